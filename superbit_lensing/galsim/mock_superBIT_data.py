@@ -32,14 +32,26 @@ import numpy as np
 import fitsio
 from astropy.io import fits
 from numpy.random import SeedSequence, default_rng
-from functools import reduce
 from astropy.table import Table
 from argparse import ArgumentParser
 from mpi_helper import MPIHelper
-from multiprocessing import Pool
+from multiprocessing import Pool, Lock
+from multiprocessing.sharedctypes import RawArray
 
 import superbit_lensing.utils as utils
 
+# The data shared by all object renders of a run, set once per pool worker
+_WORKER_DATA = None
+
+# The shared-memory frame the pool workers add their stamps to, & the locks
+# of its row bands
+_FRAME = None
+_FRAME_LOCKS = None
+
+# The number of frame rows each lock covers; stamps are a few dozen rows, so
+# most adds only lock one or two bands
+FRAME_LOCK_ROWS = 128
+
 def parse_args():
     parser = ArgumentParser()
 
@@ -55,6 +67,10 @@ def parse_args():
                         help='Number of cores to use for multiproessing')
     parser.add_argument('--mpi', action='store_true', default=False,
                         help='Use to turn on mpi')
+    parser.add_argument('--render_once', action='store_true', default=None,
+                        help='Render each object once & reuse it across exposures')
+    parser.add_argument('--fast_stars', action='store_true', default=None,
+                        help='Draw stars by scaling a single PSF template')
     parser.add_argument('--clobber', action='store_true', default=False,
                         help='Turn on to overwrite existing files')
     parser.add_argument('--vb', action='store_true', default=False,
@@ -111,14 +127,100 @@ def nfw_lensing(nfw_halo, pos, nfw_z_source):
 
     return nfw_shear, nfw_mu
 
-def make_obj_runner(batch_indices, *args, **kwargs):
+def make_frame_image(frame_buf, frame_bounds):
+    '''
+    Wrap a shared float32 buffer as a galsim.ImageF w/ the given bounds,
+    w/o copying it
+    '''
+
+    nx = frame_bounds.xmax - frame_bounds.xmin + 1
+    ny = frame_bounds.ymax - frame_bounds.ymin + 1
+
+    array = np.frombuffer(frame_buf, dtype=np.float32).reshape(ny, nx)
+
+    return galsim.Image(array, xmin=frame_bounds.xmin, ymin=frame_bounds.ymin)
+
+def _init_worker(worker_data, frame_buf, frame_locks, frame_bounds):
+    '''
+    Sets the data shared by all object renders of a run (catalogs, PSF,
+    WCS, etc.) once per pool worker, rather than sending it w/ every batch,
+    & attaches the worker to the shared frame
+    '''
+
+    global _WORKER_DATA, _FRAME, _FRAME_LOCKS
+    _WORKER_DATA = worker_data
+    _FRAME = make_frame_image(frame_buf, frame_bounds)
+    _FRAME_LOCKS = frame_locks
+
+    return
+
+def _add_to_frame(stamp):
+    '''
+    Add a stamp to the shared frame. Stamps of different workers can
+    overlap, so each add holds the locks of the row bands (of
+    FRAME_LOCK_ROWS rows) it touches; adds to different bands run at once
+    '''
+
+    bounds = stamp.bounds & _FRAME.bounds
+
+    if not bounds.isDefined():
+        return
+
+    first = (bounds.ymin - _FRAME.bounds.ymin) // FRAME_LOCK_ROWS
+    last = (bounds.ymax - _FRAME.bounds.ymin) // FRAME_LOCK_ROWS
+    locks = _FRAME_LOCKS[first:last+1]
+
+    # always taken in band order, so that workers can't deadlock
+    for lock in locks:
+        lock.acquire()
+    try:
+        _FRAME[bounds] += stamp[bounds]
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+    return
+
+def make_obj_batch(obj_type, batch_indices, seed):
     '''
-    Handles the batch running of make_obj() over multiple cores
+    Runs make_obj() over a batch of indices in a pool worker, using the
+    shared data set by _init_worker(). Only the object type, indices & seed
+    of the batch are sent to the worker. The stamps are added to the shared
+    frame as they are made, so only the truths are sent back
+
+    returns: list
+        The (i, truth, flux) of each successfully made object
     '''
 
+    d = _WORKER_DATA
+
+    ud = galsim.UniformDeviate(seed)
+    kwargs = {}
+
+    if obj_type == 'gal':
+        args = [ud, d['wcs'], d['affine'], d['cosmos_cat'], d['nfw'],
+                d['psf'], d['sbparams'], d['logprint']]
+    elif obj_type == 'cluster_gal':
+        args = [ud, d['wcs'], d['affine'], d['centerpix'], d['cluster_cat'],
+                d['psf'], d['sbparams'], d['logprint']]
+    elif obj_type == 'star':
+        pud = np.random.default_rng(d['sbparams'].stars_seed)
+        args = [ud, pud, batch_indices, d['wcs'], d['affine'], d['psf'],
+                d['sbparams'], d['logprint']]
+        kwargs['star_template'] = d['star_template']
+    else:
+        raise ValueError(f'Object type must be one of gal, cluster_gal ' +\
+                         'or star!')
+
     res = []
     for i in batch_indices:
-        res.append(make_obj(i, *args, **kwargs))
+        i, stamp, truth = make_obj(i, obj_type, *args, **kwargs)
+
+        if (stamp is None) or (truth is None):
+            continue
+
+        _add_to_frame(stamp)
+        res.append((i, truth, np.sum(stamp.array)))
 
     return res
 
@@ -156,9 +258,10 @@ def make_obj(i, obj_type, *args, **kwargs):
 
     return i, stamp, truth
 
-def combine_objs(make_obj_outputs, full_image, truth_catalog, exp_num):
+def combine_objs(make_obj_outputs, truth_catalog, exp_num):
     '''
-    (i, stamps, truths) are the output of make_obj
+    (i, truth, flux) are the output of make_obj_batch; the stamps
+    themselves were already added to the shared frame by the workers
     exp_num is the exposure number. Only add to truth table if == 1
     '''
 
@@ -166,21 +269,7 @@ def combine_objs(make_obj_outputs, full_image, truth_catalog, exp_num):
     make_obj_outputs = [item for sublist in make_obj_outputs
                         for item in sublist]
 
-    for i, stamp, truth in make_obj_outputs:
-
-        if (stamp is None) or (truth is None):
-            continue
-
-        # Find the overlapping bounds:
-        bounds = stamp.bounds & full_image.bounds
-
-        # Finally, add the stamp to the full image.
-        try:
-            full_image[bounds] += stamp[bounds]
-        except galsim.errors.GalSimBoundsError as e:
-            print(e)
-
-        this_flux = np.sum(stamp.array)
+    for i, truth, this_flux in make_obj_outputs:
 
         if exp_num == 1:
             row = [i, truth.cosmos_index, truth.x, truth.y,
@@ -193,7 +282,7 @@ def combine_objs(make_obj_outputs, full_image, truth_catalog, exp_num):
                    ]
             truth_catalog.addRow(row)
 
-    return full_image, truth_catalog
+    return truth_catalog
 
 def make_a_galaxy(ud, wcs, affine, cosmos_cat, nfw, psf, sbparams, logprint, obj_index=None):
     """
@@ -382,9 +471,46 @@ def make_cluster_galaxy(ud, wcs,affine, centerpix, cluster_cat, psf, sbparams, l
     return cluster_stamp, cluster_galaxy_truth
 
 
-def make_a_star(ud, pud, k, wcs, affine, psf, sbparams, logprint, obj_index=None):
+class StarTemplate():
+
+    def __init__(self, psf, local_wcs, logprint):
+        '''
+        class to store the unit-flux PSF stamp that stars are scaled from,
+        along w/ the truth values they share
+        :psf: the (constant) PSF profile
+        :local_wcs: the local WCS to draw the stamp w/, e.g. at the image center
+        :stamp: the unit-flux PSF stamp, centered as make_a_star() draws stars
+        :fwhm/mom_size: the truth FWHM & adaptive-moment size of every star
+        '''
+
+        start = time.time()
+
+        self.stamp = psf.drawImage(wcs=local_wcs)
+
+        try:
+            self.fwhm = psf.calculateFWHM()
+        except galsim.errors.GalSimError:
+            logprint.debug('fwhm calculation failed')
+            self.fwhm = -9999.0
+
+        try:
+            self.mom_size = self.stamp.FindAdaptiveMom().moments_sigma
+        except galsim.errors.GalSimError:
+            logprint.debug('sigma calculation failed')
+            self.mom_size = -9999.
+
+        logprint(f'Made {self.stamp.array.shape} star template in ' +\
+                 f'{time.time()-start:.2f}s')
+
+        return
+
+def make_a_star(ud, pud, k, wcs, affine, psf, sbparams, logprint, obj_index=None,
+                star_template=None):
     """
     makes a star-like object for injection into larger image.
+
+    If a StarTemplate is passed, the star is its stamp scaled by the star
+    flux rather than a fresh render of the PSF, w/ the template's truths
     """
 
     # Choose a random RA, Dec around the sky_center.
@@ -428,6 +554,21 @@ def make_a_star(ud, pud, k, wcs, affine, psf, sbparams, logprint, obj_index=None
         else:
             raise NotImplementedError('Star power law only implemented for crates_b!')
 
+    star_truth = truth()
+    star_truth.ra = ra.deg; star_truth.dec = dec.deg
+    star_truth.x = image_pos.x; star_truth.y = image_pos.y
+    star_truth.obj_class = 'star'
+
+    if star_template is not None:
+        # a star is just the PSF scaled by its flux
+        star_stamp = star_template.stamp * star_flux
+        star_stamp.setCenter(image_pos.x, image_pos.y)
+
+        star_truth.fwhm = star_template.fwhm
+        star_truth.mom_size = star_template.mom_size
+
+        return star_stamp, star_truth
+
     # Generate PSF at location of star, convolve with optical model to make a star
     deltastar = galsim.DeltaFunction(flux=star_flux)
     star = galsim.Convolve([psf, deltastar])
@@ -435,11 +576,6 @@ def make_a_star(ud, pud, k, wcs, affine, psf, sbparams, logprint, obj_index=None
     star_stamp = star.drawImage(wcs=wcs.local(image_pos)) # before it was scale = 0.206, and that was bad!
     star_stamp.setCenter(image_pos.x, image_pos.y)
 
-    star_truth = truth()
-    star_truth.ra = ra.deg; star_truth.dec = dec.deg
-    star_truth.x = image_pos.x; star_truth.y = image_pos.y
-    star_truth.obj_class = 'star'
-
     try:
         star_truth.fwhm = star.calculateFWHM()
     except galsim.errors.GalSimError:
@@ -636,6 +772,13 @@ class SuperBITParameters:
                 self.mpi = bool(value)
             elif option == "ncores":
                 self.ncores = int(value)
+            elif option == "render_once":
+                # unset on the command line defers to the config
+                if value is not None:
+                    self.render_once = bool(value)
+            elif option == "fast_stars":
+                if value is not None:
+                    self.fast_stars = bool(value)
             elif option == "use_optics":
                 self.use_optics = bool(value)
             elif option == "sample_gaia_cats":
@@ -678,6 +821,10 @@ class SuperBITParameters:
         self.flux_scaling = (sbit_eff_area/hst_eff_area) * self.exp_time
         if not hasattr(self,'jitter_fwhm'):
             self.jitter_fwhm = 0.1
+        if not hasattr(self,'render_once'):
+            self.render_once = False
+        if not hasattr(self,'fast_stars'):
+            self.fast_stars = False
 
         return
 
@@ -945,20 +1092,26 @@ class SuperBITParameters:
         self.run_outdir = run_dir
         self.logprint(f'Completed directory structure setup at {run_dir}')
 
-# function to help with reducing MPI results from each process to single result
-def combine_images(im1, im2):
-    """Combine two galsim.Image objects into one."""
-    # easy since they support +. Try using in-place operation to reduce memory
-    im1 += im2
-    return im1
-
-def combine_catalogs(t1, t2):
-    """Combine two galsim.OutputCatalog objects into one"""
-    # as far as I can tell, they expose no way of doing this aside from messing
-    # with the internal lists directly.
-    t1.rows.extend(t2.rows)
-    t1.sort_keys.extend(t2.sort_keys)
-    return t1
+def gather_truth_catalog(M, truth_catalog, names, types):
+    """
+    Gather the truth catalogs of all MPI processes into one on root, as
+    structured arrays w/ a single Gatherv rather than pickled catalogs
+    """
+
+    dtype = [(name, 'U32' if t is str else t) for name, t in zip(names, types)]
+    rows = np.array([tuple(row) for row in truth_catalog.rows], dtype=dtype)
+
+    rows = M.gather_array(rows)
+
+    if not M.is_mpi_root():
+        return None
+
+    catalog = galsim.OutputCatalog(names, types)
+    for rank_rows in rows:
+        for row in rank_rows:
+            catalog.addRow(list(row.tolist()))
+
+    return catalog
 
 def main(args):
     """
@@ -1087,11 +1240,52 @@ def main(args):
     sky_center = galsim.CelestialCoord(ra=sbparams.center_ra, dec=sbparams.center_dec)
     wcs = galsim.TanWCS(affine, sky_center, units=galsim.arcsec)
 
+    ##
+    ## Set up the star fast path
+    ##
+    if sbparams.fast_stars is True:
+        # The PSF doesn't vary across the field, so every star is the same
+        # PSF stamp scaled by its flux. It is drawn once w/ the WCS at the
+        # image center; TanWCS's local scale barely changes across the field
+        star_template = StarTemplate(
+            psf, wcs.local(fiducial_full_image.true_center), logprint
+            )
+    else:
+        star_template = None
+
     ##
     ## Define RNG for dither offsets
     ##
     rng = np.random.default_rng(sbparams.dithering_seed)
 
+    # drawn up front (in the same order as before), so that the render-once
+    # object frame can cover all of the exposures
+    dithers = [rng.integers(-100, 100, size=2) for i in range(sbparams.nexp)]
+
+    # the union of the dithered exposures
+    dxs = [d[0] for d in dithers]
+    dys = [d[1] for d in dithers]
+    frame_bounds = galsim.BoundsI(
+        int(min(dxs)), int(max(dxs)) + sbparams.image_xsize - 1,
+        int(min(dys)), int(max(dys)) + sbparams.image_ysize - 1
+        )
+
+    ##
+    ## Set up the render-once mode
+    ##
+    render_once = sbparams.render_once
+    objs_rendered = False
+
+    if render_once is True:
+        # The dithers are integer shifts of the image origin under a fixed
+        # WCS, so each object lands on the same (sub-pixel) image position in
+        # every exposure & the object seeds don't change between them. The
+        # objects are thus rendered once, into a frame covering the union of
+        # the dithered exposures, which each exposure cuts its bounds out of
+        obj_image = None
+        logprint(f'Rendering objects once into a {frame_bounds} frame ' +\
+                 'shared by all exposures')
+
     ###
     ### MAKE SIMULATED OBSERVATIONS
     ### ITERATE n TIMES TO MAKE n SEPARATE IMAGES
@@ -1153,332 +1347,373 @@ def main(args):
         logprint = utils.LogPrint(log, vb)
         logprint(f'Moved log file to {new_log_path}')
     
-    # Initialize truth catalog during first run
-    if mpi is False or M.is_mpi_root():
-        names = ['gal_num', 'cosmos_index','x_image', 'y_image',
-                 'ra', 'dec', 'nfw_g1', 'nfw_g2',
-                 'nfw_mu', 'redshift', 'flux',
-                 'truth_fwhm','truth_mom', 'n',
-                 'hlr', 'scale_h_over_r', 'obj_class']
-        types = [int, int, float, float, float, float, float,
-                 float, float, float, float, float, float,
-                 float, float, float, str]
-        truth_catalog = galsim.OutputCatalog(names, types)
-
-    for i in np.arange(1, sbparams.nexp+1):
-        if mpi is True:
-            # get MPI processes in sync at start of each image
-            M.barrier()
-
-        outnum = str(i).zfill(3)
-        outname = f'{run_name}_{outnum}_{band}_sim.fits'
-        file_name = os.path.join(output_dir, outname)
-
-        # Set up the image:
-        full_image = galsim.ImageF(sbparams.image_xsize, sbparams.image_ysize)
-        sky_level = sbparams.exp_time * sbparams.sky_bkg / sbparams.gain
-        full_image.fill(sky_level)
-
-        ## Define X & Y dither offsets
-        dither_offsets = rng.integers(-100, 100, size=2)
-        logprint(f'dithers are {dither_offsets}')
-        full_image.setOrigin(dither_offsets[0], dither_offsets[1])
-        full_image.wcs = wcs
-
-        #####
-        ## Loop over galaxy objects:
-        #####
-        print('Starting galaxy injections')
-
-        if mpi is False:
-            start = time.time()
-            with Pool(ncores) as pool:
-                # Create batches
-                batch_indices = utils.setup_batches(sbparams.nobj, ncores)
-
-                full_image, truth_catalog = combine_objs(
-                    pool.starmap(
-                        make_obj_runner,
-                        ([
-                          batch_indices[k],
-                          'gal',
-                          galsim.UniformDeviate(sbparams.galobj_seed+k+1),
-                          wcs,
-                          affine,
-                          cosmos_cat,
-                          nfw,
-                          psf,
-                          sbparams,
-                          logprint
-                          ] for k in range(ncores))
-                        ),
-                    full_image,
-                    truth_catalog,
-                    i
-                    )
-
-            dt = time.time() - start
-            logprint(f'Total time for galaxy injections: {dt:.1f}s')
-
-        else:
-            # get local range to iterate over in this process
-            local_start, local_end = M.mpi_local_range(sbparams.nobj)
-            for k in range(local_start, local_end):
-                time1 = time.time()
+    # Initialize truth catalog during first run. On MPI, each process
+    # fills its own & they are gathered to root after the first exposure
+    names = ['gal_num', 'cosmos_index','x_image', 'y_image',
+             'ra', 'dec', 'nfw_g1', 'nfw_g2',
+             'nfw_mu', 'redshift', 'flux',
+             'truth_fwhm','truth_mom', 'n',
+             'hlr', 'scale_h_over_r', 'obj_class']
+    types = [int, int, float, float, float, float, float,
+             float, float, float, float, float, float,
+             float, float, float, str]
+    truth_catalog = galsim.OutputCatalog(names, types)
+
+    center_coords = galsim.CelestialCoord(sbparams.center_ra,sbparams.center_dec)
+    centerpix = wcs.toImage(center_coords)
 
-                # The usual random number generator using a different seed for each galaxy.
-                ud = galsim.UniformDeviate(sbparams.galobj_seed+k+1)
-
-                try:
-                    # make single galaxy object
-                    stamp, truth = make_a_galaxy(ud=ud,
-                                                wcs=wcs,
-                                                affine=affine,
-                                                cosmos_cat=cosmos_cat,
-                                                psf=psf,
-                                                nfw=nfw,
-                                                sbparams=sbparams,
-                                                logprint=logprint
-                                                )
-                    # Find the overlapping bounds:
-                    bounds = stamp.bounds & full_image.bounds
-
-                    # Finally, add the stamp to the full image.
-
-                    full_image[bounds] += stamp[bounds]
-                    time2 = time.time()
-                    tot_time = time2-time1
-                    logprint(f'Galaxy {k} positioned relative to center t={tot_time} s')
-                    this_flux=np.sum(stamp.array)
-
-                    if i == 1:
-                        row = [ k, truth.cosmos_index, truth.x, truth.y, truth.ra, truth.dec, truth.g1,
-                                truth.g2, truth.mu,truth.z,
-                                this_flux, truth.fwhm, truth.mom_size,
-                                truth.n, truth.hlr, truth.scale_h_over_r, truth.obj_class]
-                        truth_catalog.addRow(row)
-                except galsim.errors.GalSimError:
-                    logprint(f'Galaxy {k} has failed, skipping...')
-
-        #####
-        ### Inject cluster galaxy objects:
-        #####
-        print('Starting cluster galaxy injections')
-
-        center_coords = galsim.CelestialCoord(sbparams.center_ra,sbparams.center_dec)
-        centerpix = wcs.toImage(center_coords)
-
-        if mpi is False:
+    ##
+    ## Start one pool for the whole run, whose workers get the catalogs, PSF
+    ## & WCS once rather than w/ every batch of every exposure. The workers
+    ## add their stamps to a shared frame covering all exposures, rather
+    ## than sending them back to be added here one by one
+    ##
+    pool = None
+    frame_image = None
+    if mpi is False:
+        worker_data = {
+            'wcs': wcs,
+            'affine': affine,
+            'centerpix': centerpix,
+            'cosmos_cat': cosmos_cat,
+            'cluster_cat': cluster_cat,
+            'nfw': nfw,
+            'psf': psf,
+            'star_template': star_template,
+            'sbparams': sbparams,
+            'logprint': logprint
+            }
+
+        if vb is True:
+            # what each batch used to send; costs a pickling, so only if vb
             start = time.time()
-            with Pool(ncores) as pool:
-                batch_indices = utils.setup_batches(sbparams.nclustergal, ncores)
-
-                full_image, truth_catalog = combine_objs(
-                    pool.starmap(
-                        make_obj_runner,
-                        ([
-                          batch_indices[k],
-                          'cluster_gal',
-                          galsim.UniformDeviate(sbparams.cluster_seed+k+1),
-                          wcs,
-                          affine,
-                          centerpix,
-                          cluster_cat,
-                          psf,
-                          sbparams,
-                          logprint
-                          ] for k in range(ncores))
-                        ),
-                    full_image,
-                    truth_catalog,
-                    i
-                    )
-
-            dt = time.time() - start
-            logprint(f'Total time for cluster galaxy injections: {dt:.1f}s')
-
-        else:
-            # get local range to iterate over in this process
-            local_start, local_end = M.mpi_local_range(sbparams.nclustergal)
-            for k in range(local_start, local_end):
-
-                time1 = time.time()
-
-                # The usual random number generator using a different seed for each galaxy.
-                ud = galsim.UniformDeviate(sbparams.cluster_seed+k+1)
-
-                try:
-                    # make single galaxy object
-                    cluster_stamp,truth = make_cluster_galaxy(ud=ud,wcs=wcs,affine=affine,
-                                                            centerpix=centerpix,
-                                                            cluster_cat=cluster_cat,
-                                                            psf=psf,
-                                                            sbparams=sbparams,
-                                                            logprint=logprint)
-                    # Find the overlapping bounds:
-                    bounds = cluster_stamp.bounds & full_image.bounds
-
-                    # Finally, add the stamp to the full image.
-
-                    full_image[bounds] += cluster_stamp[bounds]
-                    time2 = time.time()
-                    tot_time = time2-time1
-                    logprint(f'Cluster galaxy {k} positioned relative to center t={tot_time} s')
-                    this_flux=np.sum(cluster_stamp.array)
+            nbytes = len(pickle.dumps(worker_data))
+            logprint(f'Shared worker data is {nbytes/1024**2:.1f} MB ' +\
+                     f'(pickled in {time.time()-start:.2f}s); sent once ' +\
+                     'per worker instead of once per batch')
+
+        nx = frame_bounds.xmax - frame_bounds.xmin + 1
+        ny = frame_bounds.ymax - frame_bounds.ymin + 1
+        frame_buf = RawArray('f', nx * ny)
+        frame_locks = [Lock() for k in range(int(np.ceil(ny / FRAME_LOCK_ROWS)))]
+        frame_image = make_frame_image(frame_buf, frame_bounds)
+
+        start = time.time()
+        pool = Pool(
+            ncores, initializer=_init_worker,
+            initargs=(worker_data, frame_buf, frame_locks, frame_bounds)
+            )
+        logprint(f'Started pool of {ncores} workers in ' +\
+                 f'{time.time()-start:.2f}s')
+
+    # the pool is torn down even if an exposure fails, so its workers
+    # never outlive the run
+    try:
+        for i in np.arange(1, sbparams.nexp+1):
+            if mpi is True:
+                # get MPI processes in sync at start of each image
+                M.barrier()
+
+            outnum = str(i).zfill(3)
+            outname = f'{run_name}_{outnum}_{band}_sim.fits'
+            file_name = os.path.join(output_dir, outname)
+
+            # Set up the image:
+            full_image = galsim.ImageF(sbparams.image_xsize, sbparams.image_ysize)
+            sky_level = sbparams.exp_time * sbparams.sky_bkg / sbparams.gain
+            if (mpi is False) or (M.is_mpi_root()):
+                # on MPI, the images of all processes are summed on root
+                full_image.fill(sky_level)
+
+            ## Define X & Y dither offsets
+            dither_offsets = dithers[i-1]
+            logprint(f'dithers are {dither_offsets}')
+            full_image.setOrigin(dither_offsets[0], dither_offsets[1])
+            full_image.wcs = wcs
+
+            # In render-once mode, the objects are injected into the (empty)
+            # object frame on the first exposure only
+            render_objs = (render_once is False) or (objs_rendered is False)
+
+            if render_once is True:
+                exp_image = full_image
+                if render_objs is True:
+                    full_image = galsim.ImageF(frame_bounds, wcs=wcs)
+                    render_start = time.time()
+
+            if render_objs is True:
+                #####
+                ## Loop over galaxy objects:
+                #####
+                print('Starting galaxy injections')
+
+                if mpi is False:
+                    start = time.time()
+                    # Create batches
+                    batch_indices = utils.setup_batches(sbparams.nobj, ncores)
+
+                    truth_catalog = combine_objs(
+                        pool.starmap(
+                            make_obj_batch,
+                            [('gal', batch_indices[k], sbparams.galobj_seed+k+1)
+                             for k in range(ncores)]
+                            ),
+                        truth_catalog,
+                        i
+                        )
 
-                    if i == 1:
-                        row = [ k, truth.cosmos_index, truth.x, truth.y, truth.ra, truth.dec,
-                                truth.g1, truth.g2, truth.mu, truth.z,
-                                this_flux, truth.fwhm, truth.mom_size,
-                                truth.n, truth.hlr, truth.scale_h_over_r, truth.obj_class]
-                        truth_catalog.addRow(row)
-                except galsim.errors.GalSimError:
-                    logprint(f'Cluster galaxy {k} has failed, skipping...')
-
-        #####
-        ### Now repeat process for stars!
-        #####
-        print('Starting star injections')
-
-        if mpi is False:
-            start = time.time()
-            pud = np.random.default_rng(sbparams.stars_seed)
-
-            with Pool(ncores) as pool:
-                batch_indices = utils.setup_batches(sbparams.nstars, ncores)
-
-                full_image, truth_catalog = combine_objs(
-                    pool.starmap(
-                        make_obj_runner,
-                        ([
-                          batch_indices[k],
-                          'star',
-                          galsim.UniformDeviate(sbparams.stars_seed+k+1),
-                          pud,
-                          batch_indices[k],
-                          wcs,
-                          affine,
-                          psf,
-                          sbparams,
-                          logprint
-                          ] for k in range(sbparams.ncores))
-                        ),
-                    full_image,
-                    truth_catalog,
-                    i
-                    )
+                    dt = time.time() - start
+                    logprint(f'Total time for galaxy injections: {dt:.1f}s')
 
-            dt = time.time() - start
-            logprint(f'Total time for star injections: {dt:.1f}s')
+                else:
+                    # get local range to iterate over in this process
+                    local_start, local_end = M.mpi_local_range(sbparams.nobj)
+                    for k in range(local_start, local_end):
+                        time1 = time.time()
+
+                        # The usual random number generator using a different seed for each galaxy.
+                        ud = galsim.UniformDeviate(sbparams.galobj_seed+k+1)
+
+                        try:
+                            # make single galaxy object
+                            stamp, truth = make_a_galaxy(ud=ud,
+                                                        wcs=wcs,
+                                                        affine=affine,
+                                                        cosmos_cat=cosmos_cat,
+                                                        psf=psf,
+                                                        nfw=nfw,
+                                                        sbparams=sbparams,
+                                                        logprint=logprint
+                                                        )
+                            # Find the overlapping bounds:
+                            bounds = stamp.bounds & full_image.bounds
+
+                            # Finally, add the stamp to the full image.
+
+                            full_image[bounds] += stamp[bounds]
+                            time2 = time.time()
+                            tot_time = time2-time1
+                            logprint(f'Galaxy {k} positioned relative to center t={tot_time} s')
+                            this_flux=np.sum(stamp.array)
+
+                            if i == 1:
+                                row = [ k, truth.cosmos_index, truth.x, truth.y, truth.ra, truth.dec, truth.g1,
+                                        truth.g2, truth.mu,truth.z,
+                                        this_flux, truth.fwhm, truth.mom_size,
+                                        truth.n, truth.hlr, truth.scale_h_over_r, truth.obj_class]
+                                truth_catalog.addRow(row)
+                        except galsim.errors.GalSimError:
+                            logprint(f'Galaxy {k} has failed, skipping...')
+
+                #####
+                ### Inject cluster galaxy objects:
+                #####
+                print('Starting cluster galaxy injections')
+
+                if mpi is False:
+                    start = time.time()
+                    batch_indices = utils.setup_batches(sbparams.nclustergal, ncores)
+
+                    truth_catalog = combine_objs(
+                        pool.starmap(
+                            make_obj_batch,
+                            [('cluster_gal', batch_indices[k],
+                              sbparams.cluster_seed+k+1) for k in range(ncores)]
+                            ),
+                        truth_catalog,
+                        i
+                        )
 
+                    dt = time.time() - start
+                    logprint(f'Total time for cluster galaxy injections: {dt:.1f}s')
 
-        else:
-            # get local range to iterate over in this process
-            local_start, local_end = M.mpi_local_range(sbparams.nstars)
-            for k in range(local_start, local_end):
-                time1 = time.time()
-                ud = galsim.UniformDeviate(sbparams.stars_seed+k+1)
-                pud = np.random.default_rng(sbparams.stars_seed)
-                star_stamp,truth = make_a_star(ud=ud,pud=pud,
-                                            index=k,
-                                            wcs=wcs,
-                                            affine=affine,
-                                            psf=psf,
-                                            sbparams=sbparams,
-                                            logprint=logprint
-                                            )
-                bounds = star_stamp.bounds & full_image.bounds
-
-                # Add the stamp to the full image.
-                try:
-                    full_image[bounds] += star_stamp[bounds]
+                else:
+                    # get local range to iterate over in this process
+                    local_start, local_end = M.mpi_local_range(sbparams.nclustergal)
+                    for k in range(local_start, local_end):
+
+                        time1 = time.time()
+
+                        # The usual random number generator using a different seed for each galaxy.
+                        ud = galsim.UniformDeviate(sbparams.cluster_seed+k+1)
+
+                        try:
+                            # make single galaxy object
+                            cluster_stamp,truth = make_cluster_galaxy(ud=ud,wcs=wcs,affine=affine,
+                                                                    centerpix=centerpix,
+                                                                    cluster_cat=cluster_cat,
+                                                                    psf=psf,
+                                                                    sbparams=sbparams,
+                                                                    logprint=logprint)
+                            # Find the overlapping bounds:
+                            bounds = cluster_stamp.bounds & full_image.bounds
+
+                            # Finally, add the stamp to the full image.
+
+                            full_image[bounds] += cluster_stamp[bounds]
+                            time2 = time.time()
+                            tot_time = time2-time1
+                            logprint(f'Cluster galaxy {k} positioned relative to center t={tot_time} s')
+                            this_flux=np.sum(cluster_stamp.array)
+
+                            if i == 1:
+                                row = [ k, truth.cosmos_index, truth.x, truth.y, truth.ra, truth.dec,
+                                        truth.g1, truth.g2, truth.mu, truth.z,
+                                        this_flux, truth.fwhm, truth.mom_size,
+                                        truth.n, truth.hlr, truth.scale_h_over_r, truth.obj_class]
+                                truth_catalog.addRow(row)
+                        except galsim.errors.GalSimError:
+                            logprint(f'Cluster galaxy {k} has failed, skipping...')
+
+                #####
+                ### Now repeat process for stars!
+                #####
+                print('Starting star injections')
+
+                if mpi is False:
+                    start = time.time()
+                    batch_indices = utils.setup_batches(sbparams.nstars, ncores)
+
+                    truth_catalog = combine_objs(
+                        pool.starmap(
+                            make_obj_batch,
+                            [('star', batch_indices[k], sbparams.stars_seed+k+1)
+                             for k in range(ncores)]
+                            ),
+                        truth_catalog,
+                        i
+                        )
 
-                    time2 = time.time()
-                    tot_time = time2-time1
+                    dt = time.time() - start
+                    logprint(f'Total time for star injections: {dt:.1f}s')
 
-                    logprint(f'Star {k}: positioned relative to center, t={tot_time} s')
-                    this_flux=np.sum(star_stamp.array)
 
-                    if i == 1:
-                        row = [ k, truth.cosmos_index, truth.x, truth.y, truth.ra, truth.dec,
-                                truth.g1, truth.g2, truth.mu,
-                                truth.z, this_flux, truth.fwhm,truth.mom_size,
-                                truth.n, truth.hlr, truth.scale_h_over_r, truth.obj_class]
-                        truth_catalog.addRow(row)
-
-                except galsim.errors.GalSimError:
-                    logprint(f'Star {k} has failed, skipping...')
-
-        # If not using MPI, then this is already done
-        if mpi is True:
-            # Gather results from MPI processes, reduce to single result on root
-            # Using same names on left and right sides is hiding lots of MPI magic
-            full_image = M.gather(full_image)
-            truth_catalog = M.gather(truth_catalog)
-            if M.is_mpi_root():
-                full_image = reduce(combine_images, full_image)
-
-                if i == 1:
-                    truth_catalog = reduce(combine_catalogs, truth_catalog)
                 else:
-                    # do the adding of noise and writing to disk entirely on root
-                    # root and the rest meet again at barrier at start of loop
-                    continue
-
-        # The first thing to do is to make the Gaussian noise uniform across the whole image.
-
-        if (mpi is False) or (M.is_mpi_root()):
-
-            # Add dark current
-            logprint('Adding Dark current')
-            dark_noise = sbparams.dark_current * sbparams.exp_time
-            full_image += dark_noise
-
-            # Add ccd noise
-            logprint('Adding CCD noise')
-            noise = galsim.CCDNoise(
-                sky_level=0,
-                gain=sbparams.gain,
-                read_noise=sbparams.read_noise,
-                rng=galsim.BaseDeviate(sbparams.noise_seed)
-                )
+                    # get local range to iterate over in this process
+                    local_start, local_end = M.mpi_local_range(sbparams.nstars)
+                    for k in range(local_start, local_end):
+                        time1 = time.time()
+                        ud = galsim.UniformDeviate(sbparams.stars_seed+k+1)
+                        pud = np.random.default_rng(sbparams.stars_seed)
+                        star_stamp,truth = make_a_star(ud=ud,pud=pud,
+                                                    k=k,
+                                                    obj_index=k,
+                                                    wcs=wcs,
+                                                    affine=affine,
+                                                    psf=psf,
+                                                    sbparams=sbparams,
+                                                    logprint=logprint,
+                                                    star_template=star_template
+                                                    )
+                        bounds = star_stamp.bounds & full_image.bounds
+
+                        # Add the stamp to the full image.
+                        try:
+                            full_image[bounds] += star_stamp[bounds]
+
+                            time2 = time.time()
+                            tot_time = time2-time1
+
+                            logprint(f'Star {k}: positioned relative to center, t={tot_time} s')
+                            this_flux=np.sum(star_stamp.array)
+
+                            if i == 1:
+                                row = [ k, truth.cosmos_index, truth.x, truth.y, truth.ra, truth.dec,
+                                        truth.g1, truth.g2, truth.mu,
+                                        truth.z, this_flux, truth.fwhm,truth.mom_size,
+                                        truth.n, truth.hlr, truth.scale_h_over_r, truth.obj_class]
+                                truth_catalog.addRow(row)
+
+                        except galsim.errors.GalSimError:
+                            logprint(f'Star {k} has failed, skipping...')
+
+                if mpi is False:
+                    # the workers added their stamps to the shared frame
+                    full_image += frame_image[full_image.bounds]
+                    frame_image.setZero()
+
+                # If not using MPI, then this is already done
+                if mpi is True:
+                    # Sum the images of all MPI processes into root's in place,
+                    # communicating raw buffers, so root only holds one frame
+                    M.reduce_array(full_image.array)
 
-            full_image.addNoise(noise)
+                    if i == 1:
+                        truth_catalog = gather_truth_catalog(
+                            M, truth_catalog, names, types
+                            )
+
+            if render_once is True:
+                if render_objs is True:
+                    # on MPI, only the root holds the reduced object frame
+                    obj_image = full_image
+                    objs_rendered = True
+                    logprint(f'Rendered objects once in {time.time()-render_start:.1f}s')
+
+                full_image = exp_image
+                if (mpi is False) or (M.is_mpi_root()):
+                    full_image += obj_image[full_image.bounds]
+
+            # The first thing to do is to make the Gaussian noise uniform across the whole image.
+
+            if (mpi is False) or (M.is_mpi_root()):
+
+                # Add dark current
+                logprint('Adding Dark current')
+                dark_noise = sbparams.dark_current * sbparams.exp_time
+                full_image += dark_noise
+
+                # Add ccd noise
+                logprint('Adding CCD noise')
+                noise = galsim.CCDNoise(
+                    sky_level=0,
+                    gain=sbparams.gain,
+                    read_noise=sbparams.read_noise,
+                    rng=galsim.BaseDeviate(sbparams.noise_seed)
+                    )
 
-            logprint.debug('Added noise to final output image')
-            
-            # Make sure the output directory exists
-            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+                full_image.addNoise(noise)
 
-            try:
-                full_image.write(file_name, clobber=clobber)
-                logprint(f'Wrote image to {file_name}')
-            except OSError as e:
-                logprint(f'OSError: {e}')
-                raise e
+                logprint.debug('Added noise to final output image')
+                
+                # Make sure the output directory exists
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
 
-            # Write truth catalog to file after all exposures
-            if i == sbparams.nexp:
                 try:
-                    truth_catalog.write(truth_file_name)
-                    logprint(f'Wrote truth to {truth_file_name}')
-
-                    # It can be useful to load the true PSF into memory for
-                    # later tests. So we pickle it now and save the filename
-                    # into the truth catalog header
-                    psf_outfile = os.path.join(
-                        output_dir, f'true_psf_{band}.pkl'
-                        )
-                    with open(psf_outfile, 'wb') as psf_pfile:
-                        pickle.dump(psf, psf_pfile)
-
-                    with fits.open(truth_file_name, mode='update') as handle:
-                        handle[0].header['psf_pkl'] = psf_outfile
-
+                    full_image.write(file_name, clobber=clobber)
+                    logprint(f'Wrote image to {file_name}')
                 except OSError as e:
                     logprint(f'OSError: {e}')
                     raise e
 
+                # Write truth catalog to file after all exposures
+                if i == sbparams.nexp:
+                    try:
+                        truth_catalog.write(truth_file_name)
+                        logprint(f'Wrote truth to {truth_file_name}')
+
+                        # It can be useful to load the true PSF into memory for
+                        # later tests. So we pickle it now and save the filename
+                        # into the truth catalog header
+                        psf_outfile = os.path.join(
+                            output_dir, f'true_psf_{band}.pkl'
+                            )
+                        with open(psf_outfile, 'wb') as psf_pfile:
+                            pickle.dump(psf, psf_pfile)
+
+                        with fits.open(truth_file_name, mode='update') as handle:
+                            handle[0].header['psf_pkl'] = psf_outfile
+
+                    except OSError as e:
+                        logprint(f'OSError: {e}')
+                        raise e
+    finally:
+        if pool is not None:
+            # on success all the (synchronous) work is done; on failure
+            # any that is left is dropped
+            pool.terminate()
+            pool.join()
+
     logprint('\nCompleted all images\n')
 
     if (mpi is False) or (M.is_mpi_root()):
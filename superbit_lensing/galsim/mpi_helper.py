@@ -1,4 +1,6 @@
 # Helper that wraps mpi4py and allows fallback to serial
+import numpy as np
+
 comm_except_list = []
 
 def mpi_abort_excepthook(comm):
@@ -20,9 +22,9 @@ class MPIHelper:
     """
     Wrap MPI operations to provide serial fallback.
 
-    If you ever want to efficiently communicate large numpy arrays, bug Steve
-    to copy in those functions. Existing ones use more time/memory than needed,
-    though they will still work.
+    The generic bcast/scatter/gather pickle their data, which uses more
+    time/memory than needed for large numpy arrays. Use reduce_array and
+    gather_array for those, which communicate raw buffers.
     """
 
     def __init__(self, mpi=True,  mpi_root=0, comm=None):
@@ -45,6 +47,7 @@ class MPIHelper:
         self.mpi = mpi
 
         if mpi:
+            self.MPI = MPI
             self.comm = comm if comm is not None else MPI.COMM_WORLD
             self.mpi_rank = self.comm.Get_rank()
             self.mpi_size = self.comm.Get_size()
@@ -52,6 +55,7 @@ class MPIHelper:
             self.rank_fmt = self.rank_fmt.format(self.mpi_rank)
             mpi_abort_excepthook(self.comm)
         else:
+            self.MPI = None
             self.comm = None
             self.mpi_rank = 0
             self.mpi_size = 1
@@ -157,7 +161,99 @@ class MPIHelper:
             return [data]
         return self.comm.gather(data, root=self.mpi_root)
 
-    # TODO add more efficient communication for np.arrays with mem buffer
+    def reduce_array(self, data, op='sum'):
+        """
+        Elementwise reduce a numpy array across MPI processes to root,
+        communicating the raw buffer. On root, the result is accumulated
+        into data in place, so root holds a single copy.
+
+        Arguments
+        ---------
+        data : np.ndarray
+            C-contiguous array, of the same shape & dtype on each process.
+        op : str
+            The reduction; one of 'sum', 'prod', 'min' or 'max'.
+
+        Returns
+        -------
+        data :
+            On root, data w/ the reduced values. None on other processes.
+        """
+        if not self.mpi:
+            return data
+
+        ops = {
+            'sum': self.MPI.SUM,
+            'prod': self.MPI.PROD,
+            'min': self.MPI.MIN,
+            'max': self.MPI.MAX,
+        }
+        if op not in ops:
+            raise ValueError("op must be one of {}".format(list(ops)))
+
+        if not data.flags['C_CONTIGUOUS']:
+            raise ValueError("reduce_array needs a C-contiguous array")
+
+        if self.is_mpi_root():
+            self.comm.Reduce(self.MPI.IN_PLACE, data, op=ops[op],
+                             root=self.mpi_root)
+            return data
+
+        self.comm.Reduce(data, None, op=ops[op], root=self.mpi_root)
+        return None
+
+    def gather_array(self, data):
+        """
+        Gather numpy arrays (incl. structured arrays) of varying length
+        from each MPI process to root w/ a single Gatherv of their raw
+        buffers. Falls back to the pickling gather if the dtypes or
+        trailing shapes differ between processes, or hold python objects.
+
+        Arguments
+        ---------
+        data : np.ndarray
+            Array to gather; may have a different length on each process.
+
+        Returns
+        -------
+        data :
+            On root, list of the arrays of each process, as views into
+            one received buffer (same as gather). None on other processes.
+        """
+        data = np.ascontiguousarray(data)
+
+        if not self.mpi:
+            return [data]
+
+        # small, so fine to pickle
+        meta = self.comm.allgather(
+            (data.dtype, data.shape[1:], len(data), data.dtype.hasobject)
+        )
+
+        dtype, tail = meta[0][0], meta[0][1]
+        if any((m[0] != dtype) or (m[1] != tail) or m[3] for m in meta):
+            return self.comm.gather(data, root=self.mpi_root)
+
+        lengths = [m[2] for m in meta]
+        row_bytes = dtype.itemsize * int(np.prod(tail))
+        counts = [n * row_bytes for n in lengths]
+        displs = [int(d) for d in np.cumsum([0] + counts[:-1])]
+
+        sendbuf = data.reshape(-1).view(np.uint8)
+
+        if not self.is_mpi_root():
+            self.comm.Gatherv(sendbuf, None, root=self.mpi_root)
+            return None
+
+        recv = np.empty((sum(lengths),) + tuple(tail), dtype=dtype)
+        self.comm.Gatherv(
+            sendbuf,
+            [recv.reshape(-1).view(np.uint8), counts, displs, self.MPI.BYTE],
+            root=self.mpi_root
+        )
+
+        starts = np.cumsum([0] + lengths[:-1])
+        return [recv[s:s+n] for s, n in zip(starts, lengths)]
 
     def mpi_local_size(self, size):
         """
@@ -257,6 +353,20 @@ if __name__ == "__main__":
     M.log("gather received {}".format(M.gather(data)), root=True)
     M.barrier()
 
+    # array reduce test
+    M.log("Array reduce test", root=True)
+    data = np.full(4, M.mpi_rank + 1, dtype=np.float32)
+    M.log("reduce_array received {}".format(M.reduce_array(data)), root=True)
+    M.barrier()
+
+    # structured array gather test
+    M.log("Array gather test", root=True)
+    data = np.zeros(M.mpi_rank + 1, dtype=[('rank', int), ('x', float)])
+    data['rank'] = M.mpi_rank
+    data['x'] = np.arange(len(data)) / 10.
+    M.log("gather_array received {}".format(M.gather_array(data)), root=True)
+    M.barrier()
+
     # range test
     M.log("Range test", root=True)
     size = 113
@@ -7,6 +7,7 @@ from argparse import ArgumentParser
 import superbit_lensing.utils as utils
 from superbit_lensing.medsmaker.superbit import medsmaker_real as medsmaker
 from superbit_lensing.medsmaker.superbit.hotcold_sextractor import HotColdSExtractor
+from superbit_lensing.medsmaker.superbit.meds_writer import write_meds
 import yaml
 import pdb
 
@@ -37,6 +38,8 @@ def parse_args():
                              'configuration files for star processing')
     parser.add_argument('-detection_bandpass', type=str, default='b',
                         help='Shape measurement (detection) bandpass')
+    parser.add_argument('-ncores', type=int, default=1,
+                        help='Number of exposures (or MEDS shards) to process in parallel')
     parser.add_argument('--meds_coadd', action='store_true', default=False,
                         help='Set to keep coadd cutout in MEDS file')
     parser.add_argument('--use_ext_header', action='store_true', default=False,
@@ -58,6 +61,7 @@ def main(args):
     ext_header = args.use_ext_header
     overwrite = args.overwrite
     bands = args.bands
+    ncores = args.ncores
     star_config_dir = args.star_config_dir
     detection_bandpass = args.detection_bandpass
     vb = args.vb
@@ -150,7 +154,11 @@ def main(args):
             vb=vb
         )
 
-        bm.make_sextractor_weight()
+        # The bmask only needs the exposure mask, so make it in the same
+        # pass as the SExtractor weights
+        bm.make_exposure_planes(
+            ['sex_weight', 'bmask'], ncores=ncores, overwrite=overwrite
+            )
 
         # Get detection source file & catalog
         logprint('Making coadd...\n')
@@ -169,9 +177,8 @@ def main(args):
         #hcs.make_dual_image_catalogs(detection_bandpass)
 
         logprint('Making single-exposure catalogs... \n')
-        bm.make_exposure_catalogs(astro_config_dir)
-        bm.make_exposure_weights()
-        bm.make_exposure_bmask()
+        bm.make_exposure_catalogs(astro_config_dir, ncores=ncores)
+        bm.make_exposure_weights(ncores=ncores, overwrite=overwrite)
         bm.make_coadd_weight()
         
         # Set image catalogs attribute
@@ -184,6 +191,7 @@ def main(args):
             psf_mode=psf_mode,
             psf_seed=psf_seed,
             star_config=star_config,
+            ncores=ncores
         )
 
         logprint('Making MEDS... \n')
@@ -207,14 +215,13 @@ def main(args):
         meta = bm.meds_metadata(magzp, use_coadd)
 
         logprint('Finally, make and write the MEDS file... \n')
-        # Finally, make and write the MEDS file.
-        medsObj = meds.maker.MEDSMaker(
-                  obj_info, image_info, config=meds_config,
-                  psf_data=bm.psf_models, meta_data=meta
-                  )
-
+        # Finally, make and write the MEDS file, sharded over ncores
         logprint(f'Writing to {outfile} \n')
-        medsObj.write(outfile)
+        write_meds(
+            outfile, obj_info, image_info, config=meds_config,
+            psf_data=bm.psf_models, meta_data=meta, ncores=ncores,
+            logprint=logprint
+            )
 
     logprint('Done!')
 
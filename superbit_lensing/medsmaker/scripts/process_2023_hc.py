@@ -36,6 +36,8 @@ def parse_args():
                         help='Path to the directory containing the YAML configuration files for star processing')
     parser.add_argument('--select_truth_stars', action='store_true', default=False,
                         help='Set to match against truth catalog for PSF model fits')
+    parser.add_argument('-ncores', type=int, default=1,
+                        help='Number of exposures to process in parallel')
     parser.add_argument('--meds_coadd', action='store_true', default=False,
                         help='Set to keep coadd cutout in MEDS file')
     parser.add_argument('--overwrite', action='store_true', default=False,
@@ -53,6 +55,7 @@ def main(args):
     psf_seed = args.psf_seed
     use_coadd = args.meds_coadd
     overwrite = args.overwrite
+    ncores = args.ncores
     bands = args.bands
     star_config_dir = args.star_config_dir
     select_truth_stars = args.select_truth_stars
@@ -141,7 +144,7 @@ def main(args):
 
         # Run HotColdSExtractor on Single Exposures
         logprint('Making single-exposure catalogs...')
-        single_exposure_catalogs = hcs.make_exposure_catalogs()
+        single_exposure_catalogs = hcs.make_exposure_catalogs(ncores=ncores)
 
         # Build a PSF model for each image.
         logprint('Making PSF models...')
@@ -6,6 +6,7 @@ import meds
 from argparse import ArgumentParser
 import superbit_lensing.utils as utils
 from superbit_lensing.medsmaker.superbit import medsmaker_mocks as medsmaker
+from superbit_lensing.medsmaker.superbit.meds_writer import write_meds
 
 import ipdb
 
@@ -28,6 +29,8 @@ def parse_args():
                         help='model exposure PSF using either piff or psfex')
     parser.add_argument('-psf_seed', type=int, default=None,
                         help='Seed for chosen PSF estimation mode')
+    parser.add_argument('-ncores', type=int, default=1,
+                        help='Number of exposures (or MEDS shards) to process in parallel')
     parser.add_argument('--meds_coadd', action='store_true', default=False,
                         help='Set to keep coadd cutout in MEDS file')
     parser.add_argument('--overwrite', action='store_true', default=False,
@@ -50,6 +53,7 @@ def main(args):
     psf_seed = args.psf_seed
     use_coadd = args.meds_coadd
     overwrite = args.overwrite
+    ncores = args.ncores
     source_selection = args.source_select
     select_truth_stars = args.select_truth_stars
     vb = args.vb
@@ -96,7 +100,7 @@ def main(args):
 
     # Make single-exposure catalogs
     logprint('Making single-exposure catalogs...')
-    im_cats = bm.make_exposure_catalogs()
+    im_cats = bm.make_exposure_catalogs(ncores=ncores)
 
     # Build a PSF model for each image.
     logprint('Making PSF models...')
@@ -131,15 +135,13 @@ def main(args):
     # Create metadata for MEDS
     magzp = 30.
     meta = bm.meds_metadata(magzp, use_coadd)
-    # Finally, make and write the MEDS file.
-
-    medsObj = meds.maker.MEDSMaker(
-        obj_info, image_info, config=meds_config,
-        psf_data=bm.psf_models, meta_data=meta
-        )
-
+    # Finally, make and write the MEDS file, sharded over ncores
     logprint(f'Writing to {outfile}')
-    medsObj.write(outfile)
+    write_meds(
+        outfile, obj_info, image_info, config=meds_config,
+        psf_data=bm.psf_models, meta_data=meta, ncores=ncores,
+        logprint=logprint
+        )
 
     logprint('Done!')
 
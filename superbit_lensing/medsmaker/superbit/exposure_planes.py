@@ -0,0 +1,270 @@
+'''
+Fused generation of the per-exposure planes derived from the exposure mask:
+the SExtractor weight, the inverse-variance weight & the bmask. Each exposure
+is read once for all requested planes, planes whose inputs haven't changed
+since they were written are skipped & the exposures are processed in parallel
+'''
+
+import numpy as np
+import os
+import fitsio
+from multiprocessing import Pool
+
+# The output suffix of each plane
+PLANE_SUFFIXES = {
+    'sex_weight': '.sex_weight.fits',
+    'weight': '.weight.fits',
+    'bmask': '.bmask.fits',
+    }
+
+# The HDU holding the data of each plane. SExtractor & SWarp can't read
+# tile-compressed images, so the sex_weight is written uncompressed; the
+# others are compressed & thus live in the first extension
+PLANE_EXTS = {
+    'sex_weight': 0,
+    'weight': 1,
+    'bmask': 1,
+    }
+
+# Header keys not to carry over from the input image, as the planes have
+# their own dtype & (no) scaling
+_SKIP_KEYS = ['BZERO', 'BSCALE', 'BLANK']
+
+# The exposure mask, set once per pool worker
+_MASK = None
+
+def plane_filename(image_file, plane):
+    '''
+    The filename of a plane of an exposure, e.g.
+    image.fits -> image.weight.fits
+
+    image_file: str
+        The exposure image file
+    plane: str
+        One of PLANE_SUFFIXES
+    '''
+
+    if plane not in PLANE_SUFFIXES:
+        raise ValueError(f'plane must be one of {list(PLANE_SUFFIXES)}!')
+
+    return image_file.replace('.fits', PLANE_SUFFIXES[plane])
+
+def plane_inputs(image_file, plane):
+    '''
+    The exposure files a plane is computed from (besides the mask)
+    '''
+
+    if plane == 'weight':
+        # the SExtractor BACKGROUND_RMS check-image
+        return [image_file.replace('.fits', '.bkg_rms.fits')]
+
+    # the image is only needed for its header
+    return [image_file]
+
+def has_plane_layout(outfile, plane):
+    '''
+    Check whether an existing plane file has the layout make_planes()
+    writes it w/ (see PLANE_EXTS), e.g. not an uncompressed plane w/ its
+    data in HDU 0 written before the planes were compressed
+
+    outfile: str
+        The plane file
+    plane: str
+        One of PLANE_SUFFIXES
+    '''
+
+    ext = PLANE_EXTS[plane]
+
+    try:
+        with fitsio.FITS(outfile) as fits:
+            if len(fits) != ext + 1:
+                return False
+            # only the planes outside of the primary HDU are compressed
+            return fits[ext].is_compressed() == (ext > 0)
+    except OSError:
+        return False
+
+def get_data_ext(filename):
+    '''
+    The first HDU of a FITS file that holds image data, e.g. 1 for a
+    tile-compressed plane & 0 for an uncompressed one
+
+    filename: str
+        The FITS file
+    '''
+
+    with fitsio.FITS(filename) as fits:
+        for ext, hdu in enumerate(fits):
+            if hdu.has_data():
+                return ext
+
+    raise ValueError(f'{filename} has no HDU w/ data!')
+
+def is_up_to_date(outfile, infiles, plane=None):
+    '''
+    Check whether outfile exists & is newer than all of infiles (&, if
+    plane is passed, has the layout of that plane)
+
+    outfile: str
+        The output file
+    infiles: list of str
+        The files outfile was computed from
+    plane: str
+        The plane outfile holds, if any; one of PLANE_SUFFIXES
+    '''
+
+    if not os.path.exists(outfile):
+        return False
+
+    out_mtime = os.path.getmtime(outfile)
+
+    for infile in infiles:
+        if os.path.getmtime(infile) > out_mtime:
+            return False
+
+    if (plane is not None) and (not has_plane_layout(outfile, plane)):
+        return False
+
+    return True
+
+def _clean_header(header):
+    # the header is freshly read, so it can be modified in place
+    for key in _SKIP_KEYS:
+        if key in header:
+            header.delete(key)
+
+    return header
+
+def _get_shape(header):
+    return (header['NAXIS2'], header['NAXIS1'])
+
+def make_planes(image_file, planes, mask, mask_file=None, overwrite=False):
+    '''
+    Write the requested planes of a single exposure
+
+    image_file: str
+        The exposure image file
+    planes: list of str
+        The planes to write; any of PLANE_SUFFIXES
+    mask: np.ndarray
+        The (boolean) exposure mask; True where masked. None if the
+        image is unmasked (e.g. a coadd)
+    mask_file: str
+        The file the mask was read from, if any. Planes are rewritten if it
+        is newer than them
+    overwrite: bool
+        Set to rewrite planes even if they are up to date
+
+    returns: dict
+        The filename of each plane & whether it was written
+    '''
+
+    results = {}
+
+    # the image header is shared by the sex_weight & bmask planes, while
+    # the weight plane needs the rms image; each is read at most once
+    image_header = None
+
+    for plane in planes:
+        outfile = plane_filename(image_file, plane)
+        infiles = plane_inputs(image_file, plane)
+        if mask_file is not None:
+            infiles = infiles + [mask_file]
+
+        if (overwrite is False) and is_up_to_date(outfile, infiles, plane=plane):
+            results[plane] = (outfile, False)
+            continue
+
+        if plane == 'weight':
+            rms, header = fitsio.read(infiles[0], header=True)
+            header = _clean_header(header)
+
+            rms = rms.astype(np.float32, copy=False)
+            data = np.zeros(rms.shape, dtype=np.float32)
+            good = rms > 0
+            data[good] = 1. / rms[good]**2
+            if mask is not None:
+                data[mask] = 0
+
+            # lossless, as the weights aren't quantized
+            fitsio.write(outfile, data, header=header, compress='GZIP_2',
+                         qlevel=None, clobber=True)
+
+        else:
+            if image_header is None:
+                image_header = _clean_header(fitsio.read_header(image_file))
+            shape = _get_shape(image_header)
+
+            if plane == 'sex_weight':
+                data = np.ones(shape, dtype=np.float32)
+                if mask is not None:
+                    data[mask] = 0
+                fitsio.write(outfile, data, header=image_header,
+                             clobber=True)
+            else:
+                data = np.zeros(shape, dtype=np.int16)
+                if mask is not None:
+                    data[mask] = 1
+                fitsio.write(outfile, data, header=image_header,
+                             compress='RICE', clobber=True)
+
+        results[plane] = (outfile, True)
+
+    return results
+
+def _init_worker(mask):
+    global _MASK
+    _MASK = mask
+
+    return
+
+def _make_planes(args):
+    image_file, planes, mask_file, overwrite = args
+
+    return make_planes(
+        image_file, planes, _MASK, mask_file=mask_file, overwrite=overwrite
+        )
+
+def make_exposure_planes(image_files, planes, mask, mask_file=None,
+                         overwrite=False, ncores=1):
+    '''
+    Write the requested planes of all exposures, in parallel if ncores > 1
+
+    image_files: list of str
+        The exposure image files
+    planes: list of str
+        The planes to write; any of PLANE_SUFFIXES
+    mask: np.ndarray
+        The (boolean) exposure mask; True where masked
+    mask_file: str
+        The file the mask was read from, if any
+    overwrite: bool
+        Set to rewrite planes even if they are up to date
+    ncores: int
+        The number of exposures to process at once
+
+    returns: list of dicts
+        The results of make_planes() for each exposure, in order
+    '''
+
+    for plane in planes:
+        if plane not in PLANE_SUFFIXES:
+            raise ValueError(f'plane must be one of {list(PLANE_SUFFIXES)}!')
+
+    args = [(image_file, planes, mask_file, overwrite)
+            for image_file in image_files]
+
+    ncores = min(ncores, len(image_files))
+
+    if ncores <= 1:
+        _init_worker(mask)
+        try:
+            results = [_make_planes(a) for a in args]
+        finally:
+            _init_worker(None)
+    else:
+        # the mask is sent once per worker rather than once per exposure
+        with Pool(ncores, initializer=_init_worker, initargs=(mask,)) as pool:
+            results = pool.map(_make_planes, args)
+
+    return results
@@ -9,6 +9,8 @@ from shapely.geometry import MultiPolygon, box
 from rtree import index
 
 import superbit_lensing.utils as utils
+from superbit_lensing.medsmaker.superbit.sextractor_executor import \
+    SExtractorExecutor, sextractor_log_filename
 
 class HotColdSExtractor:
 
@@ -44,22 +46,52 @@ class HotColdSExtractor:
         '''
         Function that calls the SExtractor command building function based on the selected mode.
         '''
-        cold_cat, hot_cat, default_cat = None, None, None
 
-        # Run 'cold' (bright-mode) Source Extractor
-        if 'cold' in self.modes:
-            cold_cat = self._run_sextractor(self.config_dir, imagefile, self.catdir, "cold", self.data_dir, back_type)
-            self.logprint(f"Cold mode catalog complete: {cold_cat}\n")
+        self._run_modes([imagefile], back_type=back_type)
 
-        # Run 'hot' (faint-mode) Source Extractor
-        if 'hot' in self.modes:
-            hot_cat = self._run_sextractor(self.config_dir, imagefile, self.catdir, "hot", self.data_dir, back_type)
-            self.logprint(f"Hot mode catalog complete: {hot_cat}\n")
+    def _run_modes(self, imagefiles, back_type='AUTO', ncores=1):
+        '''
+        Run SExtractor on all imagefiles in each of the selected modes, w/
+        up to ncores calls at once, then merge the hot & cold catalogs of
+        each image. The modes of an image write the same check-images, so
+        they are run one after another; only the images run concurrently
+        '''
+
+        mode_order = [m for m in ['cold', 'hot', 'default'] if m in self.modes]
+
+        executor = SExtractorExecutor(
+            max_workers=ncores, logprint=self.logprint
+            )
+
+        cats = [{} for imagefile in imagefiles]
+        for mode in mode_order:
+            cmds = []; cat_files = []
+            for imagefile in imagefiles:
+                cmd, cat_file = self._get_sextractor_cmd(
+                    self.config_dir, imagefile, self.catdir, mode,
+                    self.data_dir, back_type
+                    )
+                cmds.append(cmd)
+                cat_files.append(cat_file)
+
+            executor.run(
+                cmds, [sextractor_log_filename(c) for c in cat_files]
+                )
 
-        # Run 'default' (one-mode) Source Extractor
-        if 'default' in self.modes:
-            default_cat = self._run_sextractor(self.config_dir, imagefile, self.catdir, "default", self.data_dir, back_type)
-            self.logprint(f"Default mode catalog complete: {default_cat}\n")
+            for image_cats, cat_file in zip(cats, cat_files):
+                image_cats[mode] = cat_file
+                self.logprint(f"{mode.capitalize()} mode catalog complete: {cat_file}\n")
+
+        for imagefile, image_cats in zip(imagefiles, cats):
+            self._merge_modes(imagefile, image_cats)
+
+    def _merge_modes(self, imagefile, cats):
+        '''
+        Merge the hot & cold catalogs of imagefile, if both were made
+        '''
+
+        cold_cat = cats.get('cold')
+        hot_cat = cats.get('hot')
 
         # If only default mode is selected, return immediately
         if 'default' in self.modes and 'cold' not in self.modes and 'hot' not in self.modes:
@@ -87,7 +119,24 @@ class HotColdSExtractor:
 
     def _run_sextractor(self, sextractor_config_path, image_file, catdir, mode, datadir, back_type='AUTO'):
         '''
-        Runs source extractor using os.system(cmd) on the given image file in the given mode
+        Runs source extractor on the given image file in the given mode
+        '''
+
+        cmd, cat_file = self._get_sextractor_cmd(
+            sextractor_config_path, image_file, catdir, mode, datadir,
+            back_type
+            )
+
+        executor = SExtractorExecutor(logprint=self.logprint)
+        executor.run_one(cmd, sextractor_log_filename(cat_file))
+
+        self.logprint(f'cat_name is {cat_file}')
+        return cat_file
+
+    def _get_sextractor_cmd(self, sextractor_config_path, image_file, catdir, mode, datadir, back_type='AUTO'):
+        '''
+        Builds the source extractor command for the given image file in the given mode
+        Returns: the command & the file path of its catalog
         '''
         self.logprint("Processing " + f'{image_file}' + " in mode " + f'{mode}')
 
@@ -116,27 +165,19 @@ class HotColdSExtractor:
 
         # Construct the SExtractor command
         cmd = self._construct_sextractor_cmd(image, cat_file, cpath, mode, back_type)
-        self.logprint("sex cmd is " + cmd)
 
-        # Print command to terminal and run
-        os.system(cmd)
+        return cmd, cat_file
 
-        self.logprint(f'cat_name is {cat_file}')
-        return cat_file
-
-    def make_exposure_catalogs(self):
+    def make_exposure_catalogs(self, ncores=1):
         '''
         Wrapper script that runs through the list of single exposures,
-        runs SExtractor on each, and returns a list of the catalogs.
+        runs SExtractor on each (in all modes, up to ncores calls at once),
+        and returns a list of the catalogs.
         '''
 
-        exposure_catalogs = []
-
         self.catdir = os.path.join(self.data_dir, self.target_name, self.band, "cat")
 
-        for imagefile in self.image_files:
-            sexcat = self.run(imagefile, self.catdir)
-            exposure_catalogs.append(sexcat)
+        self._run_modes(self.image_files, ncores=ncores)
 
     def make_coadd_catalog(self, use_band_coadd=False):
         '''
@@ -185,10 +226,10 @@ class HotColdSExtractor:
 
         # Construct the SExtractor command in dual image mode
         cmd = self._construct_sextractor_cmd(image_file1, cat_file, self.config_dir, mode, back_type='MANUAL', dual_image_mode=True, second_image=image_file2)
-        self.logprint("sex cmd is " + cmd)
 
         # Run the command
-        os.system(cmd)
+        executor = SExtractorExecutor(logprint=self.logprint)
+        executor.run_one(cmd, sextractor_log_filename(cat_file))
 
         self.logprint(f'Dual image catalog is {cat_file}')
         return cat_file
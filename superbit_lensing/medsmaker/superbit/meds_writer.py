@@ -0,0 +1,350 @@
+'''
+Parallel, sharded MEDS writing. The object table is split into contiguous
+shards, each of which is written to its own MEDS file by a separate
+meds.maker.MEDSMaker in a forked worker (so that the cutout extraction &
+PSF rendering run in parallel), after which the shards are merged into a
+single MEDS file
+
+MEDSMaker lays out the cutouts of each extension object by object, so the
+merged cutouts are those a single MEDSMaker would write, w/ the start_row &
+psf_start_row of each shard offset by the pixels of the shards before it.
+The shards are written uncompressed & the merged cutouts compressed once,
+w/ the compression of the MEDSMaker config, so the pixels are only
+quantized once
+'''
+
+import numpy as np
+import os
+import time
+import fitsio
+import meds
+from multiprocessing import get_context
+
+import superbit_lensing.utils as utils
+
+# object_data columns w/ one entry per cutout, & the extension whose pixel
+# count offsets them when merging shards
+_START_ROW_COLS = {
+    'start_row': 'image_cutouts',
+    'psf_start_row': 'psf',
+    }
+
+# The cutout compression of a MEDSMaker config w/o one, as fitsio
+# create_image_hdu() kwargs
+_DEFAULT_COMPRESSION = {
+    'compress': 'rice',
+    'qlevel': 4.0,
+    'qmethod': 'SUBTRACTIVE_DITHER_2',
+    }
+
+# The object_data values MEDSMaker gives the cutout slots past ncutout
+_UNUSED_FILL = {
+    'file_id': -1,
+    'start_row': -1,
+    'psf_start_row': -1,
+    }
+
+# Header keys that describe the layout of a shard HDU rather than its
+# contents, & so aren't carried over to the merged one
+_LAYOUT_KEYS = [
+    'SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND', 'PCOUNT', 'GCOUNT',
+    'TFIELDS', 'THEAP', 'EXTNAME', 'BZERO', 'BSCALE', 'CHECKSUM', 'DATASUM',
+    ]
+
+# The MEDSMaker inputs of the current sharded write, inherited by the
+# forked workers rather than pickled (the PSF extenders can't be)
+_SHARD_INPUTS = None
+
+def write_meds(outfile, obj_info, image_info, config=None, psf_data=None,
+               meta_data=None, ncores=1, nshards=None, logprint=None):
+    '''
+    Write a MEDS file, w/ a single MEDSMaker if ncores is 1 and sharded
+    across ncores workers otherwise
+
+    outfile: str
+        The MEDS file to write
+    obj_info: np.ndarray
+        The MEDS object info struct
+    image_info: np.ndarray
+        The MEDS image info struct
+    config: dict
+        The MEDSMaker config
+    psf_data: list
+        The PSF model of each image, if any
+    meta_data: np.ndarray
+        The MEDS metadata
+    ncores: int
+        The number of shards to write at once
+    nshards: int
+        The number of shards. Defaults to ncores
+    logprint: LogPrint
+        A LogPrint object, which simultaneously handles
+        logging & printing
+    '''
+
+    if logprint is None:
+        logprint = print
+
+    if nshards is None:
+        nshards = ncores
+
+    nshards = min(nshards, len(obj_info))
+
+    if (ncores <= 1) or (nshards <= 1):
+        medsObj = meds.maker.MEDSMaker(
+            obj_info, image_info, config=config, psf_data=psf_data,
+            meta_data=meta_data
+            )
+        medsObj.write(outfile)
+
+        return
+
+    global _SHARD_INPUTS
+    _SHARD_INPUTS = (obj_info, image_info, config, psf_data, meta_data)
+
+    chunksize = int(np.ceil(len(obj_info) / nshards))
+    chunks = utils.setup_chunks(0, len(obj_info), chunksize)
+
+    shard_files = [f'{outfile}.shard{i:03d}' for i in range(len(chunks))]
+
+    logprint(f'Writing {len(obj_info)} objects to {len(chunks)} MEDS ' +\
+             f'shards w/ {ncores} workers')
+    start = time.time()
+
+    try:
+        # fork, so that the workers share the PSF models & caches
+        with get_context('fork').Pool(ncores) as pool:
+            pool.map(
+                _write_shard,
+                [(chunk.start, chunk.stop, shard_file)
+                 for chunk, shard_file in zip(chunks, shard_files)],
+                chunksize=1
+                )
+
+        logprint(f'Shards written in {time.time()-start:.1f} s; ' +\
+                 f'merging to {outfile}')
+
+        merge_meds_shards(
+            shard_files, outfile, compression=get_compression(config)
+            )
+
+    finally:
+        _SHARD_INPUTS = None
+
+        for shard_file in shard_files:
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
+
+    logprint(f'Sharded MEDS writing took {time.time()-start:.1f} s')
+
+    return
+
+def _write_shard(args):
+    start, stop, shard_file = args
+
+    obj_info, image_info, config, psf_data, meta_data = _SHARD_INPUTS
+
+    # uncompressed, as the cutouts are compressed once when merging
+    shard_config = {} if config is None else dict(config)
+    shard_config['compression'] = None
+
+    medsObj = meds.maker.MEDSMaker(
+        obj_info[start:stop], image_info, config=shard_config,
+        psf_data=psf_data,
+        meta_data=meta_data
+        )
+    medsObj.write(shard_file)
+
+    return shard_file
+
+def get_compression(config):
+    '''
+    The fitsio create_image_hdu() kwargs of the cutout compression of a
+    MEDSMaker config, or None if it doesn't compress
+
+    config: dict
+        The MEDSMaker config
+    '''
+
+    if (config is None) or ('compression' not in config):
+        return dict(_DEFAULT_COMPRESSION)
+
+    if config['compression'] is None:
+        return None
+
+    return dict(config['compression'])
+
+def _merge_object_data(shards, offsets):
+    '''
+    Stack the object_data of the shards, offsetting the start rows of the
+    used cutouts by the pixels of the previous shards. The per-cutout
+    columns are padded to the max number of cutouts of any shard, w/
+    MEDSMaker's values for unused cutouts
+    '''
+
+    tables = [shard['object_data'].read() for shard in shards]
+
+    max_cut = max(t['start_row'].shape[1] for t in tables)
+
+    dtype = []
+    for name in tables[0].dtype.names:
+        col = tables[0][name]
+        if col.ndim == 2:
+            dtype.append((name, col.dtype, (max_cut,)))
+        else:
+            dtype.append((name, col.dtype, col.shape[1:]))
+
+    merged = np.zeros(sum(len(t) for t in tables), dtype=dtype)
+
+    row = 0
+    for ishard, t in enumerate(tables):
+        nobj = len(t)
+        ncut = t['start_row'].shape[1]
+
+        for name in t.dtype.names:
+            if t[name].ndim != 2:
+                merged[name][row:row+nobj] = t[name]
+                continue
+
+            if ncut < max_cut:
+                merged[name][row:row+nobj] = _UNUSED_FILL.get(name, 0)
+
+            vals = t[name].copy()
+
+            if (name in _START_ROW_COLS) and \
+               (_START_ROW_COLS[name] in offsets):
+                used = np.arange(ncut)[np.newaxis, :] < \
+                       t['ncutout'][:, np.newaxis]
+                vals[used] += offsets[_START_ROW_COLS[name]][ishard]
+
+            merged[name][row:row+nobj, :ncut] = vals
+
+        row += nobj
+
+    return merged
+
+def _get_npix(hdu):
+    dims = hdu.get_dims()
+
+    if len(dims) == 0:
+        return 0
+
+    return int(np.prod(dims))
+
+def _is_layout_key(name):
+    name = name.upper()
+
+    if name in _LAYOUT_KEYS:
+        return True
+
+    # NAXISn, TTYPEn, etc. & the tile compression keys
+    for prefix in ['NAXIS', 'TTYPE', 'TFORM', 'TUNIT', 'TDIM', 'Z']:
+        if name.startswith(prefix):
+            return True
+
+    return False
+
+def _get_header_keys(hdu):
+    '''
+    The header keys of a shard HDU, w/o the layout keys
+
+    hdu: fitsio.ImageHDU
+        The shard HDU
+    '''
+
+    header = hdu.read_header()
+
+    return [rec for rec in header.records()
+            if not _is_layout_key(rec['name'])]
+
+def merge_meds_shards(shard_files, outfile, compression=None):
+    '''
+    Merge MEDS files written for contiguous shards of one object table.
+    The cutout extensions keep the header keys of those of the first
+    shard. The shards should be uncompressed, as compressed ones are
+    decompressed & compressed again
+
+    shard_files: list of str
+        The shard MEDS files, in object order
+    outfile: str
+        The merged MEDS file
+    compression: dict
+        The fitsio create_image_hdu() compression kwargs of the merged
+        cutout extensions (all but the psf), e.g. from get_compression().
+        Uncompressed if None
+    '''
+
+    shards = [fitsio.FITS(f, 'r') for f in shard_files]
+
+    try:
+        # extensions in the order of the first shard, skipping the
+        # (empty) primary HDU
+        hdus = [(shards[0][i].get_extname(), shards[0][i].get_exttype())
+                for i in range(1, len(shards[0]))]
+
+        # the pixels in each cutout extension of each shard
+        sizes = {}
+        for extname, exttype in hdus:
+            if exttype != 'IMAGE_HDU':
+                continue
+            sizes[extname] = [
+                _get_npix(shard[extname]) for shard in shards
+                ]
+
+        offsets = {
+            extname: np.concatenate([[0], np.cumsum(s)[:-1]])
+            for extname, s in sizes.items()
+            }
+
+        with fitsio.FITS(outfile, 'rw', clobber=True) as fits:
+            for extname, exttype in hdus:
+                if extname == 'object_data':
+                    fits.write(
+                        _merge_object_data(shards, offsets),
+                        extname=extname
+                        )
+
+                elif exttype != 'IMAGE_HDU':
+                    # image_info & metadata are the same for all shards
+                    fits.write(shards[0][extname].read(), extname=extname)
+
+                else:
+                    npix = int(np.sum(sizes[extname]))
+                    if npix == 0:
+                        raise ValueError(f'No pixels in {extname} of ' +\
+                                         'any MEDS shard!')
+
+                    # the dtype of the first non-empty shard
+                    dtype = next(
+                        shard[extname][0:1].dtype for shard, size in
+                        zip(shards, sizes[extname]) if size > 0
+                        )
+
+                    if (compression is not None) and (extname != 'psf'):
+                        kwargs = compression
+                    else:
+                        kwargs = {}
+
+                    keys = _get_header_keys(shards[0][extname])
+
+                    fits.create_image_hdu(
+                        dims=[npix], dtype=dtype.newbyteorder('='),
+                        extname=extname, **kwargs
+                        )
+                    if len(keys) > 0:
+                        fits[extname].write_keys(keys)
+
+                    # one shard in memory at a time
+                    for shard, size, offset in zip(
+                            shards, sizes[extname], offsets[extname]):
+                        if size == 0:
+                            continue
+                        fits[extname].write(
+                            shard[extname].read(), start=int(offset)
+                            )
+
+    finally:
+        for shard in shards:
+            shard.close()
+
+    return
@@ -15,6 +15,8 @@ import astropy.coordinates
 from astroquery.gaia import Gaia
 import superbit_lensing.utils as utils
 from superbit_lensing.medsmaker.superbit.psf_extender import psf_extender
+from superbit_lensing.medsmaker.superbit.sextractor_executor import \
+    SExtractorExecutor, sextractor_log_filename
 import glob
 
 import ipdb
@@ -374,6 +376,24 @@ class BITMeasurement():
         Returns: file path of catalog
         '''
 
+        cmd, cat_name = self._get_sextractor_cmd(
+            detection_file, weight_file=weight_file,
+            sextractor_config_path=sextractor_config_path
+            )
+
+        executor = SExtractorExecutor(logprint=self.logprint)
+        executor.run_one(cmd, sextractor_log_filename(cat_name))
+
+        print("cat_name_is {}".format(cat_name))
+        return cat_name
+
+    def _get_sextractor_cmd(self, detection_file, weight_file=None,
+                            sextractor_config_path=None):
+        '''
+        Build the Source Extractor command for the supplied detection file
+        Returns: the command & the file path of its catalog
+        '''
+
         if sextractor_config_path is None:
             sextractor_config_path = os.path.join(
                 self.base_dir, 'superbit/astro_config/'
@@ -398,13 +418,7 @@ class BITMeasurement():
             weight_arg = '-WEIGHT_IMAGE ' + weight_file + ' -WEIGHT_TYPE MAP_WEIGHT'
             cmd = ' '.join([cmd, weight_arg])
 
-        self.logprint("sex cmd is " + cmd)
-
-        # utils.run_command(cmd, logprint=self.logprint)
-        os.system(cmd)
-
-        print("cat_name_is {}".format(cat_name))
-        return cat_name
+        return cmd, cat_name
 
     def make_coadd_catalog(self, sextractor_config_path=None, source_selection=False):
         '''
@@ -447,14 +461,27 @@ class BITMeasurement():
             self.logprint("coadd catalog could not be loaded; check name?")
             raise(e)
 
-    def make_exposure_catalogs(self,weight_file=None, sextractor_config_path=None):
+    def make_exposure_catalogs(self,weight_file=None, sextractor_config_path=None,
+                               ncores=1):
+        '''
+        Make the single-exposure catalogs, running up to ncores SExtractor
+        calls at once. Each call logs to a .sex.log file next to its catalog
+        '''
 
-        sexcat_names = []
+        cmds = []; sexcat_names = []
 
         for imagefile in self.image_files:
-            sexcat = self._run_sextractor(imagefile, weight_file=weight_file, sextractor_config_path=sextractor_config_path)
+            cmd, sexcat = self._get_sextractor_cmd(imagefile, weight_file=weight_file, sextractor_config_path=sextractor_config_path)
+            cmds.append(cmd)
             sexcat_names.append(sexcat)
 
+        executor = SExtractorExecutor(
+            max_workers=ncores, logprint=self.logprint
+            )
+        executor.run(
+            cmds, [sextractor_log_filename(c) for c in sexcat_names]
+            )
+
         return sexcat_names
 
     def make_psf_models(self, select_truth_stars=False, im_cats=None,
@@ -485,6 +512,7 @@ class BITMeasurement():
             Nim += 1
 
         k = 0
+        true_model = None
         for i in range(Nim):
             if (i == 0) and (use_coadd is True):
                 # TODO: temporary coadd PSF solution!
@@ -536,7 +564,10 @@ class BITMeasurement():
                 self.psf_models.append(psfex.PSFEx(psfex_model_file))
 
             elif psf_mode == 'true':
-                true_model = self._make_true_psf_model()
+                # The true PSF is the same for all images, so its (cached)
+                # renders are shared too
+                if true_model is None:
+                    true_model = self._make_true_psf_model()
                 self.psf_models.append(true_model)
 
         # TODO: temporary coadd PSF solution!
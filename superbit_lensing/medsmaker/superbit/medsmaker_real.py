@@ -13,6 +13,9 @@ from astropy.table import Table
 import astropy.units as u
 import superbit_lensing.utils as utils
 from superbit_lensing.medsmaker.superbit.psf_extender import psf_extender
+from superbit_lensing.medsmaker.superbit import exposure_planes
+from superbit_lensing.medsmaker.superbit.sextractor_executor import \
+    SExtractorExecutor, sextractor_log_filename
 import glob
 import pdb
 import copy
@@ -42,6 +45,7 @@ class BITMeasurement():
         self.band = band
         self.detection_bandpass = detection_bandpass
         self.exposure_mask_fname = "/work/mccleary_group/superbit/union/masks/mask_dark_55percent_300.npy" 
+        self._exposure_mask = None
 
         self.image_cats = []
         self.detect_img_path = None
@@ -98,9 +102,10 @@ class BITMeasurement():
         else:
             self.image_cats = imcats
 
-    def make_exposure_catalogs(self, config_dir):
+    def make_exposure_catalogs(self, config_dir, ncores=1):
         '''
-        Make single-exposure catalogs
+        Make single-exposure catalogs, running up to ncores SExtractor
+        calls at once. Each call logs to a .sex.log file next to its catalog
         '''
         if os.path.isdir(config_dir) is False:
             raise f'{configdir} does not exist, exiting'
@@ -109,42 +114,77 @@ class BITMeasurement():
         cat_dir = os.path.join(self.cluster_band_dir, 'cat')
         utils.make_dir(cat_dir)
         self.logprint(f'made catalog directory {cat_dir}')
+
+        cmds = []; cat_files = []
         for image_file in self.image_files:
-            sexcat = self._run_sextractor_on_exposure(image_file=image_file,
-                                          config_dir=config_dir,
-                                          cat_dir=cat_dir)
-            self.image_cats.append(sexcat)
+            cmd, cat_file = self._get_sextractor_exposure_cmd(
+                image_file=image_file, config_dir=config_dir, cat_dir=cat_dir
+                )
+            cmds.append(cmd)
+            cat_files.append(cat_file)
 
-    def make_exposure_weights(self):
+        executor = SExtractorExecutor(
+            max_workers=ncores, logprint=self.logprint
+            )
+        executor.run(
+            cmds, [sextractor_log_filename(c) for c in cat_files]
+            )
+
+        self.image_cats.extend(cat_files)
+
+    def make_exposure_weights(self, ncores=1, overwrite=False):
         '''
         Make inverse-variance weight maps because ngmix needs them and we 
         don't have them for SuperBIT.
         Use the SExtractor BACKGROUND_RMS check-image as a basis
         '''
-        
-        img_names = self.image_files
-        mask = np.load(self.exposure_mask_fname)
 
-        for img_name in img_names:
-            # Read in the BACKGROUND_RMS image
-            rms_name = img_name.replace('.fits', '.bkg_rms.fits')
-            
-            with fits.open(rms_name) as rms:
-                # Assuming the image data is in the primary HDU
-                background_rms_map = rms[0].data  
-                # Keep the original header to use for the weight map
-                header = rms[0].header  
+        self.make_exposure_planes(
+            ['weight'], ncores=ncores, overwrite=overwrite
+            )
+
+    def make_exposure_planes(self, planes, ncores=1, overwrite=False):
+        '''
+        Make the requested mask-derived planes (any of 'sex_weight',
+        'weight' & 'bmask') of all exposures in a single pass over each
+        exposure. The sex_weight & bmask only need the image header, but
+        the weight needs the SExtractor BACKGROUND_RMS check-image, so it
+        has to be made after the exposure catalogs
+
+        planes: list of str
+            The planes to make
+        ncores: int
+            The number of exposures to process in parallel
+        overwrite: bool
+            Set to remake planes that are newer than their inputs
+        '''
+
+        results = exposure_planes.make_exposure_planes(
+            self.image_files, planes, self._get_exposure_mask(),
+            mask_file=self.exposure_mask_fname, overwrite=overwrite,
+            ncores=ncores
+            )
 
-                # Make a weight map
-                weight_map = 1 / (background_rms_map**2)
-                weight_map[mask] = 0
+        if 'sex_weight' in planes:
+            self.sex_wgt_files = [r['sex_weight'][0] for r in results]
 
-                # Save the weight_map to a new file
-                wgt_file_name = img_name.replace('.fits', '.weight.fits')
-                hdu = fits.PrimaryHDU(weight_map, header=header)
-                hdu.writeto(wgt_file_name, overwrite=True)
+        for res in results:
+            for plane, (outfile, written) in res.items():
+                if written is True:
+                    self.logprint(f'{plane} map saved to {outfile}')
+                else:
+                    self.logprint(f'{plane} map {outfile} is up to date; ' +\
+                                  'skipping')
 
-            print(f'Weight map saved to {wgt_file_name}')
+    def _get_exposure_mask(self):
+        '''
+        Load the exposure mask once & keep it for all planes
+        '''
+
+        if self._exposure_mask is None:
+            self._exposure_mask = np.load(self.exposure_mask_fname)
+
+        return self._exposure_mask
 
     def make_coadd_weight(self):
         '''
@@ -212,69 +252,24 @@ class BITMeasurement():
         print(f'cat_name is {cat_file} \n')
         return cat_file
 
-    def make_sextractor_weight(self):
+    def make_sextractor_weight(self, ncores=1, overwrite=False):
         '''
-        Make inverse-variance weight maps because ngmix needs them and we 
-        don't have them for SuperBIT.
-        Use the SExtractor BACKGROUND_RMS check-image as a basis
+        Make the weight maps SExtractor & SWarp are run with: 1 everywhere
+        except for the masked pixels
         '''
-        
-        img_names = self.image_files
-        mask = np.load(self.exposure_mask_fname)
-
-        self.sex_wgt_files = [img_name.replace('.fits', '.sex_weight.fits') for img_name in img_names]
-
-        for img_name in img_names:
-            
-            with fits.open(img_name) as img:
-                # Assuming the image data is in the primary HDU
-                img_data = img[0].data  
-                # Keep the original header to use for the weight map
-                header = img[0].header  
-
-                # Initialize weight_map with ones
-                weight_map = np.ones_like(img_data, dtype=np.float32)
-
-                # Set weight to 0 where mask is True
-                weight_map[mask] = 0
-
-                # Save the weight_map to a new file
-                sex_wgt_file_name = img_name.replace('.fits', '.sex_weight.fits')
-                hdu = fits.PrimaryHDU(weight_map, header=header)
-                hdu.writeto(sex_wgt_file_name, overwrite=True)
 
-            print(f'Weight map saved to {sex_wgt_file_name}')
+        self.make_exposure_planes(
+            ['sex_weight'], ncores=ncores, overwrite=overwrite
+            )
 
-    def make_exposure_bmask(self):
+    def make_exposure_bmask(self, ncores=1, overwrite=False):
         '''
-        Make inverse-variance weight maps because ngmix needs them and we 
-        don't have them for SuperBIT.
-        Use the SExtractor BACKGROUND_RMS check-image as a basis
+        Make the exposure bmasks: 1 for the masked pixels, 0 elsewhere
         '''
-        
-        img_names = self.image_files
-        mask = np.load(self.exposure_mask_fname)
-
-        for img_name in img_names:
-            
-            with fits.open(img_name) as img:
-                # Assuming the image data is in the primary HDU
-                img_data = img[0].data  
-                # Keep the original header to use for the weight map
-                header = img[0].header  
 
-                # Initialize weight_map with ones
-                bmask_map = np.zeros_like(img_data, dtype=np.float32)
-
-                # Set weight to 1e30 where mask is True
-                bmask_map[mask] = 1.0
-
-                # Save the weight_map to a new file
-                bmask_file_name = img_name.replace('.fits', '.bmask.fits')
-                hdu = fits.PrimaryHDU(bmask_map, header=header)
-                hdu.writeto(bmask_file_name, overwrite=True)
-
-            print(f'bmask map saved to {bmask_file_name}')                               
+        self.make_exposure_planes(
+            ['bmask'], ncores=ncores, overwrite=overwrite
+            )
 
     def _run_sextractor_on_exposure(self, image_file, cat_dir, config_dir,
                         weight_file=None, back_type='AUTO'):
@@ -282,6 +277,24 @@ class BITMeasurement():
         Utility method to invoke Source Extractor on supplied detection file
         Returns: file path of catalog
         '''
+
+        cmd, cat_file = self._get_sextractor_exposure_cmd(
+            image_file, cat_dir, config_dir, weight_file=weight_file,
+            back_type=back_type
+            )
+
+        executor = SExtractorExecutor(logprint=self.logprint)
+        executor.run_one(cmd, sextractor_log_filename(cat_file))
+
+        print(f'cat_name is {cat_file} \n')
+        return cat_file
+
+    def _get_sextractor_exposure_cmd(self, image_file, cat_dir, config_dir,
+                                     weight_file=None, back_type='AUTO'):
+        '''
+        Build the Source Extractor command for a single exposure
+        Returns: the command & the file path of its catalog
+        '''
         cat_name = os.path.basename(image_file).replace('.fits','_cat.fits')
         cat_file = os.path.join(cat_dir, cat_name)
 
@@ -310,11 +323,7 @@ class BITMeasurement():
                     param_arg, nnw_arg, filter_arg, bg_sub_arg, config_arg
                     ])
 
-        self.logprint("sex cmd is " + cmd)
-        os.system(cmd)
-
-        print(f'cat_name is {cat_file} \n')
-        return cat_file
+        return cmd, cat_file
 
     def make_coadd_image(self, config_dir=None):
         '''
@@ -540,10 +549,17 @@ class BITMeasurement():
 
     def make_psf_models(self, config_path=None, select_truth_stars=False,
                         use_coadd=True, psf_mode='piff', psf_seed=None,
-                        star_config=None):
+                        star_config=None, ncores=1, nthreads=None):
         '''
         Make PSF models. If select_truth_stars is enabled, cross-references an
         externally-supplied star catalog before PSF fitting.
+
+        The PIFF / PSFEx fits of the exposures are run as up to ncores
+        concurrent calls, each in its own working directory & capped at
+        nthreads threads (defaults to the cores allocated to the job / ncores,
+        see utils.get_available_cores()) so that
+        they don't oversubscribe the node. The models keep the order of the
+        images, as expected by make_image_info_struct()
         '''
         self.psf_models = []
         image_files = copy.deepcopy(self.image_files)
@@ -584,33 +600,85 @@ class BITMeasurement():
 
         assert(len(image_cats)==Nim)
 
-        k = 0
+        if psf_mode == 'true':
+            # The true PSF is the same for all images, so its (cached)
+            # renders are shared too
+            true_model = self._make_true_psf_model()
+            self.psf_models = [true_model for i in range(Nim)]
+            return
+
+        if nthreads is None:
+            nthreads = max(1, utils.get_available_cores() // ncores)
+
+        # Star selection & config setup are quick, so are done serially
+        jobs = []
         for i in range(Nim):
 
             image_file = image_files[i]
             image_cat = image_cats[i]
 
             if psf_mode == 'piff':
-                piff_model = self._make_piff_model(
+                job = self._setup_piff_model(
                     image_file, image_cat, config_path=config_path,
                     star_config=star_config,
-                    psf_seed=psf_seed
+                    psf_seed=psf_seed, nthreads=nthreads
                     )
-                self.psf_models.append(piff_model)
 
             elif psf_mode == 'psfex':
-                psfex_model = self._make_psfex_model(
+                job = self._setup_psfex_model(
                     image_cat, config_path=config_path,
-                    star_config=star_config
+                    star_config=star_config, nthreads=nthreads
                     )
-                self.psf_models.append(psfex_model)
 
-            elif psf_mode == 'true':
-                true_model = self._make_true_psf_model()
-                self.psf_models.append(true_model)
+            else:
+                raise ValueError(f'psf_mode {psf_mode} not recognized!')
+
+            jobs.append(job)
+
+        self._run_psf_jobs(jobs, ncores=ncores, nthreads=nthreads)
+
+        self.psf_models = [self._load_psf_model(job) for job in jobs]
+
+        return
+
+    def _run_psf_jobs(self, jobs, ncores=1, nthreads=1):
+        '''
+        Run the PSF fitting calls set up by _setup_{piff,psfex}_model().
+        Failed PSFEx fits are only reported, as their models are loaded
+        as None; a failed PIFF fit raises
+        '''
+
+        # cap the threads of numpy & co. in the PIFF processes as well
+        env = {key: nthreads for key in
+               ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']}
+
+        executor = SExtractorExecutor(
+            max_workers=ncores, logprint=self.logprint, env=env
+            )
+        executor.run(
+            [job['cmd'] for job in jobs],
+            [job['log_file'] for job in jobs],
+            cwds=[job['work_dir'] for job in jobs],
+            check=all(job['mode'] == 'piff' for job in jobs)
+            )
 
         return
 
+    def _load_psf_model(self, job):
+        if job['mode'] == 'piff':
+            # Extend PIFF PSF to have needed PSFEx methods for MEDS
+            kwargs = {
+                'piff_file': job['model_file']
+            }
+            return psf_extender('piff', job['psf_stamp_size'], **kwargs)
+
+        try:
+            model = psfex.PSFEx(job['model_file'])
+        except:
+            model = None
+            print(f'WARNING:\n Could not find PSFEx model file {job["model_file"]}\n')
+        return model
+
     def set_psfex_model_files(self, use_coadd=False):
         '''
         Utility function to grab PSFEx model names for when you 
@@ -661,8 +729,23 @@ class BITMeasurement():
         TODO: Implement psf_seed for PSFEx!
         '''
 
+        job = self._setup_psfex_model(im_cat, config_path, star_config)
+        self._run_psf_jobs([job])
+
+        return self._load_psf_model(job)
+
+    def _setup_psfex_model(self, im_cat, config_path, star_config,
+                           nthreads=1):
+        '''
+        Select the stars of an image & build its PSFEx call. PSFEx writes
+        its check-images & XML to its working directory, so each image
+        gets its own one in psfex-output/
+        '''
+
         # Where to store PSFEx output
-        psfex_outdir = os.path.join(os.path.dirname(im_cat), 'psfex-output')
+        psfex_outdir = os.path.abspath(
+            os.path.join(os.path.dirname(im_cat), 'psfex-output')
+            )
         utils.make_dir(psfex_outdir)
 
         # Are we using a reference star catalog?
@@ -675,12 +758,11 @@ class BITMeasurement():
             autoselect_arg = '-SAMPLE_AUTOSELECT Y'
 
         # Get a star catalog!
-        psfcat_name = self._select_stars_for_psf(
+        psfcat_name = os.path.abspath(self._select_stars_for_psf(
                       sscat=im_cat,
                       star_config=star_config,
                       truthfile=truthfile
-                      )
-
+                      ))
 
         # The full path needs to be stripped from psfcat_name!
         # Define output names
@@ -695,32 +777,32 @@ class BITMeasurement():
             )
         )
 
+        # The diagnostics (chi*, resi*, *.xml, ...) of this image
+        work_dir = os.path.join(
+            psfex_outdir, os.path.basename(psfcat_name).replace('.fits', '')
+            )
+        utils.make_dir(work_dir)
+
         # Now run PSFEx on that image and accompanying catalog
-        psfex_config_arg = '-c '+ config_path + 'psfex.config'
+        psfex_config_arg = '-c '+ \
+            os.path.join(os.path.abspath(config_path), 'psfex.config')
         psfdir_arg = f'-PSF_DIR {psfex_outdir}'
 
         cmd = ' '.join(
             ['psfex', psfcat_name, psfdir_arg, psfex_config_arg, \
-                '-OUTCAT_NAME', outcat_name, autoselect_arg]
+                '-OUTCAT_NAME', outcat_name, autoselect_arg,
+                f'-NTHREADS {nthreads}']
         )
-        self.logprint("psfex cmd is " + cmd)
-        os.system(cmd)
 
-        cleanup_cmd = ' '.join(
-            ['mv chi* resi* samp* snap* proto* *.xml', psfex_outdir]
-            )
-        cleanup_cmd2 = ' '.join(
-            ['mv count*pdf ellipticity*pdf fwhm*pdf', psfex_outdir]
-            )
-        os.system(cleanup_cmd)
-        os.system(cleanup_cmd2)
+        job = {
+            'mode': 'psfex',
+            'cmd': cmd,
+            'work_dir': work_dir,
+            'log_file': os.path.join(work_dir, 'psfex.log'),
+            'model_file': psfex_model_file
+        }
 
-        try:
-            model = psfex.PSFEx(psfex_model_file)
-        except:
-            model = None
-            print(f'WARNING:\n Could not find PSFEx model file {psfex_model_file}\n')
-        return model
+        return job
 
 
     def _make_piff_model(self, im_file, im_cat, config_path, psf_seed,
@@ -733,8 +815,22 @@ class BITMeasurement():
         First, let's get it to run on one, then we can focus on running list
         '''
 
-        output_dir = os.path.join(self.outdir, 'piff-output',
-                        os.path.basename(im_file).split('.fits')[0])
+        job = self._setup_piff_model(
+            im_file, im_cat, config_path, psf_seed, star_config=star_config
+            )
+        self._run_psf_jobs([job])
+
+        return self._load_psf_model(job)
+
+    def _setup_piff_model(self, im_file, im_cat, config_path, psf_seed,
+                          star_config=None, nthreads=1):
+        '''
+        Select the stars of an image & build its piffify call, run in the
+        image's own piff-output/ directory w/ nthreads processes
+        '''
+
+        output_dir = os.path.abspath(os.path.join(self.outdir, 'piff-output',
+                        os.path.basename(im_file).split('.fits')[0]))
         utils.make_dir(output_dir)
 
         output_name = os.path.basename(im_file).replace('.fits', '.piff')
@@ -746,6 +842,12 @@ class BITMeasurement():
 
         config = utils.read_yaml(base_piff_config)
         config['select']['seed'] = psf_seed
+
+        # PIFF defaults to all cores, which oversubscribes the node when
+        # several images are fit at once
+        config['input']['nproc'] = nthreads
+        config['psf']['nproc'] = nthreads
+
         utils.write_yaml(config, run_piff_config)
 
         # PIFF wants RA in hours, not degrees
@@ -758,14 +860,14 @@ class BITMeasurement():
         else:
             truthfile = None
 
-        psfcat_name = self._select_stars_for_psf(
+        psfcat_name = os.path.abspath(self._select_stars_for_psf(
                       sscat=im_cat,
                       star_config=star_config,
                       truthfile=truthfile
-                      )
+                      ))
 
         # Now run PIFF on that image and accompanying catalog
-        image_arg  = f'input.image_file_name={im_file}'
+        image_arg  = f'input.image_file_name={os.path.abspath(im_file)}'
         psfcat_arg = f'input.cat_file_name={psfcat_name}'
         coord_arg  = f'input.ra={ra} input.dec={dec}'
         output_arg = f'output.file_name={output_name} output.dir={output_dir}'
@@ -773,19 +875,19 @@ class BITMeasurement():
         cmd = f'piffify {run_piff_config} {image_arg} {psfcat_arg} ' + \
               f'{output_arg} {coord_arg}'
 
-        self.logprint('piff cmd is ' + cmd)
-        os.system(cmd)
-
         # use stamp size defined in config
         psf_stamp_size = config['psf']['model']['size']
 
-        # Extend PIFF PSF to have needed PSFEx methods for MEDS
-        kwargs = {
-            'piff_file': output_path
+        job = {
+            'mode': 'piff',
+            'cmd': cmd,
+            'work_dir': output_dir,
+            'log_file': os.path.join(output_dir, 'piff.log'),
+            'model_file': output_path,
+            'psf_stamp_size': psf_stamp_size
         }
-        piff_extended = psf_extender('piff', psf_stamp_size, **kwargs)
 
-        return piff_extended
+        return job
 
 
     def _make_true_psf_model(self, stamp_size=25, psf_pix_scale=None):
@@ -896,18 +998,12 @@ class BITMeasurement():
         coadd_segmap = self.detect_img_file.replace('.fits', '.sgm.fits') 
         coadd_bmask = self.detect_img_file.replace('.fits', '.bmask.fits') 
 
-        with fits.open(coadd_image) as img:
-            img_data = img[0].data  
-            header = img[0].header  # Preserve the header
-
-            # Create an array of zeros with the same shape as the image
-            bmask_data = np.zeros_like(img_data, dtype=np.float32)
-
-            # Save the bmask file
-            fits.PrimaryHDU(bmask_data, header=header).writeto(coadd_bmask, overwrite=True)
-            print(f'Binary mask file saved to {coadd_bmask}')
+        # The coadd is unmasked, so its bmask is all zeros
+        exposure_planes.make_planes(
+            coadd_image, ['bmask'], mask=None
+            )
+        print(f'Binary mask file saved to {coadd_bmask}')
 
-        
         for img in self.image_files:
             bkgsub_name = img.replace('.fits','.sub.fits')
             weight_name = img.replace('.fits', '.weight.fits')
@@ -921,6 +1017,12 @@ class BITMeasurement():
             weight_files.insert(0, coadd_weight)
             bmask_files.insert(0, coadd_bmask)
 
+        # The ext of each file as it is on disk, rather than as the planes
+        # are written now, as e.g. the coadd weight is made uncompressed by
+        # make_coadd_weight()
+        weight_exts = [exposure_planes.get_data_ext(f) for f in weight_files]
+        bmask_exts = [exposure_planes.get_data_ext(f) for f in bmask_files]
+
         # If used, will be put first
         Nim = len(image_files)
         image_info = meds.util.get_image_info_struct(Nim, max_len_of_filepath)
@@ -930,9 +1032,9 @@ class BITMeasurement():
             image_info[i]['image_path']  =  image_files[i]
             image_info[i]['image_ext']   =  0
             image_info[i]['weight_path'] =  weight_files[i]
-            image_info[i]['weight_ext']  =  0
+            image_info[i]['weight_ext']  =  weight_exts[i]
             image_info[i]['bmask_path']  =  bmask_files[i]
-            image_info[i]['bmask_ext']   =  0
+            image_info[i]['bmask_ext']   =  bmask_exts[i]
             image_info[i]['seg_path']    =  coadd_segmap # Use coadd segmap for uberseg!
             image_info[i]['seg_ext']     =  0
 
@@ -1016,10 +1118,15 @@ class BITMeasurement():
         if catalog is None:
             catalog = self.detection_cat
 
+        # SExtractor star/galaxy & S/N info, e.g. for the metacal pre-screen
+        extra_cols = [col for col in ['CLASS_STAR', 'SNR_WIN', 'FLUX_RADIUS']
+                      if col in catalog.dtype.names]
+
         obj_str = meds.util.get_meds_input_struct(catalog.size, \
                   extra_fields = [('KRON_RADIUS', float), \
                   ('number', int), ('XWIN_IMAGE', float), \
-                  ('YWIN_IMAGE', float)]
+                  ('YWIN_IMAGE', float)] + \
+                  [(col, float) for col in extra_cols]
                   )
         obj_str['id'] = catalog['NUMBER']
         obj_str['number'] = np.arange(catalog.size)+1
@@ -1030,6 +1137,9 @@ class BITMeasurement():
         obj_str['YWIN_IMAGE'] = catalog['YWIN_IMAGE']
         obj_str['KRON_RADIUS'] = catalog['KRON_RADIUS']
 
+        for col in extra_cols:
+            obj_str[col] = catalog[col]
+
         return obj_str
 
     def run(self,outfile='superbit_ims.meds', overwrite=False,
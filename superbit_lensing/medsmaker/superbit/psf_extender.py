@@ -4,6 +4,14 @@ import galsim
 
 import ipdb
 
+# Default spacing (in image pixels) of the PIFF PSF cache grid; None renders
+# every PSF exactly
+PIFF_CACHE_SPACING = 256
+
+# Default max abs difference between a cached & an exact PIFF render,
+# relative to the PSF peak, for a grid cell to be served from the cache
+PIFF_CACHE_TOL = 5e-3
+
 def psf_extender(mode, stamp_size, **kwargs):
     '''
     Utility function to add the get_rec function expected
@@ -18,7 +26,9 @@ def psf_extender(mode, stamp_size, **kwargs):
     stamp_size: int
         The size of the piff PSF cutout
     kwargs: kwargs dict
-        Anything that should be passed to the corresponding PSF extender
+        Anything that should be passed to the corresponding PSF extender,
+        e.g. piff_file, cache_spacing & cache_tol for piff or psf,
+        psf_pix_scale & subpixel_bins for true
     '''
 
     # PSFEx does not need an extender
@@ -26,18 +36,50 @@ def psf_extender(mode, stamp_size, **kwargs):
 
     if mode == 'piff':
         piff_file = kwargs['piff_file']
-        psf_extended = _piff_extender(piff_file, stamp_size)
+        cache_spacing = kwargs.get('cache_spacing', PIFF_CACHE_SPACING)
+        cache_tol = kwargs.get('cache_tol', PIFF_CACHE_TOL)
+        psf_extended = _piff_extender(
+            piff_file, stamp_size, cache_spacing=cache_spacing,
+            cache_tol=cache_tol
+            )
     elif mode == 'true':
         psf = kwargs['psf']
         psf_pix_scale = kwargs['psf_pix_scale']
-        psf_extended = _true_extender(psf, stamp_size, psf_pix_scale)
+        subpixel_bins = kwargs.get('subpixel_bins', None)
+        psf_extended = _true_extender(
+            psf, stamp_size, psf_pix_scale, subpixel_bins=subpixel_bins
+            )
     else:
         raise KeyError(f'{mode} is not one of the valid PSF modes: ' +\
                        f'{valid_modes}')
 
     return psf_extended
 
-def _piff_extender(piff_file, stamp_size):
+def _get_stamp_center(x, stamp_size):
+    '''
+    The nominal center pixel of a PSF stamp drawn at x, following the
+    placement of piff.PSF.draw(). The stamp's true center is half a pixel
+    below it for an even stamp_size
+    '''
+
+    return int(np.ceil(x - (0.5 if stamp_size % 2 == 1 else 0)))
+
+def _shift_stamp(stamp_fft, dx, dy):
+    '''
+    Shift a stamp (passed as its FFT) by (dx, dy) pixels w/ a Fourier
+    phase ramp, returning the shifted stamp
+    '''
+
+    ny, nx = stamp_fft.shape
+    ky = np.fft.fftfreq(ny)[:, np.newaxis]
+    kx = np.fft.fftfreq(nx)[np.newaxis, :]
+
+    ramp = np.exp(-2j * np.pi * (kx * dx + ky * dy))
+
+    return np.fft.ifft2(stamp_fft * ramp).real
+
+def _piff_extender(piff_file, stamp_size, cache_spacing=PIFF_CACHE_SPACING,
+                   cache_tol=PIFF_CACHE_TOL):
     '''
     Utility function to add the get_rec function expected
     by the MEDS package to a PIFF PSF
@@ -46,6 +88,12 @@ def _piff_extender(piff_file, stamp_size):
         The piff filename
     stamp_size: int
         The size of the piff PSF cutout
+    cache_spacing: int
+        The spacing (in image pixels) of the grid of cached PSF renders.
+        None to render every PSF exactly
+    cache_tol: float
+        The max abs difference between a cached & an exact render, relative
+        to the PSF peak, for a grid cell to be served from the cache
     '''
 
     psf = piff.read(piff_file)
@@ -54,6 +102,15 @@ def _piff_extender(piff_file, stamp_size):
     class PiffExtender(type_name):
         '''
         A helper class that adds functions expected by MEDS
+
+        Rendering a PIFF PSF is expensive & MEDSMaker asks for one per
+        object & epoch, so PSFs are served from a grid of renders w/
+        cache_spacing pixels between nodes. The nodes of a grid cell are
+        drawn (centered) on first use & bilinearly interpolated to the
+        object position, after which the stamp is shifted to the same
+        sub-pixel position as an exact render. The first use of each cell
+        also compares the cached & an exact render; cells that fail
+        cache_tol are rendered exactly from then on
         '''
 
         def __init__(self, psf):
@@ -61,21 +118,93 @@ def _piff_extender(piff_file, stamp_size):
             self.psf = psf
             self.single_psf = type_name
 
+            # FFTs of the node renders, by node index
+            self._nodes = {}
+
+            # whether each grid cell passed the tolerance check
+            self._cells = {}
+
             return
 
-        def get_rec(self, row, col):
+        def _draw_exact(self, row, col):
 
-            fake_pex = self.psf.draw(
+            return self.psf.draw(
                 x=col, y=row, stamp_size=stamp_size
                 ).array
 
-            return fake_pex
+        def _get_node(self, i, j):
+
+            if (i, j) not in self._nodes:
+                node = self.psf.draw(
+                    x=i*cache_spacing, y=j*cache_spacing,
+                    stamp_size=stamp_size, center=True
+                    ).array
+                self._nodes[(i, j)] = np.fft.fft2(node)
+
+            return self._nodes[(i, j)]
+
+        def _get_cell(self, row, col):
+
+            i = int(np.floor(col / cache_spacing))
+            j = int(np.floor(row / cache_spacing))
+
+            return i, j
+
+        def _draw_cached(self, row, col):
+
+            i, j = self._get_cell(row, col)
+            tx = col / cache_spacing - i
+            ty = row / cache_spacing - j
+
+            stamp_fft = (1-tx) * (1-ty) * self._get_node(i, j) + \
+                        tx * (1-ty) * self._get_node(i+1, j) + \
+                        (1-tx) * ty * self._get_node(i, j+1) + \
+                        tx * ty * self._get_node(i+1, j+1)
+
+            # the nodes are centered on the stamp's true center, while
+            # exact renders are centered on the object position
+            half = 0.5 if stamp_size % 2 == 0 else 0.
+            dx = col - (_get_stamp_center(col, stamp_size) - half)
+            dy = row - (_get_stamp_center(row, stamp_size) - half)
+
+            return _shift_stamp(stamp_fft, dx, dy)
+
+        def _check_cell(self, i, j):
+
+            if (i, j) not in self._cells:
+                # an off-node, off-pixel-center position of the cell
+                row = (j + 0.5) * cache_spacing + 0.3
+                col = (i + 0.5) * cache_spacing + 0.3
+
+                exact = self._draw_exact(row, col)
+                cached = self._draw_cached(row, col)
+
+                if exact.shape != cached.shape:
+                    passed = False
+                else:
+                    err = np.max(np.abs(cached - exact)) / \
+                          np.max(np.abs(exact))
+                    passed = err <= cache_tol
+
+                self._cells[(i, j)] = passed
+
+            return self._cells[(i, j)]
+
+        def get_rec(self, row, col):
+
+            if cache_spacing is None:
+                return self._draw_exact(row, col)
+
+            if self._check_cell(*self._get_cell(row, col)) is False:
+                return self._draw_exact(row, col)
+
+            return self._draw_cached(row, col)
 
         def get_center(self, row, col):
 
-            psf_shape = self.psf.draw(
-                x=col, y=row, stamp_size=stamp_size
-                ).array.shape
+            # all stamps have the same shape, so there is no need to
+            # draw one
+            psf_shape = (stamp_size, stamp_size)
             cenpix_row = (psf_shape[0]-1)/2
             cenpix_col = (psf_shape[1]-1)/2
             cen = np.array([cenpix_row, cenpix_col])
@@ -86,7 +215,7 @@ def _piff_extender(piff_file, stamp_size):
 
     return psf_extended
 
-def _true_extender(psf, stamp_size, psf_pix_scale):
+def _true_extender(psf, stamp_size, psf_pix_scale, subpixel_bins=None):
     '''
     Utility function to add the get_rec function expected
     by the MEDS package to a True GalSim PSF
@@ -97,14 +226,25 @@ def _true_extender(psf, stamp_size, psf_pix_scale):
         The size of the piff PSF cutout
     psf_pix_scale: float
         The pixel scale in arcsec/pixel
+    subpixel_bins: int
+        If set, the PSF is drawn offset to the sub-pixel position of each
+        object (binned to subpixel_bins bins per axis) rather than centered
+        on the stamp
     '''
 
+    if (subpixel_bins is not None) and (subpixel_bins < 1):
+        raise ValueError('subpixel_bins must be a positive int!')
+
     type_name = type(psf)
 
     class TrueExtender(type_name):
         '''
         A helper class that adds functions expected by MEDS to a
         GalSim PSF
+
+        The true PSF is constant across the image, so each rendering is
+        done once per (stamp_size, pixel scale, method, sub-pixel offset
+        bin) & then served from a cache
         '''
 
         def __init__(self, psf):
@@ -112,56 +252,73 @@ def _true_extender(psf, stamp_size, psf_pix_scale):
             self.psf = psf
             self.type_name = type_name
             self.psf_pix_scale = psf_pix_scale
+            self.subpixel_bins = subpixel_bins
 
             self.wcs = galsim.PixelScale(psf_pix_scale)
 
+            # The rendered PSF images
+            self._cache = {}
+
             return
 
         # def get_wcs(self):
         #     return self.wcs
 
+        def get_offset(self, row, col):
+            '''
+            The (binned) sub-pixel offset of the PSF from the stamp center
+            as (row, col); 0 unless subpixel_bins is set
+            '''
+
+            if self.subpixel_bins is None:
+                return 0., 0.
+
+            n = self.subpixel_bins
+
+            offset = []
+            for pos in [row, col]:
+                frac = pos - np.floor(pos + 0.5)
+                ibin = min(int(np.floor((frac + 0.5) * n)), n - 1)
+                offset.append((ibin + 0.5) / n - 0.5)
+
+            return tuple(offset)
+
         def get_rec(self, row, col, method='real_space'):
             '''
             Reconstruct the PSF image at the specified location
 
             NOTE: For a constant True PSF across the image, row & col
-            are not used
+            are only used for the sub-pixel offset, if requested
             NOTE: k-space integration will cause issues for rendering
             our tiny PSF
             '''
 
-            image = galsim.Image(
-                stamp_size, stamp_size, scale=self.psf_pix_scale
-                )
-
-            psf_im = self.psf.drawImage(image, method=method).array
-            # psf = galsim.Gaussian(flux=1, fwhm=0.24)
-            # psf_im = psf.drawImage(image, method='real_space').array
-
-            # from matplotlib.colors import LogNorm
-            # import matplotlib.pyplot as plt
-            # plt.subplot(121)
-            # plt.imshow(psf_im, origin='lower', norm=LogNorm(vmin=1e-8, vmax=1e-1))
-            # plt.colorbar()
-            # plt.title('Gauss only')
+            offset = self.get_offset(row, col)
+            key = (stamp_size, self.psf_pix_scale, method, offset)
 
-            # plt.subplot(122)
-            # psf_im = self.psf.drawImage(image, method='real_space').array
-            # plt.imshow(psf_im, origin='lower', norm=LogNorm(vmin=1e-8, vmax=1e-1))
-            # plt.colorbar()
-            # plt.title('Conv[Gauss, delta]')
+            if key not in self._cache:
+                image = galsim.Image(
+                    stamp_size, stamp_size, scale=self.psf_pix_scale
+                    )
 
-            # plt.gcf().set_size_inches(9,4)
+                # galsim offsets are (x, y)
+                psf_im = self.psf.drawImage(
+                    image, method=method, offset=(offset[1], offset[0])
+                    ).array
+                psf_im.flags.writeable = False
 
-            # plt.show()
+                self._cache[key] = psf_im
 
-            return psf_im
+            # MEDSMaker may modify what it is handed
+            return self._cache[key].copy()
 
         def get_center(self, row, col):
 
-            psf_shape = self.get_rec(col, row).shape
-            cenpix_row = (psf_shape[0] - 1) / 2
-            cenpix_col = (psf_shape[1] - 1) / 2
+            # every render has the same shape, so there is no need to draw
+            psf_shape = (stamp_size, stamp_size)
+            offset = self.get_offset(row, col)
+            cenpix_row = (psf_shape[0] - 1) / 2 + offset[0]
+            cenpix_col = (psf_shape[1] - 1) / 2 + offset[1]
             cen = np.array([cenpix_row, cenpix_col])
 
             return cen
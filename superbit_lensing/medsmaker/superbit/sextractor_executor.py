@@ -0,0 +1,159 @@
+'''
+A bounded executor for the external SExtractor (or other external, e.g.
+PSFEx & PIFF) calls of the medsmakers. The calls are independent across
+exposures, so they are run concurrently w/ their output captured to per-call
+log files & their return codes checked, rather than serially through
+os.system()
+'''
+
+import os
+import shlex
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+class SExtractorError(RuntimeError):
+    pass
+
+def sextractor_log_filename(cat_file):
+    '''
+    The log file of the SExtractor call making cat_file, e.g.
+    image_cat.fits -> image_cat.sex.log
+
+    cat_file: str
+        The output catalog of the call
+    '''
+
+    return f'{os.path.splitext(cat_file)[0]}.sex.log'
+
+class SExtractorExecutor(object):
+    '''
+    Runs SExtractor (or other external) commands w/ at most max_workers at
+    once. Threads are enough, as each one only waits on its subprocess
+    '''
+
+    def __init__(self, max_workers=1, logprint=None, log_tail=20, env=None):
+        '''
+        max_workers: int
+            The maximum number of concurrent calls
+        logprint: LogPrint
+            A LogPrint object, which simultaneously handles
+            logging & printing
+        log_tail: int
+            The number of trailing log lines to report for a failed call
+        env: dict
+            Environment variables to set for the calls, on top of the
+            current environment (e.g. to cap their threads)
+        '''
+
+        if max_workers < 1:
+            raise ValueError('max_workers must be a positive int!')
+
+        self.max_workers = max_workers
+        self.logprint = logprint
+        self.log_tail = log_tail
+
+        self.env = None
+        if env is not None:
+            self.env = dict(os.environ)
+            self.env.update({k: str(v) for k, v in env.items()})
+
+        return
+
+    def _log(self, msg):
+        if self.logprint is not None:
+            self.logprint(msg)
+        else:
+            print(msg)
+
+        return
+
+    def _run_one(self, cmd, log_file, cwd=None):
+        '''
+        Run a single command in cwd, writing its stdout & stderr to log_file
+
+        returns: int
+            The return code of the call
+        '''
+
+        with open(log_file, 'w') as log:
+            log.write(f'{cmd}\n\n')
+            log.flush()
+
+            try:
+                rc = subprocess.run(
+                    shlex.split(cmd), stdout=log, stderr=subprocess.STDOUT,
+                    cwd=cwd, env=self.env
+                    ).returncode
+            except OSError as e:
+                # e.g. the executable isn't on the PATH
+                log.write(f'{e}\n')
+                rc = -1
+
+        return rc
+
+    def _get_tail(self, log_file):
+        with open(log_file, 'r') as log:
+            lines = log.read().splitlines()
+
+        return '\n'.join(lines[-self.log_tail:])
+
+    def run(self, cmds, log_files, cwds=None, check=True):
+        '''
+        Run all commands & check their return codes
+
+        cmds: list of str
+            The commands to run
+        log_files: list of str
+            The log file of each command
+        cwds: list of str
+            The working directory of each command, e.g. for tools that
+            write fixed filenames to it. Defaults to the current one
+        check: bool
+            Set to raise a SExtractorError once all calls are done if any
+            of them failed. Failed calls are reported either way
+
+        returns: list of int
+            The return code of each command, in order
+        '''
+
+        if cwds is None:
+            cwds = [None] * len(cmds)
+
+        if (len(cmds) != len(log_files)) or (len(cmds) != len(cwds)):
+            raise ValueError('cmds, log_files & cwds must have the ' +\
+                             'same length!')
+
+        for cmd, log_file in zip(cmds, log_files):
+            self._log(f'cmd is {cmd} (logging to {log_file})')
+
+        nworkers = min(self.max_workers, len(cmds))
+
+        if nworkers <= 1:
+            rcs = [self._run_one(c, l, w)
+                   for c, l, w in zip(cmds, log_files, cwds)]
+        else:
+            with ThreadPoolExecutor(max_workers=nworkers) as executor:
+                rcs = list(executor.map(self._run_one, cmds, log_files, cwds))
+
+        failed = []
+        for cmd, log_file, rc in zip(cmds, log_files, rcs):
+            if rc != 0:
+                self._log(f'call failed w/ rc={rc}: {cmd}\n' +\
+                          f'Last lines of {log_file}:\n' +\
+                          self._get_tail(log_file))
+                failed.append(log_file)
+
+        if (len(failed) > 0) and (check is True):
+            raise SExtractorError(
+                f'{len(failed)}/{len(cmds)} calls failed; see ' +\
+                ', '.join(failed)
+                )
+
+        return rcs
+
+    def run_one(self, cmd, log_file, cwd=None, check=True):
+        '''
+        Same as run(), but for a single command
+        '''
+
+        return self.run([cmd], [log_file], cwds=[cwd], check=check)[0]
@@ -0,0 +1,580 @@
+'''
+A reproducible metacal throughput benchmark. Builds a synthetic MEDS file
+(GalSim-rendered galaxies on a grid, several dithered epochs & a known
+PSF) and runs MetacalRunner over the supported fitter combinations at
+several core counts, reporting objects/sec, peak RSS & the scaling
+efficiency to a JSON file that can be compared across commits
+'''
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+from argparse import ArgumentParser
+
+import galsim
+import meds
+import ngmix
+import psutil
+
+import superbit_lensing.utils as utils
+from superbit_lensing.medsmaker.superbit.psf_extender import psf_extender
+from superbit_lensing.metacalibration.mcal_runner import MetacalRunner
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument('-outdir', type=str, default=None,
+                        help='Directory for the synthetic MEDS file & results')
+    parser.add_argument('-outfile', type=str, default='mcal_benchmark.json',
+                        help='Filename of the benchmark results')
+    parser.add_argument('-medsfile', type=str, default=None,
+                        help='Benchmark an existing MEDS file instead of ' +\
+                        'a synthetic one')
+    parser.add_argument('-nobjs', type=int, default=200,
+                        help='Number of synthetic objects')
+    parser.add_argument('-nepochs', type=int, default=4,
+                        help='Number of synthetic epochs (cutouts per object)')
+    parser.add_argument('-box_sizes', type=int, nargs='+', default=[32, 48, 64],
+                        help='Cutout box sizes to draw the objects from')
+    parser.add_argument('-psf_type', type=str, default='gauss',
+                        choices=['gauss', 'moffat'],
+                        help='Profile of the synthetic PSF')
+    parser.add_argument('-combos', type=str, nargs='+',
+                        default=list(FIT_COMBOS.keys()),
+                        help='Fitter combinations to benchmark')
+    parser.add_argument('-ncores', type=int, nargs='+', default=[1, 2, 4],
+                        help='Core counts to benchmark')
+    parser.add_argument('-chunksize', type=int, default=16,
+                        help='Number of MEDS indices handed to a worker at a time')
+    parser.add_argument('-ntry', type=int, default=3,
+                        help='Max number of fit tries per object')
+    parser.add_argument('-seed', type=int, default=723961,
+                        help='Seed of the synthetic MEDS file & the fits')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='Overwrite the synthetic MEDS file & results')
+    parser.add_argument('--vb', action='store_true', default=False,
+                        help='Make verbose')
+
+    return parser.parse_args()
+
+# (gal model, psf model) of each benchmarked fitter combination, following
+# the models supported by ngmix_fit.mp_fit_one()
+FIT_COMBOS = {
+    'gauss': ('gauss', 'gauss'),
+    'exp': ('exp', 'gauss'),
+    'coellip': ('gauss', 'coellip3'),
+    'em': ('gauss', 'em3'),
+    'gaussmom': ('gaussmom', 'gaussmom'),
+    }
+
+def make_synthetic_meds(outdir, nobjs=200, nepochs=4, box_sizes=(32, 48, 64),
+                        psf_type='gauss', psf_fwhm=0.35, pixel_scale=0.141,
+                        noise_sigma=1., dither=10., psf_stamp_size=25,
+                        seed=None, overwrite=False):
+    '''
+    Render a synthetic MEDS file of sheared exponential galaxies laid out on
+    a grid, observed in several dithered epochs w/ a constant PSF
+
+    outdir: str
+        The directory for the epoch images & the MEDS file
+    nobjs: int
+        The number of objects
+    nepochs: int
+        The number of epochs, i.e. cutouts per object
+    box_sizes: list of ints
+        The cutout box sizes; each object draws one, and its galaxy size
+        is scaled to it
+    psf_type: str
+        The PSF profile; one of gauss or moffat
+    psf_fwhm: float
+        The PSF FWHM (arcsec)
+    pixel_scale: float
+        The pixel scale (arcsec/pixel)
+    noise_sigma: float
+        The std dev of the Gaussian pixel noise
+    dither: float
+        The max dither (pixels) between epochs
+    psf_stamp_size: int
+        The size of the PSF images stored in the MEDS file
+    seed: int
+        The seed of the galaxy properties, dithers & noise
+    overwrite: bool
+        Set to re-render an existing MEDS file
+
+    returns: str
+        The filename of the MEDS file
+    '''
+
+    if nobjs < 1:
+        raise ValueError('nobjs must be positive!')
+    if nepochs < 1:
+        raise ValueError('nepochs must be positive!')
+
+    utils.make_dir(outdir)
+
+    medsfile = os.path.join(
+        outdir, f'synthetic_n{nobjs}_e{nepochs}_{psf_type}_meds.fits'
+        )
+    if os.path.exists(medsfile) and (overwrite is False):
+        return medsfile
+
+    rng = np.random.default_rng(seed)
+
+    if psf_type == 'gauss':
+        psf = galsim.Gaussian(fwhm=psf_fwhm, flux=1.)
+    elif psf_type == 'moffat':
+        psf = galsim.Moffat(beta=3., fwhm=psf_fwhm, flux=1.)
+    else:
+        raise ValueError('psf_type must be one of gauss or moffat')
+
+    #--------------------------------------------------------------------
+    # Objects on a grid w/ cells large enough for the largest box, so
+    # that cutouts never overlap
+
+    box_size = rng.choice(np.asarray(box_sizes, dtype=int), size=nobjs)
+    spacing = int(np.max(box_sizes)) + 8
+    ngrid = int(np.ceil(np.sqrt(nobjs)))
+    nx = ny = ngrid * spacing + 2 * int(np.ceil(dither)) + spacing
+
+    x = spacing + (np.arange(nobjs) % ngrid) * spacing
+    y = spacing + (np.arange(nobjs) // ngrid) * spacing
+
+    world_origin = galsim.CelestialCoord(
+        150. * galsim.degrees, 2. * galsim.degrees
+        )
+
+    def make_wcs(dx=0., dy=0.):
+        affine = galsim.AffineTransform(
+            -pixel_scale, 0., 0., pixel_scale,
+            origin=galsim.PositionD(nx / 2. + dx, ny / 2. + dy)
+            )
+        return galsim.TanWCS(affine, world_origin, units=galsim.arcsec)
+
+    ref_wcs = make_wcs()
+    coords = [ref_wcs.toWorld(galsim.PositionD(xi, yi)) for xi, yi in zip(x, y)]
+
+    hlr = 0.1 * box_size * pixel_scale
+    flux = np.exp(rng.uniform(np.log(500.), np.log(5000.), size=nobjs))
+    g = rng.uniform(0., 0.3, size=nobjs)
+    beta = rng.uniform(0., np.pi, size=nobjs)
+
+    gals = [
+        galsim.Convolve([
+            galsim.Exponential(half_light_radius=hlr[i], flux=flux[i]).shear(
+                g=g[i], beta=beta[i] * galsim.radians
+                ),
+            psf
+            ])
+        for i in range(nobjs)
+        ]
+
+    #--------------------------------------------------------------------
+    # Render & write each epoch
+
+    image_files, weight_files, seg_files, bmask_files = [], [], [], []
+
+    for epoch in range(nepochs):
+        dx, dy = rng.uniform(-dither, dither, size=2)
+        wcs = make_wcs(dx, dy)
+
+        image = galsim.ImageF(nx, ny, wcs=wcs)
+        seg = galsim.ImageI(nx, ny, wcs=wcs)
+
+        for i, coord in enumerate(coords):
+            pos = wcs.toImage(coord)
+            ix = int(np.floor(pos.x + 0.5))
+            iy = int(np.floor(pos.y + 0.5))
+            offset = galsim.PositionD(pos.x - ix, pos.y - iy)
+
+            stamp = gals[i].drawImage(
+                nx=box_size[i], ny=box_size[i], wcs=wcs.local(image_pos=pos),
+                offset=offset
+                )
+            stamp.setCenter(ix, iy)
+
+            bounds = stamp.bounds & image.bounds
+            image[bounds] += stamp[bounds]
+            seg[bounds].fill(i + 1)
+
+        noise = galsim.GaussianNoise(
+            rng=galsim.BaseDeviate(int(rng.integers(1, 2**31))),
+            sigma=noise_sigma
+            )
+        image.addNoise(noise)
+
+        weight = galsim.ImageF(nx, ny, wcs=wcs, init_value=1. / noise_sigma**2)
+        bmask = galsim.ImageI(nx, ny, wcs=wcs)
+
+        base = os.path.join(outdir, f'synthetic_epoch{epoch:03d}')
+        for im, ext, files in [(image, '', image_files),
+                               (weight, '.weight', weight_files),
+                               (seg, '.seg', seg_files),
+                               (bmask, '.bmask', bmask_files)]:
+            fname = f'{base}{ext}.fits'
+            im.write(fname)
+            files.append(fname)
+
+    #--------------------------------------------------------------------
+    # Build the MEDS file
+
+    max_len_of_filepath = max(len(f) for f in image_files + weight_files +
+                              seg_files + bmask_files) + 10
+    image_info = meds.util.get_image_info_struct(nepochs, max_len_of_filepath)
+    for i in range(nepochs):
+        image_info[i]['image_path'] = image_files[i]
+        image_info[i]['image_ext'] = 0
+        image_info[i]['weight_path'] = weight_files[i]
+        image_info[i]['weight_ext'] = 0
+        image_info[i]['bmask_path'] = bmask_files[i]
+        image_info[i]['bmask_ext'] = 0
+        image_info[i]['seg_path'] = seg_files[i]
+        image_info[i]['seg_ext'] = 0
+
+        # FITS standard of a (1,1) origin, as for the real MEDS files
+        image_info[i]['position_offset'] = 1
+
+    obj_info = meds.util.get_meds_input_struct(
+        nobjs, extra_fields=[('KRON_RADIUS', float), ('number', int),
+                             ('XWIN_IMAGE', float), ('YWIN_IMAGE', float)]
+        )
+    obj_info['id'] = np.arange(nobjs) + 1
+    obj_info['number'] = np.arange(nobjs) + 1
+    obj_info['box_size'] = box_size
+    obj_info['ra'] = [c.ra.deg for c in coords]
+    obj_info['dec'] = [c.dec.deg for c in coords]
+    obj_info['XWIN_IMAGE'] = x
+    obj_info['YWIN_IMAGE'] = y
+    obj_info['KRON_RADIUS'] = hlr / pixel_scale
+
+    psf_models = [
+        psf_extender('true', psf_stamp_size, psf=psf,
+                     psf_pix_scale=pixel_scale)
+        for i in range(nepochs)
+        ]
+
+    meds_config = {
+        'first_image_is_coadd': False,
+        'cutout_types': ['weight', 'seg', 'bmask'],
+        'psf_type': 'true',
+        }
+
+    meta = np.empty(1, [('magzp_ref', float), ('has_coadd', bool)])
+    meta['magzp_ref'] = 30.
+    meta['has_coadd'] = False
+
+    medsObj = meds.maker.MEDSMaker(
+        obj_info, image_info, config=meds_config, psf_data=psf_models,
+        meta_data=meta
+        )
+    medsObj.write(medsfile)
+
+    return medsfile
+
+def setup_fit_combo(mcal_runner, combo, shear_step, ntry=3, weight_fwhm=1.2):
+    '''
+    Setup the bootstrapper of a MetacalRunner for one of FIT_COMBOS
+
+    mcal_runner: MetacalRunner
+        A runner whose seed is already set
+    combo: str
+        The name of the fitter combination
+    shear_step: float
+        The metacal shear step
+    ntry: int
+        The max number of fit tries per object
+    weight_fwhm: float
+        The weight FWHM (arcsec) of the moments fitters
+    '''
+
+    if combo not in FIT_COMBOS:
+        raise ValueError(f'{combo} is not one of the fitter combinations: ' +\
+                         f'{list(FIT_COMBOS.keys())}')
+
+    gal_model, psf_model = FIT_COMBOS[combo]
+
+    mcal_runner.setup_lm_pars()
+    lm_pars = mcal_runner.lm_pars
+    rng = mcal_runner.rng
+
+    if gal_model == 'gaussmom':
+        fitter = ngmix.gaussmom.GaussMom(fwhm=weight_fwhm)
+    else:
+        fitter = ngmix.fitting.Fitter(model=gal_model, fit_pars=lm_pars)
+
+    psf_guesser = None
+    if psf_model == 'gaussmom':
+        psf_fitter = ngmix.gaussmom.GaussMom(fwhm=weight_fwhm)
+    elif psf_model == 'gauss':
+        psf_fitter = ngmix.fitting.Fitter(model='gauss', fit_pars=lm_pars)
+        psf_guesser = ngmix.guessers.SimplePSFGuesser(rng=rng)
+    elif psf_model.startswith('coellip'):
+        ngauss = int(psf_model[7:])
+        psf_fitter = ngmix.fitting.CoellipFitter(ngauss=ngauss, fit_pars=lm_pars)
+        psf_guesser = ngmix.guessers.CoellipPSFGuesser(rng=rng, ngauss=ngauss)
+    elif psf_model.startswith('em'):
+        ngauss = int(psf_model[2:])
+        psf_fitter = ngmix.em.EMFitter(maxiter=5000, tol=1.0e-6)
+        psf_guesser = ngmix.guessers.GMixPSFGuesser(rng=rng, ngauss=ngauss)
+    else:
+        raise ValueError(f'{psf_model} is not a supported psf model')
+
+    mcal_runner.setup_bootstrapper(
+        fitter, psf_fitter, shear_step, psf_guesser=psf_guesser, ntry=ntry
+        )
+
+    return
+
+class RSSMonitor(object):
+    '''
+    Samples the summed resident set size of this process & all of its
+    children (e.g. pool workers) in a background thread to track the peak
+    '''
+
+    def __init__(self, interval=0.1):
+        '''
+        interval: float
+            The sampling interval (s)
+        '''
+
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = None
+
+        return
+
+    def sample(self):
+        rss = 0
+        for proc in [self._process] + self._process.children(recursive=True):
+            try:
+                rss += proc.memory_info().rss
+            except psutil.Error:
+                # a worker may exit between listing & sampling
+                pass
+
+        self.peak = max(self.peak, rss)
+
+        return rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+        return
+
+    def __enter__(self):
+        self.peak = 0
+        self.sample()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+        return False
+
+def run_benchmark(medsfile, combo, ncores, shear_step=0.01, chunksize=16,
+                  ntry=3, seed=None, logprint=None):
+    '''
+    Time a full MetacalRunner.go() over a MEDS file
+
+    medsfile: str
+        The MEDS file to fit
+    combo: str
+        The fitter combination; see FIT_COMBOS
+    ncores: int
+        The number of processes to fit with
+    shear_step: float
+        The metacal shear step
+    chunksize: int
+        The number of MEDS indices handed to a worker at a time
+    ntry: int
+        The max number of fit tries per object
+    seed: int
+        The master seed of the fits
+    logprint: LogPrint
+        A LogPrint object, which simultaneously handles
+        logging & printing
+
+    returns: dict
+        The throughput, peak RSS, failures & median stage times of the run
+    '''
+
+    mcal_runner = MetacalRunner(medsfile, logprint=logprint)
+    mcal_runner.set_seed(seed)
+    setup_fit_combo(mcal_runner, combo, shear_step, ntry=ntry)
+
+    Nobjs = mcal_runner.Nobjs
+
+    with RSSMonitor() as rss:
+        start = time.perf_counter()
+        mcal_runner.go(0, Nobjs, ncores=ncores, chunksize=chunksize)
+        wall_time = time.perf_counter() - start
+
+    result = {
+        'combo': combo,
+        'gal_model': FIT_COMBOS[combo][0],
+        'psf_model': FIT_COMBOS[combo][1],
+        'ncores': ncores,
+        'nobjs': Nobjs,
+        'wall_time': wall_time,
+        'objs_per_sec': Nobjs / wall_time,
+        'peak_rss_mb': rss.peak / 1024**2,
+        'nfailed': int(mcal_runner.mcal_buffer.Nfailed),
+        }
+
+    # median per-object time of each stage, see mcal_timing
+    timing = mcal_runner.timing
+    if timing is not None and len(timing) > 0:
+        for col in timing.colnames:
+            if col.startswith('time_'):
+                result[f'p50_{col}'] = float(np.median(timing[col]))
+
+    return result
+
+def add_scaling_efficiency(results):
+    '''
+    Add the scaling efficiency of each run to the results in place, i.e.
+    its throughput relative to the run w/ the fewest cores of the same
+    combo, divided by the relative number of cores
+
+    results: list of dicts
+        The run_benchmark() results
+    '''
+
+    for combo in set(r['combo'] for r in results):
+        runs = [r for r in results if r['combo'] == combo]
+        base = min(runs, key=lambda r: r['ncores'])
+        for r in runs:
+            speedup = r['objs_per_sec'] / base['objs_per_sec']
+            r['speedup'] = speedup
+            r['scaling_efficiency'] = speedup / (r['ncores'] / base['ncores'])
+
+    return
+
+def get_git_commit():
+    '''
+    The git commit of the repo, or None if it can't be determined
+    '''
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=utils.get_module_dir(),
+            stderr=subprocess.DEVNULL
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit.decode().strip()
+
+def main(args):
+    outdir = args.outdir
+    outfile = args.outfile
+    medsfile = args.medsfile
+    nobjs = args.nobjs
+    nepochs = args.nepochs
+    box_sizes = args.box_sizes
+    psf_type = args.psf_type
+    combos = args.combos
+    ncores_list = args.ncores
+    chunksize = args.chunksize
+    ntry = args.ntry
+    seed = args.seed
+    overwrite = args.overwrite
+    vb = args.vb
+
+    if outdir is None:
+        outdir = os.getcwd()
+    utils.make_dir(outdir)
+
+    log = utils.setup_logger('mcal_benchmark.log', logdir=outdir)
+    logprint = utils.LogPrint(log, vb)
+
+    outfile = os.path.join(outdir, outfile)
+    if os.path.exists(outfile) and (overwrite is False):
+        raise OSError(f'{outfile} already exists and overwrite is False')
+
+    for combo in combos:
+        if combo not in FIT_COMBOS:
+            raise ValueError(f'{combo} is not one of the fitter ' +\
+                             f'combinations: {list(FIT_COMBOS.keys())}')
+
+    if medsfile is None:
+        logprint(f'Making synthetic MEDS file w/ {nobjs} objects, ' +\
+                 f'{nepochs} epochs & a {psf_type} PSF...')
+        medsfile = make_synthetic_meds(
+            outdir, nobjs=nobjs, nepochs=nepochs, box_sizes=box_sizes,
+            psf_type=psf_type, seed=seed, overwrite=overwrite
+            )
+    logprint(f'MEDS file: {medsfile}')
+
+    # the per-object fit messages are only logged, never printed
+    fit_logprint = utils.LogPrint(log, False)
+
+    results = []
+    for combo in combos:
+        for ncores in ncores_list:
+            logprint(f'Running {combo} on {ncores} core(s)...')
+            result = run_benchmark(
+                medsfile, combo, ncores, chunksize=chunksize, ntry=ntry,
+                seed=seed, logprint=fit_logprint
+                )
+            logprint(f'{combo}, ncores={ncores}: ' +\
+                     f'{result["objs_per_sec"]:.2f} objs/s, ' +\
+                     f'peak RSS {result["peak_rss_mb"]:.0f} MB, ' +\
+                     f'{result["nfailed"]} failed')
+            results.append(result)
+
+    add_scaling_efficiency(results)
+
+    benchmark = {
+        'commit': get_git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': socket.gethostname(),
+        'cpu_count': os.cpu_count(),
+        'python': sys.version.split()[0],
+        'ngmix': ngmix.__version__,
+        'medsfile': os.path.abspath(medsfile),
+        'synthetic': args.medsfile is None,
+        'nobjs': nobjs,
+        'nepochs': nepochs,
+        'box_sizes': box_sizes,
+        'psf_type': psf_type,
+        'chunksize': chunksize,
+        'ntry': ntry,
+        'seed': seed,
+        'results': results,
+        }
+
+    with open(outfile, 'w') as f:
+        json.dump(benchmark, f, indent=2)
+
+    logprint(f'Benchmark results written to {outfile}')
+
+    for r in results:
+        logprint(f'{r["combo"]:>9} ncores={r["ncores"]:<3} ' +\
+                 f'{r["objs_per_sec"]:8.2f} objs/s  ' +\
+                 f'efficiency={r["scaling_efficiency"]:.2f}  ' +\
+                 f'peak RSS={r["peak_rss_mb"]:.0f} MB')
+
+    return 0
+
+if __name__ == '__main__':
+    args = parse_args()
+    rc = main(args)
+
+    if rc == 0:
+        print('\nMetacal benchmark completed without error')
+    else:
+        print(f'\nMetacal benchmark failed with rc={rc}')
@@ -0,0 +1,231 @@
+'''
+Metacal bootstrappers that time each stage of the fit & can warm-start the
+sheared fits from the noshear solution, plus a summary of the fit
+iterations to measure the savings
+'''
+
+import numpy as np
+import ngmix
+from ngmix.bootstrap import bootstrap
+from ngmix.metacal import MetacalBootstrapper, get_all_metacal
+
+from superbit_lensing.metacalibration.mcal_timing import SpanTimer
+
+class WarmStartGuesser(object):
+    '''
+    Returns the warm-start parameters for the first guess of a fit and
+    defers to a fallback guesser for all later tries (or if there are no
+    warm-start parameters)
+    '''
+
+    def __init__(self, fallback):
+        '''
+        fallback: ngmix guesser
+            The guesser used once the warm start failed
+        '''
+
+        self.fallback = fallback
+        self.pars = None
+
+        return
+
+    def set_pars(self, pars):
+        '''
+        pars: np.ndarray
+            The warm-start parameters of the next fit. Used only once;
+            None to use the fallback guesser right away
+        '''
+
+        self.pars = None if pars is None else np.array(pars, copy=True)
+
+        return
+
+    def __call__(self, obs, **kwargs):
+        if self.pars is None:
+            return self.fallback(obs=obs, **kwargs)
+
+        guess = self.pars
+        self.pars = None
+
+        return guess
+
+class _TimedRunner(object):
+    '''
+    Wraps a ngmix runner to time its fits as a span of a SpanTimer
+    '''
+
+    def __init__(self, runner, span_timer, name):
+        self.runner = runner
+        self.span_timer = span_timer
+        self.name = name
+
+        return
+
+    def go(self, obs):
+        with self.span_timer.span(self.name):
+            return self.runner.go(obs=obs)
+
+def _get_res_val(res, name):
+    '''
+    Get a value from a fit result, or None if the fitter doesn't set it
+    (e.g. nfev for moments)
+    '''
+
+    try:
+        return res[name]
+    except (KeyError, TypeError):
+        return None
+
+class TimedMetacalBootstrapper(MetacalBootstrapper):
+    '''
+    A MetacalBootstrapper that times the metacal image generation, the PSF
+    fits & the galaxy fit of each shear type as spans of its span_timer,
+    and records the nfev & ntry of each galaxy fit. Otherwise the same as
+    ngmix.metacal.MetacalBootstrapper
+
+    Set span_timer to a (per-object) SpanTimer before calling go(); a
+    throwaway one is used if it is None
+    '''
+
+    span_timer = None
+
+    def go(self, obs):
+        '''
+        obs: ngmix.Observation, ngmix.ObsList
+            The observation(s) of the object to fit
+
+        returns: (dict, dict)
+            The fit results & metacal observations for each shear type,
+            as in ngmix.metacal.MetacalBootstrapper.go()
+        '''
+
+        span_timer = self.span_timer
+        if span_timer is None:
+            span_timer = SpanTimer()
+
+        with span_timer.span('metacal_images'):
+            obs_dict = get_all_metacal(
+                obs=obs, rng=self.rng, **self.metacal_kws
+                )
+
+        psf_runner = None
+        if self.psf_runner is not None:
+            psf_runner = _TimedRunner(self.psf_runner, span_timer, 'psf_fit')
+
+        # noshear first, as the fits of the sheared images may use it
+        keys = ['noshear'] + [k for k in obs_dict if k != 'noshear']
+
+        res_dict = {}
+        for key in keys:
+            runner = _TimedRunner(
+                self._get_runner(key, res_dict), span_timer, f'gal_fit_{key}'
+                )
+            res = bootstrap(
+                obs=obs_dict[key],
+                runner=runner,
+                psf_runner=psf_runner,
+                ignore_failed_psf=self.ignore_failed_psf,
+                )
+
+            span_timer.add_info(f'nfev_{key}', _get_res_val(res, 'nfev'))
+            span_timer.add_info(f'ntry_{key}', _get_res_val(res, 'ntry'))
+
+            res_dict[key] = res
+
+        return res_dict, obs_dict
+
+    def _get_runner(self, key, res_dict):
+        '''
+        The runner of the galaxy fit of a shear type
+
+        key: str
+            The metacal shear type
+        res_dict: dict
+            The fit results of the shear types fit so far
+        '''
+
+        return self.runner
+
+class WarmStartMetacalBootstrapper(TimedMetacalBootstrapper):
+    '''
+    A MetacalBootstrapper that fits noshear first and starts the fits of
+    all sheared (incl. *_psf) images from its best-fit parameters. As the
+    sheared images only differ by a small shear, this typically converges
+    in far fewer iterations than a fresh random guess; the runner's own
+    guesser is only used if the warm-started fit fails
+    '''
+
+    def __init__(self, runner, **kwargs):
+        '''
+        runner: ngmix.runners.Runner
+            The runner of the galaxy fits
+        kwargs:
+            Passed on to ngmix.metacal.MetacalBootstrapper
+        '''
+
+        super(WarmStartMetacalBootstrapper, self).__init__(runner, **kwargs)
+
+        self.warm_guesser = WarmStartGuesser(runner.guesser)
+        self.warm_runner = ngmix.runners.Runner(
+            fitter=runner.fitter, guesser=self.warm_guesser, ntry=runner.ntry
+            )
+
+        return
+
+    def _get_runner(self, key, res_dict):
+        # e.g. moments fitters take no guess, so there is nothing to warm
+        if (key == 'noshear') or (self.runner.guesser is None):
+            return self.runner
+
+        noshear = res_dict['noshear']
+        if noshear['flags'] == 0:
+            self.warm_guesser.set_pars(noshear['pars'])
+        else:
+            self.warm_guesser.set_pars(None)
+
+        return self.warm_runner
+
+def report_fit_iterations(data, shear_types, logprint, flags=None):
+    '''
+    Report the mean number of function evaluations (nfev) & tries (ntry)
+    per fit for each shear type, e.g. to measure the effect of warm starts
+
+    data: np.ndarray, astropy.Table
+        The mcal results, w/ {nfev,ntry}_{shear_type} cols
+    shear_types: list of str
+        The metacal shear types to report
+    logprint: LogPrint
+        A LogPrint object, which simultaneously handles
+        logging & printing
+    flags: np.ndarray
+        The mcal flags of each row; only rows w/ flags == 0 are used
+    '''
+
+    if data is None:
+        return
+
+    names = data.dtype.names if hasattr(data, 'dtype') else data.colnames
+
+    if flags is None:
+        good = np.ones(len(data), dtype=bool)
+    else:
+        good = np.asarray(flags) == 0
+
+    if np.sum(good) == 0:
+        return
+
+    for col in ['nfev', 'ntry']:
+        means = {}
+        for shear_type in shear_types:
+            name = f'{col}_{shear_type}'
+            if name in names:
+                means[shear_type] = np.mean(np.asarray(data[name])[good])
+
+        if len(means) == 0:
+            continue
+
+        total = np.sum(list(means.values()))
+        per_type = ', '.join(f'{k}={v:.1f}' for k, v in means.items())
+        logprint(f'Mean {col} per object: {per_type} (total={total:.1f})')
+
+    return
@@ -0,0 +1,191 @@
+import numpy as np
+import os
+from glob import glob
+import time
+import socket
+
+import superbit_lensing.utils as utils
+
+class McalCheckpoint(object):
+    '''
+    Periodically appends finished metacal results to shard files in a
+    checkpoint directory, keyed by MEDS index. A killed run can then be
+    restarted with the same checkpoint_dir and will only fit the objects
+    that are missing from the shards. Once the final mcal catalog has been
+    written the shards can be removed w/ clean()
+    '''
+
+    _info_file = 'checkpoint_info.yaml'
+    _shard_prefix = 'mcal_shard'
+
+    def __init__(self, checkpoint_dir, flush_size=500, logprint=None):
+        '''
+        checkpoint_dir: str
+            The directory to write the shards to. Created if needed
+        flush_size: int
+            The number of finished objects to collect before writing a
+            new shard
+        logprint: LogPrint
+            A LogPrint object, which simultaneously handles
+            logging & printing
+        '''
+
+        if flush_size < 1:
+            raise ValueError('flush_size must be a positive int!')
+
+        self.checkpoint_dir = checkpoint_dir
+        self.flush_size = flush_size
+
+        if logprint is None:
+            logprint = utils.LogPrint(None, False)
+        self.logprint = logprint
+
+        utils.make_dir(checkpoint_dir)
+
+        self._pending = []
+        self._Nshards = 0
+
+        return
+
+    @classmethod
+    def read_info(cls, checkpoint_dir):
+        '''
+        Return the run info stored in checkpoint_dir, or None if there
+        is no checkpoint there yet
+
+        checkpoint_dir: str
+            The checkpoint directory of a (possibly killed) run
+        '''
+
+        info_file = os.path.join(checkpoint_dir, cls._info_file)
+
+        if not os.path.exists(info_file):
+            return None
+
+        return utils.read_yaml(info_file)
+
+    def check_info(self, info):
+        '''
+        Make sure that an existing checkpoint was made for the same run
+        setup, or save the info if this is a new checkpoint
+
+        info: dict
+            Run properties that must match between restarts, such as the
+            MEDS file and seed. Values must be yaml-serializable
+        '''
+
+        saved_info = self.read_info(self.checkpoint_dir)
+
+        if saved_info is None:
+            info_file = os.path.join(self.checkpoint_dir, self._info_file)
+            utils.write_yaml(info, info_file)
+            return
+
+        for key, val in info.items():
+            if saved_info.get(key) != val:
+                raise ValueError(f'Checkpoint in {self.checkpoint_dir} has ' +\
+                                 f'{key}={saved_info.get(key)}, but the ' +\
+                                 f'current run has {key}={val}!')
+
+        return
+
+    def get_shard_files(self):
+        return sorted(glob(
+            os.path.join(self.checkpoint_dir, f'{self._shard_prefix}_*.npy')
+            ))
+
+    def resume(self, mcal_buffer):
+        '''
+        Load all existing shards into the passed result buffer
+
+        mcal_buffer: McalResultBuffer
+            The result buffer of the current run
+
+        returns: int
+            The number of objects recovered from the checkpoint
+        '''
+
+        shard_files = self.get_shard_files()
+
+        Nstart = len(mcal_buffer.get_unprocessed())
+        for shard_file in shard_files:
+            mcal_buffer.fill_rows(np.load(shard_file))
+        Nresumed = Nstart - len(mcal_buffer.get_unprocessed())
+
+        self._Nshards = len(shard_files)
+
+        if Nresumed > 0:
+            self.logprint(f'Resumed {Nresumed} objects from ' +\
+                          f'{len(shard_files)} checkpoint shards in ' +\
+                          f'{self.checkpoint_dir}')
+
+        return Nresumed
+
+    def add(self, mcal_buffer, indices):
+        '''
+        Register finished MEDS indices, writing a new shard once at least
+        flush_size objects are pending
+
+        mcal_buffer: McalResultBuffer
+            The result buffer holding the finished results
+        indices: list of ints
+            The finished MEDS indices
+        '''
+
+        self._pending += list(indices)
+
+        if len(self._pending) >= self.flush_size:
+            self.flush(mcal_buffer)
+
+        return
+
+    def flush(self, mcal_buffer):
+        '''
+        Write all pending results to a new shard
+
+        mcal_buffer: McalResultBuffer
+            The result buffer holding the finished results
+        '''
+
+        if len(self._pending) == 0:
+            return
+
+        rows = mcal_buffer.get_rows(self._pending)
+
+        # unique name so that shards from restarted runs (or other MPI
+        # ranks / nodes) never collide
+        tag = f'{int(time.time()*1e6)}_{socket.gethostname()}_' +\
+              f'{os.getpid()}_{self._Nshards:05d}'
+        shard_file = os.path.join(
+            self.checkpoint_dir, f'{self._shard_prefix}_{tag}.npy'
+            )
+
+        # write to a temporary file first so that a killed job can't
+        # leave a truncated shard behind
+        tmp_file = shard_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, rows)
+        os.replace(tmp_file, shard_file)
+
+        self._pending = []
+        self._Nshards += 1
+
+        return
+
+    def clean(self):
+        '''
+        Remove all shards & the checkpoint info. Only do this once the
+        consolidated mcal catalog has been written
+        '''
+
+        for shard_file in self.get_shard_files():
+            os.remove(shard_file)
+
+        info_file = os.path.join(self.checkpoint_dir, self._info_file)
+        if os.path.exists(info_file):
+            os.remove(info_file)
+
+        self._pending = []
+        self._Nshards = 0
+
+        return
@@ -0,0 +1,246 @@
+'''
+A NGMixMEDS reader that serves cutouts from memory maps of the (uncompressed)
+cutout extensions or from bulk reads of contiguous MEDS index ranges, instead
+of a separate small fitsio read per object, cutout & extension
+'''
+
+import numpy as np
+from ngmix.medsreaders import NGMixMEDS
+
+# The MEDS cutout extensions are {type}_cutouts, except for the PSF
+CUTOUT_TYPES = ['image', 'weight', 'seg', 'bmask', 'noise', 'psf']
+
+# FITS BITPIX -> (big-endian) numpy dtype
+_BITPIX_DTYPES = {
+    8: 'u1',
+    16: '>i2',
+    32: '>i4',
+    64: '>i8',
+    -32: '>f4',
+    -64: '>f8',
+    }
+
+class BatchedNGMixMEDS(NGMixMEDS):
+    '''
+    A NGMixMEDS that reads its cutouts in bulk. Uncompressed cutout
+    extensions are memory mapped when the file is opened, so that reading a
+    cutout needs no fitsio call at all. For all other extensions (or if
+    use_mmap is False), prefetch() reads the cutouts of each contiguous run
+    of MEDS indices w/ a single read per extension. Cutouts that are in
+    neither fall back to the usual per-cutout reads
+
+    The returned cutouts are (native byte order) copies, as ngmix & the
+    uberseg weights modify them in place
+    '''
+
+    def __init__(self, filename, use_mmap=True):
+        '''
+        filename: str
+            The MEDS file
+        use_mmap: bool
+            Set to memory map the uncompressed cutout extensions
+        '''
+
+        super(BatchedNGMixMEDS, self).__init__(filename)
+
+        self._mmaps = {}
+        self._blocks = {}
+
+        if use_mmap is True:
+            self._setup_mmaps(filename)
+
+        return
+
+    @staticmethod
+    def _get_extname(cutout_type):
+        if cutout_type == 'psf':
+            return 'psf'
+
+        return f'{cutout_type}_cutouts'
+
+    def _setup_mmaps(self, filename):
+        '''
+        Memory map each uncompressed & unscaled cutout extension
+        '''
+
+        for cutout_type in CUTOUT_TYPES:
+            extname = self._get_extname(cutout_type)
+            if extname not in self._fits:
+                continue
+
+            hdu = self._fits[extname]
+            if hdu.is_compressed():
+                continue
+
+            header = hdu.read_header()
+            dtype = _BITPIX_DTYPES.get(header['BITPIX'])
+            scaled = (header.get('BZERO', 0) != 0) or \
+                     (header.get('BSCALE', 1) != 1)
+            if (dtype is None) or (scaled is True):
+                continue
+
+            npix = int(np.prod(hdu.get_dims()))
+            if npix == 0:
+                continue
+
+            offset = hdu.get_offsets()['data_start']
+            self._mmaps[cutout_type] = np.memmap(
+                filename, dtype=dtype, mode='r', offset=offset, shape=(npix,)
+                )
+
+        return
+
+    def _get_cat_val(self, name, iobj, icutout):
+        col = self._cat[name]
+        if col.ndim == 1:
+            return int(col[iobj])
+
+        return int(col[iobj, icutout])
+
+    def _get_location(self, iobj, icutout, cutout_type):
+        '''
+        The first row & shape of a cutout in its (flattened) extension
+        '''
+
+        names = self._cat.dtype.names
+
+        if cutout_type == 'psf':
+            if 'psf_row_size' in names:
+                shape = (self._get_cat_val('psf_row_size', iobj, icutout),
+                         self._get_cat_val('psf_col_size', iobj, icutout))
+            else:
+                box_size = self._get_cat_val('psf_box_size', iobj, icutout)
+                shape = (box_size, box_size)
+            start_row = self._get_cat_val('psf_start_row', iobj, icutout)
+        else:
+            box_size = int(self._cat['box_size'][iobj])
+            shape = (box_size, box_size)
+            start_row = self._get_cat_val('start_row', iobj, icutout)
+
+        return start_row, shape
+
+    def _read_batched(self, iobj, icutout, cutout_type):
+        '''
+        Read a cutout from the memory maps or prefetched blocks
+
+        returns: np.ndarray
+            The cutout, or None if it isn't available
+        '''
+
+        if (cutout_type not in self._mmaps) and \
+           (cutout_type not in self._blocks):
+            return None
+
+        # out-of-range indices are left to the usual checks
+        if (iobj < 0) or (iobj >= len(self._cat)):
+            return None
+        if (icutout < 0) or (icutout >= self._cat['ncutout'][iobj]):
+            return None
+
+        start_row, shape = self._get_location(iobj, icutout, cutout_type)
+        end_row = start_row + shape[0] * shape[1]
+
+        flat = None
+        if cutout_type in self._mmaps:
+            flat = self._mmaps[cutout_type][start_row:end_row]
+        else:
+            for block_start, block in self._blocks[cutout_type]:
+                if (start_row >= block_start) and \
+                   (end_row <= block_start + len(block)):
+                    flat = block[start_row-block_start:end_row-block_start]
+                    break
+
+        if flat is None:
+            return None
+
+        native = flat.dtype.newbyteorder('=')
+
+        return flat.astype(native, copy=True).reshape(shape)
+
+    def get_cutout(self, iobj, icutout, type='image'):
+        cutout = self._read_batched(iobj, icutout, type)
+
+        if cutout is None:
+            cutout = super(BatchedNGMixMEDS, self).get_cutout(
+                iobj, icutout, type=type
+                )
+
+        return cutout
+
+    def get_psf(self, iobj, icutout):
+        psf = self._read_batched(iobj, icutout, 'psf')
+
+        if psf is None:
+            psf = super(BatchedNGMixMEDS, self).get_psf(iobj, icutout)
+
+        return psf
+
+    def prefetch(self, indices, cutout_types=None):
+        '''
+        Bulk read the cutouts of the passed MEDS indices for all extensions
+        that aren't memory mapped, w/ one read per extension for each
+        contiguous run of indices. Replaces any previous prefetch
+
+        indices: list, np.ndarray
+            The MEDS indices about to be read
+        cutout_types: list of str
+            The cutout types to prefetch. Defaults to all of CUTOUT_TYPES
+            present in the file
+        '''
+
+        self._blocks = {}
+
+        if cutout_types is None:
+            cutout_types = CUTOUT_TYPES
+
+        cutout_types = [
+            t for t in cutout_types
+            if (t not in self._mmaps) and (self._get_extname(t) in self._fits)
+            ]
+
+        indices = np.unique(np.asarray(indices, dtype=int))
+        if (len(indices) == 0) or (len(cutout_types) == 0):
+            return
+
+        runs = np.split(indices, np.where(np.diff(indices) != 1)[0] + 1)
+
+        for cutout_type in cutout_types:
+            hdu = self._fits[self._get_extname(cutout_type)]
+
+            blocks = []
+            for run in runs:
+                row_range = self._get_row_range(run, cutout_type)
+                if row_range is None:
+                    continue
+                start_row, end_row = row_range
+                blocks.append((start_row, hdu[start_row:end_row]))
+
+            self._blocks[cutout_type] = blocks
+
+        return
+
+    def _get_row_range(self, indices, cutout_type):
+        '''
+        The range of extension rows spanned by all cutouts of the passed
+        MEDS indices, or None if they have no cutouts
+        '''
+
+        start_rows = []
+        end_rows = []
+        for iobj in indices:
+            for icutout in range(self._cat['ncutout'][iobj]):
+                start_row, shape = self._get_location(
+                    iobj, icutout, cutout_type
+                    )
+                start_rows.append(start_row)
+                end_rows.append(start_row + shape[0] * shape[1])
+
+        if len(start_rows) == 0:
+            return None
+
+        return min(start_rows), max(end_rows)
+
+    def clear_prefetch(self):
+        self._blocks = {}
+
+        return
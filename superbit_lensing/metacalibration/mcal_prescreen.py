@@ -0,0 +1,144 @@
+'''
+A cheap pre-screen of MEDS objects that skips obvious stars, very low-S/N
+and unresolved sources before the (expensive) metacal bootstrapper runs.
+The thresholds are deliberately loose compared to the shear catalog cuts
+in make_annular_catalog (e.g. s2n > 7, T > 0.6*Tpsf), as objects near the
+cuts must still be fit for the selection response R_S to be correct
+'''
+
+import numpy as np
+import ngmix
+
+from superbit_lensing.metacalibration.mcal_results import MCAL_FLAGS
+
+class McalPrescreen(object):
+    '''
+    Decides whether a MEDS object is worth a full metacal fit, using the
+    SExtractor columns of the MEDS object catalog (if present) and a fast
+    weighted-moments measurement of the cutouts & their PSFs
+    '''
+
+    _flags = MCAL_FLAGS
+
+    # SExtractor cols copied into the MEDS object catalog by the medsmaker
+    _star_col = 'CLASS_STAR'
+    _s2n_col = 'SNR_WIN'
+
+    def __init__(self, cat, max_class_star=0.98, min_cat_s2n=3.,
+                 min_s2n=3.5, min_T_ratio=0.2, weight_fwhm=1.2):
+        '''
+        cat: np.ndarray, astropy.Table
+            The MEDS object catalog
+        max_class_star: float
+            Unresolved objects (see min_T_ratio) w/ a larger SExtractor
+            CLASS_STAR are flagged as stars rather than as unresolved.
+            CLASS_STAR only chooses between those two flags; it never
+            skips a resolved object. Ignored if the catalog has no
+            CLASS_STAR col
+        min_cat_s2n: float
+            Objects w/ a smaller SExtractor SNR_WIN are skipped. Ignored
+            if the catalog has no SNR_WIN col
+        min_s2n: float
+            Objects whose combined weighted-moment s2n over all cutouts
+            is smaller are skipped
+        min_T_ratio: float
+            Objects w/ a smaller median deconvolved size
+            (T - Tpsf) / Tpsf of the weighted moments are skipped as
+            unresolved. Both sizes are measured on PSF-convolved images,
+            so a star is ~0. The estimate is noisy (& uses the undilated
+            PSF), so the default is well below the T > min_Tpsf*Tpsf cut
+            of make_annular_catalog (min_Tpsf of 0.5-0.6), keeping objects
+            near that cut in the fit for R_S
+        weight_fwhm: float
+            The FWHM (arcsec) of the Gaussian moment weight function
+        '''
+
+        names = cat.dtype.names if hasattr(cat, 'dtype') else cat.colnames
+
+        if self._star_col in names:
+            self.class_star = np.array(cat[self._star_col], dtype=float)
+        else:
+            self.class_star = None
+
+        if self._s2n_col in names:
+            self.cat_s2n = np.array(cat[self._s2n_col], dtype=float)
+        else:
+            self.cat_s2n = None
+
+        self.max_class_star = max_class_star
+        self.min_cat_s2n = min_cat_s2n
+        self.min_s2n = min_s2n
+        self.min_T_ratio = min_T_ratio
+        self.weight_fwhm = weight_fwhm
+
+        self.fitter = ngmix.gaussmom.GaussMom(fwhm=weight_fwhm)
+
+        return
+
+    def measure(self, obslist):
+        '''
+        Run the weighted-moments measurement on each cutout & its PSF
+
+        obslist: ngmix.ObsList
+            The observations of the object
+
+        returns: (float, float)
+            The combined s2n over all cutouts & the median deconvolved
+            (T - Tpsf) / Tpsf; NaN if no cutout could be measured
+        '''
+
+        s2n2 = []
+        T_ratio = []
+
+        for obs in obslist:
+            res = self.fitter.go(obs)
+            if res['flags'] != 0:
+                continue
+            s2n2.append(res['s2n']**2)
+
+            if not obs.has_psf():
+                continue
+            psf_res = self.fitter.go(obs.psf)
+            if (psf_res['flags'] != 0) or (psf_res['T'] <= 0):
+                continue
+            # the weighted moments of the PSF-convolved object are
+            # ~T + Tpsf, so subtract the PSF's to get the intrinsic size
+            T_ratio.append((res['T'] - psf_res['T']) / psf_res['T'])
+
+        s2n = np.sqrt(np.sum(s2n2)) if len(s2n2) > 0 else np.nan
+        T_ratio = np.median(T_ratio) if len(T_ratio) > 0 else np.nan
+
+        return s2n, T_ratio
+
+    def check(self, iobj, obslist):
+        '''
+        Pre-screen a single object
+
+        iobj: int
+            The MEDS index of the object
+        obslist: ngmix.ObsList
+            The observations of the object
+
+        returns: int
+            0 if the object should be fit, otherwise its skip flag
+        '''
+
+        # the catalog s2n check doesn't need the cutouts
+        if self.cat_s2n is not None:
+            if self.cat_s2n[iobj] < self.min_cat_s2n:
+                return self._flags['skip_low_s2n']
+
+        s2n, T_ratio = self.measure(obslist)
+
+        # NOTE: objects the moments fail on are left to the full fit
+        if s2n < self.min_s2n:
+            return self._flags['skip_low_s2n']
+
+        if T_ratio < self.min_T_ratio:
+            is_star = (self.class_star is not None) and \
+                      (self.class_star[iobj] > self.max_class_star)
+            if is_star:
+                return self._flags['skip_star']
+            return self._flags['skip_unresolved']
+
+        return 0
@@ -0,0 +1,515 @@
+import numpy as np
+import os
+from astropy.table import Table
+
+# Bit flags stored in the mcal_flags column of the result buffer
+MCAL_FLAGS = {
+    'unprocessed': 2**0, # object was never fit
+    'failed': 2**1, # an exception was raised during the fit
+    'obj_flagged': 2**2, # rejected by check_obj_flags()
+    'timeout': 2**3, # fit exceeded the per-object time limit
+    'skip_star': 2**4, # skipped by the pre-screen as a star
+    'skip_low_s2n': 2**5, # skipped by the pre-screen as too faint
+    'skip_unresolved': 2**6, # skipped by the pre-screen as unresolved
+}
+
+# Any of the pre-screen skip flags
+MCAL_SKIP_FLAGS = MCAL_FLAGS['skip_star'] | MCAL_FLAGS['skip_low_s2n'] | \
+                  MCAL_FLAGS['skip_unresolved']
+
+# Width of the fixed-size string columns (e.g. ngmix errmsg)
+_STR_WIDTH = 32
+
+def mcal_dict2row(mcal_dict, obj_info, shear_types, extra_types=None):
+    '''
+    Flatten the nested metacal result dict of a single object into one
+    row dict of scalars & fixed-shape arrays. Column names match those of
+    the old hstack'ed tables, i.e. {col}_{shear_type} for the per-shear
+    results and unchanged names for obj_info & extra_types cols
+
+    mcal_dict: dict
+        The main result dictionary returned by the ngmix metacal
+        bootstrapper.go() func
+    obj_info: dict
+        A dictionary with MEDS identification info like id, ra, dec not
+        returned by the bootstrapper
+    shear_types: list of str
+        The metacal result types to add w/ a suffix (e.g. noshear, 1p, ...)
+    extra_types: list of str
+        Additional entries of mcal_dict whose cols are added w/o a suffix
+    '''
+
+    row = dict(obj_info)
+
+    for name in shear_types:
+        for key, val in mcal_dict[name].items():
+            row[f'{key}_{name}'] = val
+
+    if extra_types is not None:
+        for name in extra_types:
+            row.update(mcal_dict[name])
+
+    return row
+
+def _field_dtype(val):
+    '''
+    Get the structured array field (dtype, shape) for a row value, or
+    None if the value can't be stored in a fixed-size column
+    '''
+
+    if val is None:
+        return None
+
+    if isinstance(val, (str, bytes)):
+        return (f'U{_STR_WIDTH}', ())
+
+    arr = np.asarray(val)
+    if arr.dtype.kind not in 'biuf':
+        return None
+
+    return (arr.dtype.str, arr.shape)
+
+def _fill_value(dtype):
+    if dtype.kind == 'f':
+        return np.nan
+    elif dtype.kind == 'U':
+        return ''
+    else:
+        return 0
+
+def realization_filename(outfile, realization):
+    '''
+    The filename of the per-realization catalog for a multi-realization
+    run, e.g. name_mcal.fits -> name_mcal_r3.fits
+
+    outfile: str
+        The filename of the (combined) output mcal table
+    realization: int
+        The realization index
+    '''
+
+    base, ext = os.path.splitext(outfile)
+
+    return f'{base}_r{realization}{ext}'
+
+class McalResultBuffer(object):
+    '''
+    A preallocated structured array that holds the metacal results with
+    one row per MEDS index in [start, end) & noise realization. The schema
+    is set by the first successful fit & extended by any later row w/ new
+    fields, and failed or skipped objects are recorded in the mcal_flags
+    column rather than dropped
+    '''
+
+    _flags = MCAL_FLAGS
+
+    def __init__(self, start, end, nrealizations=1):
+        '''
+        start: int
+            The first MEDS index of the run
+        end: int
+            One past the last MEDS index of the run
+        nrealizations: int
+            The number of metacal noise realizations stored per object
+        '''
+
+        if end < start:
+            raise ValueError('end must be greater than start!')
+        if nrealizations < 1:
+            raise ValueError('nrealizations must be a positive int!')
+
+        self.start = start
+        self.end = end
+        self.Nobjs = end - start
+        self.Nrealizations = nrealizations
+        self.Nrows = self.Nobjs * nrealizations
+
+        # rows are ordered by MEDS index, then realization
+        self.meds_indx = np.repeat(np.arange(start, end), nrealizations)
+        self.realization = np.tile(np.arange(nrealizations), self.Nobjs)
+        self.flags = np.full(
+            self.Nrows, self._flags['unprocessed'], dtype=np.int32
+            )
+
+        # allocated once the row schema is known
+        self.data = None
+
+        # the row keys that have a column
+        self._known_keys = set()
+
+        return
+
+    def _setup_data(self, row, promote=()):
+        '''
+        Allocate (or extend) the structured array to include the storable
+        fields of the passed row. Fields w/o a storable value (e.g. None)
+        are left out until a row has one
+
+        row: dict
+            The row w/ the new fields
+        promote: list of str
+            Int columns to promote to float, e.g. as a later row has a
+            float value for them
+        '''
+
+        fields = []
+        names = []
+        if self.data is not None:
+            for name in self.data.dtype.names:
+                dt = self.data.dtype[name]
+                base = np.dtype(np.float64) if name in promote else dt.base
+                fields.append((name, base, dt.shape))
+                names.append(name)
+
+        for key, val in row.items():
+            if key in names:
+                continue
+            dt = _field_dtype(val)
+            if dt is None:
+                continue
+            fields.append((key, np.dtype(dt[0]), dt[1]))
+            names.append(key)
+
+        dtype = np.dtype(fields)
+        data = np.zeros(self.Nrows, dtype=dtype)
+        for name in dtype.names:
+            data[name] = _fill_value(dtype[name].base)
+
+        if self.data is not None:
+            for name in self.data.dtype.names:
+                data[name] = self.data[name]
+        elif 'meds_indx' in dtype.names:
+            data['meds_indx'] = self.meds_indx
+
+        self.data = data
+        self._known_keys = set(dtype.names)
+
+        return
+
+    def _update_schema(self, row):
+        '''
+        Add columns for the new storable fields of a row & promote int
+        columns that get float values to float. Raises a ValueError if a
+        value's shape doesn't match its column's
+        '''
+
+        # only happens for the first rows, or if a row has new fields
+        if not self._known_keys.issuperset(row):
+            new = {key: val for key, val in row.items()
+                   if (key not in self._known_keys) and
+                      (_field_dtype(val) is not None)}
+            if len(new) > 0:
+                self._setup_data(new)
+
+        if self.data is None:
+            return
+
+        promote = []
+        for key, val in row.items():
+            if (key not in self._known_keys) or (val is None):
+                continue
+
+            dt = self.data.dtype[key]
+
+            if np.shape(val) != dt.shape:
+                raise ValueError(f'{key} has shape {np.shape(val)}, but ' +\
+                                 f'its column has shape {dt.shape}!')
+
+            if (dt.base.kind in 'biu') and (np.asarray(val).dtype.kind == 'f'):
+                promote.append(key)
+
+        if len(promote) > 0:
+            self._setup_data({}, promote=promote)
+
+        return
+
+    def _index(self, iobj, realization=0):
+        i = iobj - self.start
+        if (i < 0) or (i >= self.Nobjs):
+            raise IndexError(f'MEDS index {iobj} is outside of the buffer ' +\
+                             f'range [{self.start}, {self.end})')
+        if (realization < 0) or (realization >= self.Nrealizations):
+            raise IndexError(f'realization {realization} is outside of ' +\
+                             f'the buffer range [0, {self.Nrealizations})')
+
+        return i*self.Nrealizations + realization
+
+    def _row_index(self, indices, realizations=None):
+        '''
+        Vectorized _index() w/o bounds checking. If realizations is None,
+        returns the rows of all realizations of the passed MEDS indices
+        '''
+
+        i = np.asarray(indices, dtype=int) - self.start
+
+        if realizations is None:
+            nreal = self.Nrealizations
+            return (i[:, None]*nreal + np.arange(nreal)[None, :]).ravel()
+
+        return i*self.Nrealizations + np.asarray(realizations, dtype=int)
+
+    def fill(self, iobj, flags, row=None, realization=0):
+        '''
+        Store the result of a single object
+
+        iobj: int
+            The MEDS index of the object
+        flags: int
+            The mcal flags for the object; 0 if the fit succeeded
+        row: dict
+            The flattened result row (see mcal_dict2row()), if any
+        realization: int
+            The noise realization of the result
+        '''
+
+        i = self._index(iobj, realization)
+
+        self.flags[i] = flags
+
+        if row is None:
+            return
+
+        self._update_schema(row)
+
+        for key, val in row.items():
+            # values w/o a column (yet), & Nones, keep the fill value
+            if (key in self._known_keys) and (val is not None):
+                self.data[key][i] = val
+
+        return
+
+    def get_rows(self, indices):
+        '''
+        Get the stored rows (incl. mcal_flags & realization) of all
+        realizations of the passed MEDS indices as a structured array
+
+        indices: array of ints
+            The MEDS indices to grab
+        '''
+
+        idx = self._row_index(indices)
+
+        if self.data is None:
+            rows = np.zeros(len(idx), dtype=[('meds_indx', int)])
+            rows['meds_indx'] = self.meds_indx[idx]
+        else:
+            rows = self.data[idx]
+
+        dtype = rows.dtype.descr + [
+            ('realization', self.realization.dtype.str),
+            ('mcal_flags', self.flags.dtype.str)
+            ]
+        out = np.zeros(len(idx), dtype=dtype)
+        for name in rows.dtype.names:
+            out[name] = rows[name]
+        out['realization'] = self.realization[idx]
+        out['mcal_flags'] = self.flags[idx]
+
+        return out
+
+    def fill_rows(self, rows):
+        '''
+        Store a structured array of rows as returned by get_rows(), e.g.
+        when loading checkpointed results. Rows outside of the buffer's
+        MEDS index or realization range are ignored
+
+        rows: np.ndarray
+            A structured array w/ at least meds_indx & mcal_flags fields
+        '''
+
+        if 'realization' in rows.dtype.names:
+            real = rows['realization']
+        else:
+            real = np.zeros(len(rows), dtype=int)
+
+        i = rows['meds_indx'] - self.start
+        keep = (i >= 0) & (i < self.Nobjs) & \
+               (real >= 0) & (real < self.Nrealizations)
+        rows = rows[keep]
+        idx = self._row_index(rows['meds_indx'], real[keep])
+
+        if len(rows) == 0:
+            return
+
+        self.flags[idx] = rows['mcal_flags']
+
+        names = [n for n in rows.dtype.names
+                 if n not in ['mcal_flags', 'realization']]
+        self._update_schema({n: rows[n][0] for n in names})
+
+        for name in names:
+            if name in self._known_keys:
+                self.data[name][idx] = rows[name]
+
+        return
+
+    def add_columns(self, cols):
+        '''
+        Add (or overwrite) full-length columns computed for the whole
+        buffer at once, e.g. the catalog-wide mcal responsivities
+
+        cols: dict
+            Column name -> array w/ one entry per buffer row
+        '''
+
+        if self.data is None:
+            raise ValueError('Buffer has no data yet; fill it first!')
+
+        for key, val in cols.items():
+            if len(val) != self.Nrows:
+                raise ValueError(f'Column {key} has length {len(val)} ' +\
+                                 f'but the buffer has {self.Nrows} rows!')
+
+        new = {key: val[0] for key, val in cols.items()
+               if key not in self.data.dtype.names}
+        if len(new) > 0:
+            self._setup_data(new)
+
+        for key, val in cols.items():
+            self.data[key] = val
+
+        return
+
+    def get_unprocessed(self):
+        '''
+        Return the MEDS indices that have not been processed yet for
+        at least one realization
+        '''
+
+        unprocessed = (self.flags & self._flags['unprocessed']) != 0
+
+        return np.unique(self.meds_indx[unprocessed])
+
+    def _obj_flags(self):
+        '''
+        The mcal flags of each object, OR'ed over realizations
+        '''
+
+        flags = self.flags.reshape(self.Nobjs, self.Nrealizations)
+
+        return np.bitwise_or.reduce(flags, axis=1)
+
+    @property
+    def Nfailed(self):
+        return int(np.sum(self._obj_flags() != 0))
+
+    def to_table(self, keep_failed=False, realization=0):
+        '''
+        Build the output mcal table of a single realization
+
+        keep_failed: bool
+            Set to keep rows for objects w/ nonzero mcal_flags
+        realization: int
+            The noise realization to grab
+        '''
+
+        rows = self.realization == realization
+        if keep_failed is False:
+            rows &= self.flags == 0
+
+        if self.data is None:
+            table = Table()
+            table['meds_indx'] = self.meds_indx[rows]
+        else:
+            table = Table(self.data[rows])
+
+        table['mcal_flags'] = self.flags[rows]
+
+        return table
+
+    def to_combined_table(self):
+        '''
+        Build an output mcal table whose float columns are the median over
+        all noise realizations, for objects that succeeded in every one of
+        them. Non-float cols (ids, fit flags, etc.) are taken from the
+        first realization
+        '''
+
+        obj_flags = self._obj_flags()
+        good = obj_flags == 0
+
+        if self.data is None:
+            table = Table()
+            table['meds_indx'] = self.meds_indx[::self.Nrealizations][good]
+        else:
+            data = self.data.reshape(self.Nobjs, self.Nrealizations)[good]
+            table = Table(data[:, 0])
+            for name in data.dtype.names:
+                if data.dtype[name].base.kind == 'f':
+                    table[name] = np.median(data[name], axis=1)
+
+        table['mcal_flags'] = obj_flags[good]
+
+        return table
+
+    def write(self, outfile, overwrite=False, keep_failed=False,
+              combine='median'):
+        '''
+        Write the buffer to a FITS mcal catalog
+
+        outfile: str
+            The filename of the output mcal table
+        overwrite: bool
+            Set to overwrite an existing outfile
+        keep_failed: bool
+            Set to keep rows for objects w/ nonzero mcal_flags
+        combine: str
+            How to write multi-realization results. 'median' writes the
+            median over realizations to outfile (see to_combined_table()),
+            while None (or 'none') writes one catalog per realization
+            (see realization_filename())
+        '''
+
+        if self.Nrealizations == 1:
+            table = self.to_table(keep_failed=keep_failed)
+            table.write(outfile, format='fits', overwrite=overwrite)
+
+        elif combine == 'median':
+            table = self.to_combined_table()
+            table.write(outfile, format='fits', overwrite=overwrite)
+
+        elif (combine is None) or (combine == 'none'):
+            for k in range(self.Nrealizations):
+                table = self.to_table(keep_failed=keep_failed, realization=k)
+                table.write(realization_filename(outfile, k),
+                            format='fits', overwrite=overwrite)
+
+        else:
+            raise ValueError(f'combine={combine} is not a valid option! ' +\
+                             'Must be one of [median, none]')
+
+        return
+
+def gather_buffers(mcal_buffer, mpi_helper, start, end):
+    '''
+    Gather the result buffers of all MPI ranks into a single buffer on
+    the root rank. Only the compact structured array rows (see
+    McalResultBuffer.get_rows()) are communicated
+
+    mcal_buffer: McalResultBuffer
+        The result buffer of the local rank's MEDS index range
+    mpi_helper: MPIHelper
+        The MPI helper of the run
+    start: int
+        The first MEDS index of the full run
+    end: int
+        One past the last MEDS index of the full run
+
+    returns: McalResultBuffer
+        The combined buffer on the root rank; None on all other ranks
+    '''
+
+    rows = mcal_buffer.get_rows(np.arange(mcal_buffer.start, mcal_buffer.end))
+
+    all_rows = mpi_helper.gather_array(rows)
+
+    if not mpi_helper.is_mpi_root():
+        return None
+
+    full_buffer = McalResultBuffer(
+        start, end, nrealizations=mcal_buffer.Nrealizations
+        )
+    for rank_rows in all_rows:
+        full_buffer.fill_rows(rank_rows)
+
+    return full_buffer
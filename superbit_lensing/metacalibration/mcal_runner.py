@@ -1,17 +1,34 @@
 import ngmix
-from ngmix.medsreaders import NGMixMEDS
 from ngmix.fitting import Fitter
 import numpy as np
 import os
-from copy import deepcopy
 from collections.abc import Mapping
 from multiprocessing import Pool
 import time
-from astropy.table import Table, vstack, hstack
 import matplotlib.pyplot as plt
 from argparse import ArgumentParser
 
 import superbit_lensing.utils as utils
+from superbit_lensing.metacalibration.mcal_results import (
+    McalResultBuffer, mcal_dict2row, gather_buffers, MCAL_FLAGS,
+    MCAL_SKIP_FLAGS
+    )
+from superbit_lensing.metacalibration.mcal_prescreen import McalPrescreen
+from superbit_lensing.metacalibration.mcal_staging import MedsStager
+from superbit_lensing.metacalibration.mcal_bootstrap import (
+    TimedMetacalBootstrapper, WarmStartMetacalBootstrapper,
+    report_fit_iterations
+    )
+from superbit_lensing.metacalibration.mcal_timing import (
+    SpanTimer, TimedNGMixMEDS, build_timing_table, gather_timing_tables,
+    spread_block_span
+    )
+from superbit_lensing.metacalibration.responsivity import (
+    get_mcal_responsivities
+    )
+from superbit_lensing.metacalibration.mcal_schedule import (
+    FitTimeoutError, FitTimer, fit_time_limit, order_blocks_by_cost
+    )
 
 import ipdb
 
@@ -24,6 +41,11 @@ def parse_args():
                         help='Ending MEDS index for mcal fitting')
     parser.add_argument('-ncores', type=int, default=1,
                         help='Number of cores to use for mcal fitting')
+    parser.add_argument('-medsfile', type=str, default=None,
+                        help='MEDS file to test on. Defaults to a synthetic ' +\
+                        'MEDS file w/ end objects (see mcal_benchmark.py)')
+    parser.add_argument('-outdir', type=str, default=None,
+                        help='Directory for the synthetic MEDS file')
     parser.add_argument('--vb', action='store_true', default=False,
                         help='Make verbose')
 
@@ -50,6 +72,9 @@ class CaseInsensitiveDict(Mapping):
     def actual_key_case(self, k):
         return self._s.get(k.lower())
 
+# The metacal result types stored in the output catalog
+MCAL_SHEAR_TYPES = ['noshear', '1p', '1m', '2p', '2m']
+
 # NOTE: This is where you must register ngmix fitters
 # NOTE: Capitalization here matches ngmix conventions,
 # but isn't case-sensitive when actually building
@@ -116,6 +141,51 @@ def build_fitter(fit_type, fitter_name, kwargs):
 
     return fitter
 
+# Per-process MetacalRunner used for worker-side MEDS reading; set in each
+# pool worker by _init_worker()
+_worker_runner = None
+
+def _init_worker(runner):
+    '''
+    Pool initializer. Each worker opens its own NGMixMEDS handle once so
+    that only MEDS indices (and not cutouts) need to be sent to it
+
+    runner: MetacalRunner
+        The (already setup) runner to fit objects with
+    '''
+
+    global _worker_runner
+
+    # NOTE: a forked worker would otherwise share the parent's fitsio
+    # file handle (and file offset), so always reopen
+    runner.open_meds()
+    _worker_runner = runner
+
+    return
+
+def _fit_chunk(indices):
+    '''
+    Fit a chunk of MEDS indices using the worker's own MEDS handle
+
+    indices: iterable of ints
+        The MEDS indices to fit
+
+    returns: list of (int, list, float, dict)
+        The MEDS index, the (mcal flags, result row) of each realization,
+        the fit time & the timing spans for each object
+    '''
+
+    runner = _worker_runner
+
+    return runner._fit_chunk(indices)
+
+def _is_skipped(results):
+    '''
+    Check if the pre-screen skipped an object, given its _fit_one() results
+    '''
+
+    return (results[0][0] & MCAL_SKIP_FLAGS) != 0
+
 class MetacalRunner(object):
     '''
     A helper class to organize interaction w/ various ngmix
@@ -133,7 +203,7 @@ class MetacalRunner(object):
     # to another detected source than the fitted obj
     _default_weight_type = 'uberseg'
 
-    def __init__(self, medsfile, vb=False, logprint=None):
+    def __init__(self, medsfile, vb=False, logprint=None, stage_dir=None):
         '''
         medsfile: str
             The medsfile that we will use for metacalibration
@@ -142,6 +212,10 @@ class MetacalRunner(object):
         logprint: LogPrint
             A LogPrint object, which simultaneously handles
             logging & printing. Takes precedence over vb
+        stage_dir: str
+            If passed, the MEDS file is staged into this node-local dir
+            (e.g. /dev/shm/superbit_meds) & read from there by all
+            processes on the node. See MedsStager & close()
         '''
 
         self.medsfile = medsfile
@@ -154,7 +228,15 @@ class MetacalRunner(object):
         self.logprint = logprint
         self.vb = vb
 
-        self.meds = NGMixMEDS(medsfile)
+        if stage_dir is not None:
+            self.stager = MedsStager(
+                medsfile, stage_dir=stage_dir, logprint=logprint
+                )
+            self.stager.acquire()
+        else:
+            self.stager = None
+
+        self.open_meds()
         self.has_coadd = bool(self.meds._meta['has_coadd'])
         self.cat = self.meds.get_cat()
         self.Nobjs = len(self.cat)
@@ -172,7 +254,45 @@ class MetacalRunner(object):
         self.psf_guesser = None
         self.lm_pars = None
 
-        self.mcal_table = None
+        self.nrealizations = 1
+        self.timeout = None
+        self.prescreen = None
+        self.mcal_buffer = None
+        self.timing = None
+
+        return
+
+    def __getstate__(self):
+        # open fitsio handles can't be pickled; workers reopen the MEDS
+        # file themselves in _init_worker()
+        state = self.__dict__.copy()
+        state['meds'] = None
+
+        return state
+
+    def open_meds(self):
+        '''
+        (Re)open the MEDS file. Needed for each process that reads
+        cutouts, as fitsio handles can't be shared between processes
+        '''
+
+        if self.stager is not None:
+            fname = self.stager.path
+        else:
+            fname = self.medsfile
+
+        self.meds = TimedNGMixMEDS(fname)
+
+        return
+
+    def close(self):
+        '''
+        Release the staged MEDS file, if any. The results are kept
+        '''
+
+        if self.stager is not None:
+            self.meds = None
+            self.stager.release()
 
         return
 
@@ -271,7 +391,7 @@ class MetacalRunner(object):
     def setup_bootstrapper(self, gal_fitter, psf_fitter, shear_step,
                            gal_kwargs={}, psf_kwargs={}, lm_pars=None,
                            guesser=None, psf_guesser=None, prior=None,
-                           ntry=1):
+                           ntry=1, warm_start=False):
         '''
         Initialize ngmix bootstrapper for metacal measurement
 
@@ -293,6 +413,9 @@ class MetacalRunner(object):
             A dictionary of Levenberg–Marquardt algorithm parameters
         ntry: int
             The number of times to try the fit before failure
+        warm_start: bool
+            Set to start the sheared fits from the noshear solution, only
+            falling back to the guesser if that fails
         '''
 
         self.shear_step = shear_step
@@ -322,18 +445,31 @@ class MetacalRunner(object):
                 psf_kwargs=psf_kwargs
                 )
 
+        # moments are measured directly and don't take a guess
+        psf_guesser = self.psf_guesser
+        if isinstance(self.psf_fitter, ngmix.gaussmom.GaussMom):
+            psf_guesser = None
+        guesser = self.guesser
+        if isinstance(self.fitter, ngmix.gaussmom.GaussMom):
+            guesser = None
+
         # the runners run the measurement code on observations
         psf_runner = ngmix.runners.PSFRunner(
-            fitter=self.psf_fitter, guesser=self.psf_guesser, ntry=ntry
+            fitter=self.psf_fitter, guesser=psf_guesser, ntry=ntry
             )
         runner = ngmix.runners.Runner(
-            fitter=self.fitter, guesser=self.guesser, ntry=ntry
+            fitter=self.fitter, guesser=guesser, ntry=ntry
             )
 
         #----------------------------------------------------------------------
         # the bootstrapper automates the metacal image shearing as well as both psf
         # and object measurements
-        self.boot = ngmix.metacal.MetacalBootstrapper(
+        if warm_start is True:
+            boot_class = WarmStartMetacalBootstrapper
+        else:
+            boot_class = TimedMetacalBootstrapper
+
+        self.boot = boot_class(
             runner=runner,
             psf_runner=psf_runner,
             step=shear_step,
@@ -353,16 +489,92 @@ class MetacalRunner(object):
             MEDS index of object to be fit
         '''
 
-        obs = self.get_obslist(iobj)
+        with self._span('obslist'):
+            obs = self.get_obslist(iobj)
         obj_info = self.get_obj_info(iobj)
 
         args = [iobj, self.boot, obs, obj_info, self.shear_step]
-        kwargs = {'logprint': self.logprint}
+        kwargs = {
+            'logprint': self.logprint,
+            'rng': self.rng,
+            'seed': self.seed,
+            'nrealizations': self.nrealizations,
+            'timeout': self.timeout,
+            'prescreen': self.prescreen
+            }
 
         return args, kwargs
 
+    def _fit_obj(self, iobj):
+        '''
+        Read & fit a single object, timing both
+
+        iobj: int
+            MEDS index of object to be fit
+
+        returns: (int, list, float, dict)
+            The MEDS index, the (mcal flags, result row) of each
+            realization, the time it took & a row of timing spans
+            (see SpanTimer.to_row())
+        '''
+
+        start = time.time()
+
+        # the MEDS reader adds its cutout reads to the same spans
+        span_timer = SpanTimer()
+        self.meds.span_timer = span_timer
+
+        try:
+            args, kwargs = self._get_fit_args(iobj)
+        finally:
+            self.meds.span_timer = None
+
+        kwargs['span_timer'] = span_timer
+        results = MetacalRunner._fit_one(*args, **kwargs)
+
+        dt = time.time() - start
+
+        return iobj, results, dt, span_timer.to_row(iobj, total=dt)
+
+    def _fit_chunk(self, indices):
+        '''
+        Bulk read the cutouts of a chunk of objects (see
+        BatchedNGMixMEDS.prefetch()) & fit them one by one
+
+        indices: iterable of ints
+            The MEDS indices to fit
+
+        returns: list of (int, list, float, dict)
+            The _fit_obj() output for each object, w/ the prefetch time
+            spread over the objects as the prefetch span
+        '''
+
+        start = time.time()
+        self.meds.prefetch(indices)
+        prefetch_time = time.time() - start
+
+        try:
+            chunk = [self._fit_obj(iobj) for iobj in indices]
+        finally:
+            self.meds.clear_prefetch()
+
+        return spread_block_span(chunk, 'prefetch', prefetch_time)
+
+    def _span(self, name):
+        '''
+        Time a block as a span of the current object, if one is being timed
+        '''
+
+        span_timer = self.meds.span_timer
+        if span_timer is None:
+            span_timer = SpanTimer()
+
+        return span_timer.span(name)
+
     @staticmethod
-    def _fit_one(iobj, bootstrapper, obs, obj_info, mcal_shear, logprint):
+    def _fit_one(iobj, bootstrapper, obs, obj_info, mcal_shear, logprint,
+                 rng=None, seed=None, nrealizations=1, timeout=None,
+                 prescreen=None, span_timer=None):
         '''
         A static method to wrap the mcal fitting to allow
         for multiprocessing
@@ -380,81 +592,276 @@ class MetacalRunner(object):
         logprint: LogPrint
             A LogPrint object, which simultaneously handles
             logging & printing
-
-        returns: astropy.Table
-            A table that holds all mcal info for the obj, including
-            responsivities
+        rng: np.random.RandomState
+            The RandomState shared by the bootstrapper, guessers & prior.
+            Reseeded for each object & realization
+        seed: int
+            The master seed of the run. The rng is seeded from
+            (seed, iobj, realization), so results don't depend on how
+            objects are split between processes, index ranges or restarts
+        nrealizations: int
+            The number of noise realizations to fit
+        timeout: float
+            The wall-clock limit in seconds for the fit of a single
+            realization. Fits that take longer are flagged as a timeout
+        prescreen: McalPrescreen
+            If passed, objects that fail the cheap pre-screen are skipped
+            w/ a skip flag instead of running the bootstrapper
+        span_timer: SpanTimer
+            If passed, the pre-screen, the bootstrapper stages, the
+            value-added cols & the row conversion are timed as its spans
+
+        returns: list of (int, dict)
+            The mcal flags of the obj, and a flat row dict that holds all
+            mcal info for the obj, including responsivities, for each
+            noise realization
         '''
 
         logprint(f'Starting fit for obj {iobj}')
 
+        # first check if object is flagged
+        flagged, flag_name = check_obj_flags(obj_info)
+
+        if flagged is True:
+            logprint(f'object {iobj}: Object flagged with {flag_name}, ' +\
+                     'skipping...')
+            return nrealizations * [(MCAL_FLAGS['obj_flagged'], obj_info)]
+
+        if span_timer is None:
+            span_timer = SpanTimer()
+
+        if prescreen is not None:
+            # deterministic, so the same for all realizations
+            with span_timer.span('prescreen'):
+                skip_flag = prescreen.check(iobj, obs)
+            if skip_flag != 0:
+                logprint(f'object {iobj}: Skipped by the pre-screen ' +\
+                         f'(flag={skip_flag})')
+                return nrealizations * [(skip_flag, obj_info)]
+
+        # the cutouts are only read once, and each realization gets its
+        # own counter-based random stream
+        results = []
+        for k in range(nrealizations):
+            if rng is not None:
+                rng.seed(utils.get_obj_seed(seed, iobj, k))
+            results.append(MetacalRunner._run_bootstrapper(
+                iobj, bootstrapper, obs, obj_info, mcal_shear, logprint,
+                timeout=timeout, span_timer=span_timer
+                ))
+
+        return results
+
+    @staticmethod
+    def _run_bootstrapper(iobj, bootstrapper, obs, obj_info, mcal_shear,
+                          logprint, timeout=None, span_timer=None):
+        '''
+        Run the bootstrapper once on an object; see _fit_one()
+
+        returns: (int, dict)
+            The mcal flags of the obj, and a flat row dict that holds all
+            mcal info for the obj
+        '''
+
+        if span_timer is None:
+            span_timer = SpanTimer()
+
         try:
-            # first check if object is flagged
-            flagged, flag_name = check_obj_flags(obj_info)
+            # a TimedMetacalBootstrapper times its own stages
+            bootstrapper.span_timer = span_timer
+            with fit_time_limit(timeout):
+                res_dict, obs_dict = bootstrapper.go(obs)
 
-            if flagged is True:
-                raise Exception(f'Object flagged with {flag_name}')
+            # compute value-added cols such as PSF size, "roundified" s2n,
+            # etc. The responsivities are computed catalog-wide in go()
+            with span_timer.span('value_added'):
+                add_mcal_cols(res_dict, obs_dict, mcal_shear)
 
-            res_dict, obs_dict = bootstrapper.go(obs)
+            with span_timer.span('to_row'):
+                row = mcal_dict2row(res_dict, obj_info, MCAL_SHEAR_TYPES)
 
-            # compute value-added cols such as gamma-only responsivity,
-            # PSF size, "roundified" s2n, etc.
-            add_mcal_cols(res_dict, obs_dict, mcal_shear)
+            return 0, row
 
-            return mcal_dict2tab(res_dict, obs_dict, obj_info)
+        except FitTimeoutError as e:
+            logprint(f'object {iobj}: {e}, skipping...')
+
+            return MCAL_FLAGS['timeout'], obj_info
 
         except Exception as e:
             logprint(f'object {iobj}: Exception: {e}')
             logprint(f'object {iobj} failed, skipping...')
 
-            return Table()
+            return MCAL_FLAGS['failed'], obj_info
+
+        finally:
+            bootstrapper.span_timer = None
 
-    def go(self, start, end, ncores=1):
+    def go(self, start, end, ncores=1, chunksize=16, checkpoint=None,
+           nrealizations=1, timeout=None, mpi_helper=None):
         '''
         Run the metacal measurement from start to end.
-        NOTE: cannot be parallelized
+
+        start: int
+            The first MEDS index to fit
+        end: int
+            One past the last MEDS index to fit
+        ncores: int
+            The number of processes to use
+        chunksize: int
+            The number of MEDS indices sent to a worker at a time. Each
+            worker reads its own cutouts, so only indices are streamed
+            from the parent process. Chunks are consecutive in MEDS
+            order, so that their cutouts are read in bulk (see
+            BatchedNGMixMEDS), & are handed out as workers free up, the
+            most expensive chunks first
+        checkpoint: McalCheckpoint
+            If passed, finished objects are periodically written to the
+            checkpoint & objects already present in it are not refit
+        nrealizations: int
+            The number of independent metacal noise realizations to run
+            for each object. The cutouts of an object are only read once
+            for all realizations. The RNG of each object & realization is
+            seeded from (self.seed, MEDS index, realization)
+        timeout: float
+            Per-object (and realization) wall-clock limit in seconds.
+            Fits that exceed it get the timeout mcal flag instead of
+            stalling the run. No limit if None
+        mpi_helper: MPIHelper
+            If passed, [start, end) is split evenly over the MPI ranks.
+            Each rank reads & fits its own objects (w/ ncores processes)
+            and the result buffers are gathered on the root rank, which
+            is the only one w/ a mcal_buffer afterwards
+
+        The per-object timing spans (cutout reads, obslist construction,
+        PSF fits, metacal images, galaxy fits, ...) are kept in
+        self.timing; see write_timing()
         '''
 
         if end < start:
             raise ValueError('end must be greater than start!')
-        N = end - start
 
-        self.logprint(f'Starting metacal fitting for {N} objects...')
+        # NOTE: self.rng is shared by the bootstrapper, default guessers
+        # & prior, and is reseeded per object & realization in _fit_one()
+        if self.seed is None:
+            raise ValueError('seed is still None! Try using set_seed()')
+        self.nrealizations = nrealizations
+        self.timeout = timeout
+
+        if mpi_helper is not None:
+            lstart, lend = mpi_helper.mpi_local_range(end - start)
+            local_start, local_end = start + lstart, start + lend
+            self.logprint(f'MPI rank {mpi_helper.mpi_rank}: fitting MEDS ' +\
+                          f'indices [{local_start}, {local_end})')
+        else:
+            local_start, local_end = start, end
+
+        # one preallocated row per MEDS index & realization; filled in place
+        self.mcal_buffer = McalResultBuffer(
+            local_start, local_end, nrealizations=nrealizations
+            )
 
-        if ncores == 1:
-            mcal_tabs = []
-            k = 1
-            for iobj in range(start, end):
-                args, kwargs = self._get_fit_args(iobj)
-                mcal_tabs.append(
-                    MetacalRunner._fit_one(*args, **kwargs)
-                    )
-                k += 1
+        if checkpoint is not None:
+            checkpoint_info = {
+                'medsfile': os.path.abspath(self.medsfile),
+                'seed': None if self.seed is None else int(self.seed),
+                'shear_step': self.shear_step,
+                'start': start,
+                'end': end,
+                'nrealizations': nrealizations,
+                'seeding': 'per_object',
+                }
+
+            # the root rank saves the info of a new checkpoint before
+            # the other ranks compare against it
+            if (mpi_helper is None) or mpi_helper.is_mpi_root():
+                checkpoint.check_info(checkpoint_info)
+            if mpi_helper is not None:
+                mpi_helper.barrier()
+                if not mpi_helper.is_mpi_root():
+                    checkpoint.check_info(checkpoint_info)
+
+            # all ranks share the checkpoint dir; rows outside of the
+            # local index range are ignored, so resuming works for any
+            # number of ranks
+            checkpoint.resume(self.mcal_buffer)
+
+        # consecutive chunks, so that their cutouts are read in bulk; the
+        # most expensive go first, so that they don't end up as stragglers
+        # at the end of the run
+        chunks = order_blocks_by_cost(
+            self.mcal_buffer.get_unprocessed(), self.cat['box_size'],
+            chunksize
+            )
+        ntodo = int(sum(len(chunk) for chunk in chunks))
 
-            self.logprint('Stacking mcal results...')
-            self.mcal_table = vstack(mcal_tabs)
+        self.logprint(f'Starting metacal fitting for {ntodo} objects...')
+
+        timer = FitTimer(ncores=ncores)
+        timing_rows = []
+
+        if ncores == 1:
+            for chunk in chunks:
+                for iobj, results, dt, spans in self._fit_chunk(chunk):
+                    timer.add(dt, skipped=_is_skipped(results))
+                    timing_rows.append(spans)
+                    for k, (flags, row) in enumerate(results):
+                        self.mcal_buffer.fill(iobj, flags, row, realization=k)
+                if checkpoint is not None:
+                    checkpoint.add(self.mcal_buffer, list(chunk))
 
         else:
-            # multiprocessing
+            # multiprocessing; each worker opens its own MEDS handle and
+            # reads the cutouts for the index chunks it is handed
             self.logprint(f'Running on {ncores} cores')
-            with Pool(ncores) as pool:
-                # TODO: I want to use self._get_fit_args() here, but
-                # a little complicated...
-                self.mcal_table = vstack(pool.starmap(
-                    self._fit_one,
-                    [(i,
-                      self.boot,
-                      self.get_obslist(i),
-                      self.get_obj_info(i),
-                      self.shear_step,
-                      self.logprint
-                      # TODO: make this work!
-                      # *args, **kwargs = self._get_fit_args(i)
-                      ) for i in range(start, end)
-                     ])
+            with Pool(ncores,
+                      initializer=_init_worker,
+                      initargs=(self,)) as pool:
+                for chunk in pool.imap_unordered(_fit_chunk, chunks):
+                    for iobj, results, dt, spans in chunk:
+                        timer.add(dt, skipped=_is_skipped(results))
+                        timing_rows.append(spans)
+                        for k, (flags, row) in enumerate(results):
+                            self.mcal_buffer.fill(
+                                iobj, flags, row, realization=k
+                                )
+                    if checkpoint is not None:
+                        checkpoint.add(
+                            self.mcal_buffer, [c[0] for c in chunk]
+                            )
+
+        timer.stop()
+
+        if checkpoint is not None:
+            checkpoint.flush(self.mcal_buffer)
+
+        timer.report(self.logprint)
+
+        self.timing = build_timing_table(timing_rows)
+
+        Ntimeout = np.sum(
+            (self.mcal_buffer.flags & MCAL_FLAGS['timeout']) != 0
+            )
+        if Ntimeout > 0:
+            self.logprint(f'{Ntimeout} fits exceeded the {timeout} s ' +\
+                          'time limit')
+
+        report_fit_iterations(
+            self.mcal_buffer.data, MCAL_SHEAR_TYPES, self.logprint,
+            flags=self.mcal_buffer.flags
+            )
+
+        # R_gamma only for now - selections later
+        add_mcal_responsivities(self.mcal_buffer, self.shear_step)
+
+        if mpi_helper is not None:
+            self.mcal_buffer = gather_buffers(
+                self.mcal_buffer, mpi_helper, start, end
                 )
+            self.timing = gather_timing_tables(self.timing, mpi_helper)
+            if not mpi_helper.is_mpi_root():
+                return
 
-        Nfailed = N - len(self.mcal_table)
+        Nfailed = self.mcal_buffer.Nfailed
         self.logprint(f'{Nfailed} objects failed metacalibration fitting ' +\
                       'and are excluded from output catalog')
         self.logprint('Done!')
@@ -476,7 +883,8 @@ class MetacalRunner(object):
         if self.has_coadd is True:
             # NOTE: doesn't produce the right type...
             # obslist = obslist[1:]
-            se_obslist = ngmix.ObsList(meta=deepcopy(obslist._meta))
+            # a shallow copy is enough, as the meta isn't modified
+            se_obslist = ngmix.ObsList(meta=dict(obslist.meta))
             for obs in obslist[1:]:
                 se_obslist.append(obs)
             obslist = se_obslist
@@ -659,6 +1067,23 @@ class MetacalRunner(object):
 
         return
 
+    def setup_prescreen(self, prescreen=None, **kwargs):
+        '''
+        Enable the cheap pre-screen that skips obvious stars, very low-S/N
+        and unresolved objects before the bootstrapper runs
+
+        prescreen: McalPrescreen
+            A custom pre-screen. If None, one is built from the MEDS object
+            catalog w/ the passed kwargs (see McalPrescreen)
+        '''
+
+        if prescreen is None:
+            prescreen = McalPrescreen(self.cat, **kwargs)
+
+        self.prescreen = prescreen
+
+        return
+
     def setup_lm_pars(self, lm_pars=None):
         if lm_pars is None:
             self._setup_default_lm_pars()
@@ -677,18 +1102,38 @@ class MetacalRunner(object):
 
         return
 
-    def write_output(self, outfile, overwrite=False):
+    def write_output(self, outfile, overwrite=False, combine='median'):
         '''
-        Write mcal_table to outfile
+        Write the mcal results to outfile
 
         outfile: str
             The filename of the output mcal table
+        combine: str
+            For multiple noise realizations, either 'median' to write the
+            median over realizations to outfile or 'none' to write one
+            catalog per realization. See McalResultBuffer.write()
+        '''
+
+        if self.mcal_buffer is None:
+            raise ValueError('mcal_buffer is still None! Try using go()')
+
+        self.mcal_buffer.write(outfile, overwrite=overwrite, combine=combine)
+
+        return
+
+    def write_timing(self, outfile, overwrite=False):
         '''
+        Write the per-object timing spans of the last go() to a sidecar
+        file. Summarize it w/ python mcal_timing.py {outfile}
 
-        if self.mcal_table is None:
-            raise ValueError('mcal_table is still None! Try using go()')
+        outfile: str
+            The filename of the timing table
+        '''
+
+        if self.timing is None:
+            raise ValueError('timing is still None! Try using go()')
 
-        self.mcal_table.write(outfile, overwrite=overwrite)
+        self.timing.write(outfile, overwrite=overwrite)
 
         return
 
@@ -714,9 +1159,6 @@ def add_mcal_cols(res_dict, obs_dict, mcal_shear):
     # the round version of the profile
     add_round_cols(res_dict, obs_dict)
 
-    # R_gamma only for now - selections later
-    add_mcal_responsivities(res_dict, mcal_shear)
-
     return
 
 def add_psf_cols(res_dict, obs_dict):
@@ -833,82 +1275,28 @@ def _compute_obs_s2n_r(result, obs):
 
     return s2n_r
 
-def add_mcal_responsivities(res_dict, mcal_shear):
+def add_mcal_responsivities(mcal_buffer, mcal_shear):
     '''
-    Compute and add the mcal responsivity values to the output
-    result dict from get_metacal_result()
+    Compute and add the mcal responsivity values & calibrated shears
+    for all objects in the result buffer at once. Failed objects and
+    those w/ a singular response matrix get NaNs
     NOTE: These are only for the selection-independent component!
-    '''
-
-    # Define full responsivity matrix, take inner product with shear moments
-    r11 = (res_dict['1p']['g'][0] - res_dict['1m']['g'][0]) / (2*mcal_shear)
-    r12 = (res_dict['2p']['g'][0] - res_dict['2m']['g'][0]) / (2*mcal_shear)
-    r21 = (res_dict['1p']['g'][1] - res_dict['1m']['g'][1]) / (2*mcal_shear)
-    r22 = (res_dict['2p']['g'][1] - res_dict['2m']['g'][1]) / (2*mcal_shear)
-
-    R = [ [r11, r12], [r21, r22] ]
-    Rinv = np.linalg.inv(R)
-    gMC = np.dot(Rinv,
-                 res_dict['noshear']['g']
-                 )
-
-    MC = {
-        'r11':r11, 'r12':r12,
-        'r21':r21, 'r22':r22,
-        'g1_MC':gMC[0], 'g2_MC':gMC[1]
-    }
-
-    res_dict['MC'] = MC
-
-    return
 
-def mcal_dict2tab(mcal_dict, obs_dict, obj_info):
-    '''
-    mcal_dict: dict
-        The main result dictionary returned by the ngmix metacal
-        bootstrapper.go() func
-    obs_dict: dict
-        The ngmix observation dictionary returned by the ngmix metacal
-        boostrapper.go() func, containing meta info like the PSF fit
-    obj_info: np.recarray, Table
-        An array or astropy table with MEDS identification info like
-        id, ra, dec not returned by the bootstrapper
+    mcal_buffer: McalResultBuffer
+        The filled result buffer of a metacal run
+    mcal_shear: float
+        The applied shear in the finite difference calculation
     '''
 
-    # Annoying, but have to do this to make Table from scalars
-    for key, val in obj_info.items():
-        obj_info[key] = np.array([val])
-
-    tab_names = ['noshear', '1p', '1m', '2p', '2m','MC']
-    for name in tab_names:
-        tab = mcal_dict[name]
-
-        for key, val in tab.items():
-            tab[key] = np.array([val])
-
-        mcal_dict[name] = tab
-
-    id_tab = Table(data=obj_info)
+    # nothing to do if every object failed
+    if mcal_buffer.data is None:
+        return
 
-    tab_noshear = Table(mcal_dict['noshear'])
-    tab_1p = Table(mcal_dict['1p'])
-    tab_1m = Table(mcal_dict['1m'])
-    tab_2p = Table(mcal_dict['2p'])
-    tab_2m = Table(mcal_dict['2m'])
-    tab_MC = Table(mcal_dict['MC'])
+    MC = get_mcal_responsivities(mcal_buffer.data, mcal_shear)
 
-    join_tab = hstack([id_tab, hstack([tab_noshear,
-                                       tab_1p,
-                                       tab_1m,
-                                       tab_2p,
-                                       tab_2m,
-                                       tab_MC
-                                       ],
-                                      table_names=tab_names)
-                       ]
-                      )
+    mcal_buffer.add_columns(MC)
 
-    return join_tab
+    return
 
 def check_obj_flags(obj, min_cutouts=1):
     '''
@@ -934,15 +1322,24 @@ def main(args):
     start = args.start
     end = args.end
     ncores = args.ncores
+    base_meds_file = args.medsfile
+    outdir = args.outdir
     vb = args.vb
 
-    test_dir = '/Users/sweveret/repos/superbit-lensing/runs/real-test/'
-    meds_dir = 'redo/real-base/r0/'
-    meds_file = 'real-base_meds.fits'
     shear = 0.01
     seed = 723961
 
-    base_meds_file = os.path.join(test_dir, meds_dir, meds_file)
+    if base_meds_file is None:
+        # NOTE: imported here, as mcal_benchmark imports this module
+        from superbit_lensing.metacalibration.mcal_benchmark import (
+            make_synthetic_meds
+            )
+
+        if outdir is None:
+            outdir = os.path.join(utils.get_test_dir(), 'mcal_runner')
+        if vb is True:
+            print(f'Making a synthetic MEDS file w/ {end} objects in {outdir}')
+        base_meds_file = make_synthetic_meds(outdir, nobjs=end, seed=seed)
 
     if vb is True:
         print('Setting up MetacalRunner...')
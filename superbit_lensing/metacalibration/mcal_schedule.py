@@ -0,0 +1,197 @@
+'''
+Helpers for scheduling metacal fits over a pool of workers: cost-ordered
+work lists, a per-fit wall-clock limit & a summary of the fit timing
+'''
+
+import numpy as np
+import signal
+import time
+from contextlib import contextmanager
+
+class FitTimeoutError(Exception):
+    '''
+    Raised inside a fit that exceeded its wall-clock limit
+    '''
+    pass
+
+@contextmanager
+def fit_time_limit(seconds):
+    '''
+    Raise a FitTimeoutError in the calling process if the wrapped block
+    takes longer than the passed number of seconds. Uses SIGALRM, so it
+    must be used from the main thread of a (worker) process
+
+    seconds: float
+        The wall-clock limit. No limit is set if None or <= 0
+    '''
+
+    if (seconds is None) or (seconds <= 0):
+        yield
+        return
+
+    def _handler(signum, frame):
+        raise FitTimeoutError(f'fit exceeded the {seconds} s time limit')
+
+    old_handler = signal.signal(signal.SIGALRM, _handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+def order_blocks_by_cost(indices, box_size, block_size):
+    '''
+    Split MEDS indices into blocks of up to block_size indices that are
+    consecutive in MEDS order, so that the cutouts of a block are read in
+    bulk (see BatchedNGMixMEDS.prefetch()), & sort the blocks by
+    decreasing estimated fit cost. The cost of a block is the total
+    number of pixels of its cutout boxes
+
+    indices: np.ndarray of ints
+        The MEDS indices to fit
+    box_size: np.ndarray
+        The box_size column of the full MEDS object catalog
+    block_size: int
+        The max number of indices per block
+
+    returns: list of np.ndarray
+        The blocks, most expensive first
+    '''
+
+    if block_size < 1:
+        raise ValueError('block_size must be a positive int!')
+
+    indices = np.sort(np.asarray(indices, dtype=int))
+
+    if len(indices) == 0:
+        return []
+
+    blocks = [indices[i:i+block_size]
+              for i in range(0, len(indices), block_size)]
+
+    box_size = np.asarray(box_size, dtype=float)
+    cost = np.array([np.sum(box_size[block]**2) for block in blocks])
+
+    # stable, so equal-cost blocks stay in MEDS order
+    order = np.argsort(-cost, kind='stable')
+
+    return [blocks[i] for i in order]
+
+class FitTimer(object):
+    '''
+    Collects the per-object fit durations of a run to report the tail
+    latency & how well the cores were kept busy
+    '''
+
+    def __init__(self, ncores=1):
+        '''
+        ncores: int
+            The number of processes fitting objects
+        '''
+
+        self.ncores = ncores
+        self.durations = []
+        self.skipped = []
+
+        self.start_time = time.time()
+        self.end_time = None
+
+        return
+
+    def add(self, duration, skipped=False):
+        '''
+        duration: float
+            The time (s) spent on an object
+        skipped: bool
+            Set if the object was skipped by the pre-screen, i.e. only
+            its pre-screen time is included
+        '''
+
+        self.durations.append(duration)
+        self.skipped.append(skipped)
+
+        return
+
+    def stop(self):
+        self.end_time = time.time()
+
+        return
+
+    def summary(self):
+        '''
+        returns: dict
+            Fit-time percentiles (s), the wall time (s), the core
+            utilization, i.e. the summed fit time over ncores * wall time,
+            & the number of pre-screen skips w/ the estimated time saved
+        '''
+
+        if self.end_time is None:
+            self.stop()
+
+        wall = self.end_time - self.start_time
+        dt = np.asarray(self.durations, dtype=float)
+
+        summary = {
+            'Nfit': len(dt),
+            'wall_time': wall,
+            'busy_time': float(np.sum(dt)),
+            }
+
+        if len(dt) > 0:
+            p50, p90, p99 = np.percentile(dt, [50, 90, 99])
+            summary.update({
+                'p50': p50,
+                'p90': p90,
+                'p99': p99,
+                'max': float(np.max(dt)),
+                })
+
+        # estimate the time saved by the pre-screen as the mean time of a
+        # full fit for each skipped obj, minus the time spent screening
+        skipped = np.asarray(self.skipped, dtype=bool)
+        Nskipped = int(np.sum(skipped))
+        summary['Nskipped'] = Nskipped
+        if (Nskipped > 0) and (Nskipped < len(dt)):
+            summary['time_saved'] = Nskipped * np.mean(dt[~skipped]) - \
+                                    np.sum(dt[skipped])
+        else:
+            summary['time_saved'] = np.nan
+
+        if wall > 0:
+            summary['utilization'] = summary['busy_time'] / \
+                                     (self.ncores * wall)
+        else:
+            summary['utilization'] = np.nan
+
+        return summary
+
+    def report(self, logprint):
+        '''
+        Print the tail latency & core utilization of the run
+
+        logprint: LogPrint
+            A LogPrint object, which simultaneously handles
+            logging & printing
+        '''
+
+        s = self.summary()
+
+        if s['Nfit'] == 0:
+            logprint('No objects were fit; no timing to report')
+            return
+
+        logprint(f'Fit time per object (s): p50={s["p50"]:.3f}, ' +\
+                 f'p90={s["p90"]:.3f}, p99={s["p99"]:.3f}, ' +\
+                 f'max={s["max"]:.3f}')
+        logprint(f'Core utilization: {100*s["utilization"]:.1f}% ' +\
+                 f'({s["busy_time"]:.1f} s of fitting over ' +\
+                 f'{self.ncores} core(s) x {s["wall_time"]:.1f} s wall time)')
+
+        if s['Nskipped'] > 0:
+            logprint(f'Pre-screen skipped {s["Nskipped"]} of {s["Nfit"]} ' +\
+                     f'objects ({100*s["Nskipped"]/s["Nfit"]:.1f}%), saving ' +\
+                     f'~{s["time_saved"]:.1f} s of fitting time')
+
+        return
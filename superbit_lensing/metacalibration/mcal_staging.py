@@ -0,0 +1,233 @@
+'''
+Opt-in staging of MEDS files into node-local shared memory (/dev/shm), so
+that the many metacal processes & array tasks on a node read one staged copy
+instead of each reading the same file from the parallel filesystem
+'''
+
+import os
+import time
+import fcntl
+import shutil
+import socket
+import hashlib
+import uuid
+from glob import glob
+from contextlib import contextmanager
+
+DEFAULT_STAGE_DIR = '/dev/shm/superbit_meds'
+
+class MedsStager(object):
+    '''
+    Stages a MEDS file into a node-local directory. The first process on a
+    node copies the file under a lock file; all later ones attach to the
+    staged copy. Each process holds a reference file, and the staged copy
+    is removed once the last live holder releases it. References of
+    processes that died w/o releasing are ignored
+    '''
+
+    def __init__(self, medsfile, stage_dir=None, keep=False, logprint=None):
+        '''
+        medsfile: str
+            The MEDS file to stage
+        stage_dir: str
+            The node-local staging directory. Defaults to DEFAULT_STAGE_DIR
+        keep: bool
+            Set to keep the staged copy after the last release, e.g. for
+            later array tasks on the same node
+        logprint: LogPrint
+            A LogPrint object, which simultaneously handles
+            logging & printing
+        '''
+
+        if stage_dir is None:
+            stage_dir = DEFAULT_STAGE_DIR
+
+        self.medsfile = os.path.abspath(medsfile)
+        self.stage_dir = stage_dir
+        self.keep = keep
+        self.logprint = logprint
+
+        # the staged name changes if the source file does, so that an
+        # outdated copy is never attached to
+        stat = os.stat(self.medsfile)
+        key = hashlib.sha1(
+            f'{self.medsfile}:{stat.st_size}:{stat.st_mtime_ns}'.encode()
+            ).hexdigest()[:12]
+        self.size = stat.st_size
+
+        self.staged_file = os.path.join(
+            stage_dir, f'{key}_{os.path.basename(self.medsfile)}'
+            )
+        self.lock_file = f'{self.staged_file}.lock'
+
+        # the file to actually read; the source file until acquire()
+        self.path = self.medsfile
+
+        self._ref_file = None
+        self._owner_pid = None
+
+        return
+
+    def _log(self, msg):
+        if self.logprint is not None:
+            self.logprint(msg)
+
+        return
+
+    @contextmanager
+    def _locked(self):
+        '''
+        Hold the node-wide lock of the staged file. The lock file is
+        removed w/ the last reference, so a lock taken on a since-removed
+        lock file is retried on the current one
+        '''
+
+        while True:
+            f = open(self.lock_file, 'a')
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            try:
+                current = os.stat(self.lock_file).st_ino
+            except FileNotFoundError:
+                current = None
+
+            if current == os.fstat(f.fileno()).st_ino:
+                break
+
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def _ref_prefix(self):
+        return f'{self.staged_file}.ref.'
+
+    def _live_refs(self):
+        '''
+        The reference files of live processes on this node. Stale ones are
+        removed
+        '''
+
+        host = socket.gethostname()
+
+        live = []
+        for ref in glob(f'{self._ref_prefix()}*'):
+            # {host}.{pid}.{token}; hostnames may contain dots
+            ref_host, pid, _ = ref[len(self._ref_prefix()):].rsplit('.', 2)
+
+            alive = True
+            if ref_host == host:
+                try:
+                    os.kill(int(pid), 0)
+                except ProcessLookupError:
+                    alive = False
+                except (PermissionError, ValueError):
+                    pass
+
+            if alive is True:
+                live.append(ref)
+            else:
+                os.remove(ref)
+
+        return live
+
+    def acquire(self):
+        '''
+        Stage the MEDS file (if not already staged on this node) & take a
+        reference to it. Falls back to the source file if the staging dir
+        can't be used or lacks the space
+
+        returns: str
+            The path of the file to read
+        '''
+
+        if self._ref_file is not None:
+            return self.path
+
+        try:
+            os.makedirs(self.stage_dir, exist_ok=True)
+        except OSError as e:
+            self._log(f'WARNING: Can\'t use staging dir {self.stage_dir} ' +\
+                      f'({e}); reading {self.medsfile} directly')
+            return self.path
+
+        with self._locked():
+            if not os.path.exists(self.staged_file):
+                free = shutil.disk_usage(self.stage_dir).free
+                if free < 1.05 * self.size:
+                    self._log(f'WARNING: Not enough space in ' +\
+                              f'{self.stage_dir} to stage {self.medsfile} ' +\
+                              f'({self.size/1024**3:.2f} GB); reading it ' +\
+                              'directly')
+                    if len(self._live_refs()) == 0:
+                        os.remove(self.lock_file)
+                    return self.path
+
+                self._log(f'Staging {self.medsfile} to {self.staged_file}')
+                start = time.time()
+
+                # copy & rename, so that a crashed copy is never attached to
+                tmp_file = f'{self.staged_file}.tmp.{os.getpid()}'
+                try:
+                    shutil.copyfile(self.medsfile, tmp_file)
+                    os.replace(tmp_file, self.staged_file)
+                finally:
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+
+                self._log(f'Staging took {time.time()-start:.1f} s')
+            else:
+                self._log(f'Attaching to staged {self.staged_file}')
+
+            self._owner_pid = os.getpid()
+            self._ref_file = f'{self._ref_prefix()}' +\
+                             f'{socket.gethostname()}.{self._owner_pid}.' +\
+                             f'{uuid.uuid4().hex[:8]}'
+            open(self._ref_file, 'w').close()
+
+        self.path = self.staged_file
+
+        return self.path
+
+    def release(self):
+        '''
+        Drop this process' reference & remove the staged copy & its lock
+        file if it was the last one (unless keep is set). Only the process
+        that called acquire() releases, so forked pool workers can't drop
+        it
+        '''
+
+        if (self._ref_file is None) or (os.getpid() != self._owner_pid):
+            return
+
+        with self._locked():
+            if os.path.exists(self._ref_file):
+                os.remove(self._ref_file)
+
+            if (len(self._live_refs()) == 0) and (self.keep is False):
+                if os.path.exists(self.staged_file):
+                    self._log(f'Removing staged {self.staged_file}')
+                    os.remove(self.staged_file)
+
+                # while still holding it; see _locked()
+                os.remove(self.lock_file)
+
+        self._ref_file = None
+        self._owner_pid = None
+        self.path = self.medsfile
+
+        return
+
+    def __enter__(self):
+        self.acquire()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+        return False
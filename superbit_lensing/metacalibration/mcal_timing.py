@@ -0,0 +1,297 @@
+'''
+Per-object timing spans for metacal runs (MEDS reads, obslist
+construction, PSF fits, metacal image generation, galaxy fits, ...),
+written to a sidecar table next to the mcal catalog. Run this module on a
+sidecar file to print a percentile breakdown of where the time goes
+'''
+
+import numpy as np
+import os
+import time
+from contextlib import contextmanager
+from argparse import ArgumentParser
+from astropy.table import Table, vstack
+
+from superbit_lensing.metacalibration.mcal_meds import BatchedNGMixMEDS
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument('timing_file', type=str,
+                        help='Metacal timing sidecar file to summarize')
+    parser.add_argument('-percentiles', type=float, nargs='+',
+                        default=[50, 90, 99],
+                        help='Percentiles to report for each span')
+
+    return parser.parse_args()
+
+def timing_filename(outfile):
+    '''
+    The filename of the timing sidecar of a mcal catalog, e.g.
+    name_mcal.fits -> name_mcal_timing.fits
+
+    outfile: str
+        The filename of the output mcal table
+    '''
+
+    base, ext = os.path.splitext(outfile)
+
+    return f'{base}_timing{ext}'
+
+class SpanTimer(object):
+    '''
+    Accumulates the exclusive wall time of named (possibly nested) spans
+    for a single object, i.e. the time of a span does not include that
+    of the spans nested inside of it. Also holds extra per-object info
+    such as the number of function evaluations of each fit
+    '''
+
+    def __init__(self):
+        self.spans = {}
+        self.info = {}
+
+        # time spent in child spans, for each currently open span
+        self._stack = []
+
+        return
+
+    @contextmanager
+    def span(self, name):
+        '''
+        Time the wrapped block as span name
+
+        name: str
+            The name of the span. Repeated spans of the same name are
+            summed
+        '''
+
+        start = time.perf_counter()
+        self._stack.append(0.)
+
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - start
+            child_time = self._stack.pop()
+            self.spans[name] = self.spans.get(name, 0.) + dt - child_time
+            if len(self._stack) > 0:
+                self._stack[-1] += dt
+
+    def add_info(self, name, val):
+        '''
+        Add a numerical value to the per-object info; repeated values of
+        the same name are summed (e.g. nfev over noise realizations)
+
+        name: str
+            The name of the info column
+        val: int, float
+            The value to add. Ignored if None
+        '''
+
+        if val is None:
+            return
+
+        self.info[name] = self.info.get(name, 0) + val
+
+        return
+
+    def to_row(self, iobj, total=None):
+        '''
+        A flat row dict of the spans (as time_{span}) & info
+
+        iobj: int
+            The MEDS index of the object
+        total: float
+            The total wall time spent on the object, if known
+        '''
+
+        row = {'meds_indx': iobj}
+
+        if total is not None:
+            row['time_total'] = total
+
+        for name, val in self.spans.items():
+            row[f'time_{name}'] = val
+
+        row.update(self.info)
+
+        return row
+
+def spread_block_span(chunk, name, dt):
+    '''
+    Spread the time of a span shared by a block of objects (e.g. a bulk
+    cutout prefetch) evenly over the objects, adding their share to
+    their fit time & to the time_{name} & time_total of their timing row
+
+    chunk: list of (int, results, float, dict)
+        The MEDS index, fit results, fit time & timing row of each object
+    name: str
+        The name of the shared span
+    dt: float
+        The wall time of the shared span
+
+    returns: list of (int, results, float, dict)
+        The chunk w/ the shared time added
+    '''
+
+    if len(chunk) == 0:
+        return chunk
+
+    share = dt / len(chunk)
+
+    spread = []
+    for iobj, results, obj_dt, row in chunk:
+        row[f'time_{name}'] = row.get(f'time_{name}', 0.) + share
+        if 'time_total' in row:
+            row['time_total'] += share
+        spread.append((iobj, results, obj_dt + share, row))
+
+    return spread
+
+class TimedNGMixMEDS(BatchedNGMixMEDS):
+    '''
+    A BatchedNGMixMEDS that adds the time spent reading cutouts & PSF
+    images to the read_cutouts span of its span_timer, if one is set
+    '''
+
+    span_timer = None
+
+    def get_cutout(self, *args, **kwargs):
+        if self.span_timer is None:
+            return super(TimedNGMixMEDS, self).get_cutout(*args, **kwargs)
+
+        with self.span_timer.span('read_cutouts'):
+            return super(TimedNGMixMEDS, self).get_cutout(*args, **kwargs)
+
+    def get_psf(self, *args, **kwargs):
+        if self.span_timer is None:
+            return super(TimedNGMixMEDS, self).get_psf(*args, **kwargs)
+
+        with self.span_timer.span('read_cutouts'):
+            return super(TimedNGMixMEDS, self).get_psf(*args, **kwargs)
+
+def build_timing_table(rows):
+    '''
+    Build a compact timing table from a list of per-object row dicts
+    (see SpanTimer.to_row()). Missing spans are set to 0
+
+    rows: list of dicts
+        The timing rows
+    '''
+
+    names = []
+    for row in rows:
+        for key in row:
+            if key not in names:
+                names.append(key)
+
+    table = Table()
+    for name in names:
+        vals = [row.get(name, 0) for row in rows]
+        if name == 'meds_indx':
+            table[name] = np.array(vals, dtype=np.int64)
+        elif name.startswith('time_'):
+            table[name] = np.array(vals, dtype=np.float32)
+        else:
+            table[name] = np.array(vals, dtype=np.int32)
+
+    return table
+
+def gather_timing_tables(table, mpi_helper):
+    '''
+    Gather the timing tables of all MPI ranks on the root rank
+
+    table: astropy.Table
+        The timing table of the local rank
+    mpi_helper: MPIHelper
+        The MPI helper of the run
+
+    returns: astropy.Table
+        The combined table on the root rank; None on all other ranks
+    '''
+
+    # the column sets can differ between ranks, in which case gather_array
+    # falls back to pickling
+    arrays = mpi_helper.gather_array(table.as_array())
+
+    if not mpi_helper.is_mpi_root():
+        return None
+
+    tables = [Table(a) for a in arrays if len(a) > 0]
+    if len(tables) == 0:
+        return table
+
+    combined = vstack(tables, join_type='outer')
+
+    # spans missing on some ranks are 0, as for build_timing_table()
+    for name in combined.colnames:
+        if hasattr(combined[name], 'filled'):
+            combined[name] = combined[name].filled(0)
+
+    return combined
+
+def summarize_timing(table, percentiles=(50, 90, 99)):
+    '''
+    Compute a percentile breakdown of each timing span & info column
+
+    table: astropy.Table
+        A timing sidecar table
+    percentiles: list of floats
+        The percentiles to compute
+
+    returns: astropy.Table
+        One row per span/info col w/ the requested percentiles, the mean,
+        the sum & (for spans) the fraction of the summed span time
+    '''
+
+    span_cols = [c for c in table.colnames
+                 if c.startswith('time_') and c != 'time_total']
+    info_cols = [c for c in table.colnames
+                 if (c not in span_cols) and
+                 (c not in ['meds_indx', 'time_total'])]
+
+    span_sum = np.sum([np.sum(table[c]) for c in span_cols])
+
+    summary = Table(names=['name'] +
+                    [f'p{p:g}' for p in percentiles] +
+                    ['mean', 'sum', 'frac'],
+                    dtype=[str] + [float]*(len(percentiles)+3))
+
+    for col in span_cols + ['time_total'] + info_cols:
+        if col not in table.colnames:
+            continue
+        vals = np.asarray(table[col], dtype=float)
+        if col in span_cols and span_sum > 0:
+            frac = np.sum(vals) / span_sum
+        else:
+            frac = np.nan
+        summary.add_row(
+            [col] + list(np.percentile(vals, percentiles)) +
+            [np.mean(vals), np.sum(vals), frac]
+            )
+
+    return summary
+
+def main(args):
+    timing_file = args.timing_file
+    percentiles = args.percentiles
+
+    table = Table.read(timing_file)
+
+    print(f'{len(table)} objects in {timing_file}\n')
+
+    summary = summarize_timing(table, percentiles=percentiles)
+
+    for col in summary.colnames[1:]:
+        summary[col].info.format = '.4g'
+
+    summary.pprint(max_lines=-1, max_width=-1)
+
+    return 0
+
+if __name__ == '__main__':
+    args = parse_args()
+    rc = main(args)
+
+    if rc != 0:
+        print(f'mcal_timing failed w/ rc={rc}')
@@ -1,14 +1,29 @@
 import ngmix
-from ngmix.medsreaders import NGMixMEDS
 import numpy as np
-from astropy.table import Table, Row, vstack, hstack
 import os, sys, time, traceback
-from copy import deepcopy
 from argparse import ArgumentParser
 import time
 
 from multiprocessing import Pool
 import superbit_lensing.utils as utils
+import superbit_lensing.metacalibration.mcal_results as mcal_results
+from superbit_lensing.metacalibration.mcal_results import (
+    McalResultBuffer, MCAL_FLAGS
+    )
+from superbit_lensing.metacalibration.mcal_checkpoint import McalCheckpoint
+from superbit_lensing.metacalibration.mcal_staging import MedsStager
+from superbit_lensing.metacalibration.mcal_bootstrap import (
+    TimedMetacalBootstrapper, WarmStartMetacalBootstrapper,
+    report_fit_iterations
+    )
+from superbit_lensing.metacalibration.mcal_timing import (
+    SpanTimer, TimedNGMixMEDS, build_timing_table, gather_timing_tables,
+    spread_block_span, timing_filename
+    )
+from superbit_lensing.galsim.mpi_helper import MPIHelper
+from superbit_lensing.metacalibration.mcal_schedule import (
+    FitTimeoutError, FitTimer, fit_time_limit, order_blocks_by_cost
+    )
 
 import ipdb
 
@@ -26,6 +41,8 @@ parser.add_argument('-end', type=int, default=None,
                     help='Ending index for MEDS processing')
 parser.add_argument('-n', type=int, default=1,
                     help='Number of cores to use')
+parser.add_argument('-chunksize', type=int, default=16,
+                    help='Number of consecutive MEDS indices handed to a worker at a time')
 parser.add_argument('-seed', type=int, default=None,
                     help='Metacalibration seed')
 parser.add_argument('-psf_model', type=str, default='gauss',
@@ -38,6 +55,36 @@ parser.add_argument('--use_coadd', action='store_true', default=False,
                     help='Will use the coadd, if present')                    
 parser.add_argument('--use_coadd_only', action='store_true', default=False,
                     help='Will use the coadd, if present')  
+parser.add_argument('-timeout', type=float, default=None,
+                    help='Wall-clock limit in seconds for the fit of a single ' +\
+                    'object; slower fits are flagged instead of stalling the run')
+parser.add_argument('-nrealizations', type=int, default=1,
+                    help='Number of metacal noise realizations to fit per ' +\
+                    'object in a single pass over the MEDS file')
+parser.add_argument('-combine', type=str, default='median',
+                    choices=['median', 'none'],
+                    help='For nrealizations > 1, write the median over ' +\
+                    'realizations (median) or one catalog per realization (none)')
+parser.add_argument('-checkpoint_dir', type=str, default=None,
+                    help='Directory for checkpoint shards. If set, finished ' +\
+                    'objects are saved periodically and a restarted run ' +\
+                    'only fits the missing objects')
+parser.add_argument('-checkpoint_every', type=int, default=500,
+                    help='Number of finished objects per checkpoint shard')
+parser.add_argument('--keep_checkpoint', action='store_true', default=False,
+                    help='Keep the checkpoint shards after the final mcal ' +\
+                    'catalog is written')
+parser.add_argument('--warm_start', action='store_true', default=False,
+                    help='Start the sheared metacal fits from the noshear solution')
+parser.add_argument('--mpi', action='store_true', default=False,
+                    help='Split the MEDS indices over MPI ranks (e.g. w/ ' +\
+                    'mpirun -n 4); -n is then the number of cores per rank')
+parser.add_argument('--timing', action='store_true', default=False,
+                    help='Write per-object timing spans to a {outfile}_timing ' +\
+                    'sidecar; summarize it w/ python mcal_timing.py {sidecar}')
+parser.add_argument('-stage_dir', type=str, default=None,
+                    help='Stage the MEDS file into this node-local dir (e.g. ' +\
+                    '/dev/shm/superbit_meds) once per node & read it from there')
 parser.add_argument('--overwrite', action='store_true', default=False,
                     help='Overwrite output mcal file')
 parser.add_argument('--vb', action='store_true', default=False,
@@ -73,11 +120,11 @@ class SuperBITNgmixFitter():
 
         try:
             fname = os.path.join(config['outdir'], config['medsfile'])
-            self.medsObj = NGMixMEDS(fname)
+            self.medsObj = TimedNGMixMEDS(fname)
         except OSError:
             fname =config['medsfile']
             print(fname)
-            self.medsObj = NGMixMEDS(fname)
+            self.medsObj = TimedNGMixMEDS(fname)
 
         self.catalog = self.medsObj.get_cat()
 
@@ -92,11 +139,22 @@ class SuperBITNgmixFitter():
 
         return
 
-    def _get_priors(self):
+    def _get_priors(self, seed=None, rng=None):
+        '''
+        seed: int
+            The seed of the prior RNG; defaults to the run seed
+        rng: np.random.RandomState
+            An existing RNG to share w/ the priors. Takes precedence
+            over seed
+        '''
+
+        if seed is None:
+            seed = self.seed
 
         # This bit is needed for ngmix v2.x.x
         # won't work for v1.x.x
-        rng = np.random.RandomState(self.seed)
+        if rng is None:
+            rng = np.random.RandomState(seed)
 
         # prior on ellipticity.  The details don't matter, as long
         # as it regularizes the fit.  This one is from Bernstein & Armstrong 2014
@@ -140,7 +198,7 @@ class SuperBITNgmixFitter():
     def _get_source_observations(self, iobj, weight_type='uberseg'):
 
         obslist = self.medsObj.get_obslist(iobj, weight_type)
-        se_obslist = ngmix.ObsList(meta=deepcopy(obslist._meta))
+        se_obslist = ngmix.ObsList(meta=dict(obslist.meta))
 
         if self.use_coadd_only:
             print('Using only coadd to do ngmix fitting')
@@ -181,7 +239,7 @@ class SuperBITNgmixFitter():
         else:
             print('Using only multi-epoch obs to do ngmix fitting')
             if self.has_coadd:
-                se_obslist = ngmix.ObsList(meta=deepcopy(obslist._meta))
+                se_obslist = ngmix.ObsList(meta=dict(obslist.meta))
                 for obs in obslist[1:]:
                     se_obslist.append(obs)
                 obslist = se_obslist
@@ -201,25 +259,23 @@ def set_seed(config):
 
     return
 
-def write_output_table(outfilename, tab, overwrite=False):
-    tab.write(outfilename, format='fits', overwrite=overwrite)
+def write_output_table(outfilename, mcal_buffer, overwrite=False,
+                       combine='median'):
+    mcal_buffer.write(outfilename, overwrite=overwrite, combine=combine)
 
     return
 
-def mcal_dict2tab(mcal, obsdict, ident):
-    '''
-    mcal is the dict returned by ngmix.get_metacal_result()
+# The metacal result types stored in the output catalog
+MCAL_SHEAR_TYPES = ['noshear', '1p', '1m', '2p', '2m',
+                    '1p_psf', '1m_psf', '2p_psf', '2m_psf']
 
-    ident is an array with MEDS identification info like id, ra, dec
-    not returned by the function
+def add_mcal_psf_cols(mcal, obsdict):
+    '''
+    Add the epoch-averaged PSF size & shape of each shear type to the
+    dict returned by ngmix.get_metacal_result(), in place
     '''
 
-    # Annoying, but have to do this to make Table from scalars
-    for key, val in ident.items():
-        ident[key] = np.array([val])
-
-    tab_names = ['noshear', '1p', '1m', '2p', '2m', '1p_psf', '1m_psf', '2p_psf', '2m_psf']
-    for name in tab_names:
+    for name in MCAL_SHEAR_TYPES:
         tab = mcal[name]
 
         # Remove "pars_cov0" and "pars_cov" keys if they exist
@@ -227,9 +283,6 @@ def mcal_dict2tab(mcal, obsdict, ident):
             if key_to_remove in tab:
                 del tab[key_to_remove]
 
-        for key, val in tab.items():
-            tab[key] = np.array([val])
-
         # Get the psf T by averaging over epochs (and eventually bands)
         tpsf_list = []
         gpsf_list = []
@@ -245,30 +298,28 @@ def mcal_dict2tab(mcal, obsdict, ident):
             except:
                 pass
 
-        tab['Tpsf'] = np.array([np.mean(tpsf_list)]) if tpsf_list else np.array([np.nan])
-        tab['gpsf'] = np.array([np.mean(gpsf_list, axis=0)]) if gpsf_list else np.array([np.nan, np.nan])
+        tab['Tpsf'] = np.mean(tpsf_list) if tpsf_list else np.nan
+        tab['gpsf'] = np.mean(gpsf_list, axis=0) if gpsf_list else np.array([np.nan, np.nan])
 
-        mcal[name] = tab
+    return
 
-    id_tab = Table(data=ident)
+def mcal_dict2row(mcal, obsdict, ident):
+    '''
+    mcal is the dict returned by ngmix.get_metacal_result()
+
+    ident is a dict with MEDS identification info like id, ra, dec
+    not returned by the function
 
-    tab_noshear = Table(mcal['noshear'])
-    tab_1p = Table(mcal['1p'])
-    tab_1m = Table(mcal['1m'])
-    tab_2p = Table(mcal['2p'])
-    tab_2m = Table(mcal['2m'])
-    tab_1p_psf = Table(mcal['1p_psf'])
-    tab_1m_psf = Table(mcal['1m_psf'])
-    tab_2p_psf = Table(mcal['2p_psf'])
-    tab_2m_psf = Table(mcal['2m_psf'])
+    returns a flat row dict of the mcal results (see
+    mcal_results.mcal_dict2row())
+    '''
 
-    join_tab = hstack([id_tab, hstack([tab_noshear, tab_1p, tab_1m, tab_2p, tab_2m,
-                                       tab_1p_psf, tab_1m_psf, tab_2p_psf, tab_2m_psf],
-                                      table_names=tab_names)])
+    add_mcal_psf_cols(mcal, obsdict)
 
-    return join_tab
+    return mcal_results.mcal_dict2row(mcal, ident, MCAL_SHEAR_TYPES)
 
-def mp_fit_one(obslist, prior, rng, psf_model='gauss', gal_model='gauss', mcal_pars= {'psf': 'dilate', 'mcal_shear': 0.01}):
+def mp_fit_one(obslist, prior, rng, psf_model='gauss', gal_model='gauss', mcal_pars= {'psf': 'dilate', 'mcal_shear': 0.01},
+               span_timer=None):
     """
     Multiprocessing version of original _fit_one()
 
@@ -278,7 +329,10 @@ def mp_fit_one(obslist, prior, rng, psf_model='gauss', gal_model='gauss', mcal_p
     inputs:
     - obslist: Observation list for MEDS object of given ID
     - prior: ngmix mcal priors
-    - mcal_pars: mcal running parameters
+    - mcal_pars: mcal running parameters. If mcal_pars['warm_start'] is
+      True, the sheared fits start from the noshear solution
+    - span_timer: if passed, the metacal images, PSF fits & galaxy fits
+      are timed as its spans
 
     TO DO: add a label indicating whether the galaxy passed the selection
     cuts for each shear step (i.e. no_shear,1p,1m,2p,2m).
@@ -316,13 +370,19 @@ def mp_fit_one(obslist, prior, rng, psf_model='gauss', gal_model='gauss', mcal_p
     #types = ['noshear', '1p', '1m', '2p', '2m']
     psf = mcal_pars['psf']
     mcal_shear = mcal_pars['mcal_shear']
-    boot = ngmix.metacal.MetacalBootstrapper(
+    if mcal_pars.get('warm_start', False) is True:
+        boot_class = WarmStartMetacalBootstrapper
+    else:
+        boot_class = TimedMetacalBootstrapper
+
+    boot = boot_class(
         runner=runner, psf_runner=psf_runner,
         rng=rng,
         psf=psf,
         step = mcal_shear,
         #types=types,
     )
+    boot.span_timer = span_timer
 
     resdict, obsdict = boot.go(obslist)
 
@@ -368,13 +428,17 @@ def check_obj_flags(obj, min_cutouts=1):
     return False, None
 
 def mp_run_fit(i, obj, obslist, prior,
-               logprint, rng, psf_model='gauss', gal_model='gauss', mcal_pars= {'psf': 'dilate', 'mcal_shear': 0.01}):
+               logprint, rng, psf_model='gauss', gal_model='gauss', mcal_pars= {'psf': 'dilate', 'mcal_shear': 0.01},
+               timeout=None, span_timer=None):
     '''
     parallelized version of original ngmix_fit code
 
     i: MEDS indx
+    timeout: wall-clock limit of the fit in seconds; slower fits are
+             flagged as a timeout. No limit if None
+    span_timer: SpanTimer that times the stages of the fit as spans
 
-    returns ...
+    returns the mcal flags & a flat result row dict for the object
     '''
 
     start = time.time()
@@ -384,39 +448,166 @@ def mp_run_fit(i, obj, obslist, prior,
     if obslist is None:
         logprint('obslist is None')
 
-    try:
-        # first check if object is flagged
-        flagged, flag_name = check_obj_flags(obj)
+    # first check if object is flagged
+    flagged, flag_name = check_obj_flags(obj)
+
+    if flagged is True:
+        logprint(f'Object flagged with {flag_name}')
+        logprint(f'object {i} failed, skipping...')
+
+        return MCAL_FLAGS['obj_flagged'], obj
 
-        if flagged is True:
-            raise Exception(f'Object flagged with {flag_name}')
+    if span_timer is None:
+        span_timer = SpanTimer()
 
+    try:
         # mcal_res: the bootstrapper's get_mcal_result() dict
         # mcal_fit: the mcal model image
-        resdict, obsdict = mp_fit_one(obslist, prior, rng, psf_model=psf_model, gal_model=gal_model, mcal_pars=mcal_pars)
+        with fit_time_limit(timeout):
+            resdict, obsdict = mp_fit_one(obslist, prior, rng, psf_model=psf_model, gal_model=gal_model, mcal_pars=mcal_pars,
+                                          span_timer=span_timer)
 
         # Ain some identifying info like (ra,dec), id, etc.
         # for key in obj.keys():
         #     mcal_res[key] = obj[key]
 
-        # convert result dict to a formatted table
-        # obj here is the "identifying" table
-        mcal_tab = mcal_dict2tab(resdict, obsdict, obj)
+        with span_timer.span('value_added'):
+            add_mcal_psf_cols(resdict, obsdict)
+
+        # convert result dict to a flat row for the result buffer
+        # obj here is the "identifying" dict
+        with span_timer.span('to_row'):
+            mcal_row = mcal_results.mcal_dict2row(resdict, obj, MCAL_SHEAR_TYPES)
 
         end = time.time()
         logprint(f'Fitting and conversion took {end-start} seconds')
 
+    except FitTimeoutError as e:
+        logprint(f'object {i}: {e}, skipping...')
+
+        return MCAL_FLAGS['timeout'], obj
+
     except Exception as e:
         logprint(f'Exception: {e}')
         logprint(f'object {i} failed, skipping...')
 
-        return Table()
+        return MCAL_FLAGS['failed'], obj
 
     end = time.time()
 
     logprint(f'Total runtime for object was {end-start} seconds')
 
-    return mcal_tab
+    return 0, mcal_row
+
+def mp_run_fits(i, obj, obslist, prior, logprint, rng, seed, nrealizations=1,
+                psf_model='gauss', gal_model='gauss',
+                mcal_pars={'psf': 'dilate', 'mcal_shear': 0.01}, timeout=None,
+                span_timer=None):
+    '''
+    Run mp_run_fit() once per metacal noise realization on the same
+    obslist, so that the cutouts are only read once
+
+    prior: ngmix prior that draws from rng
+    rng: np.random.RandomState, reseeded in place for each realization
+    seed: the master seed of the run. The rng is seeded from
+          (seed, i, realization), so the results of an object don't
+          depend on how the run is split across processes or restarts
+    nrealizations: the number of noise realizations to fit
+    timeout: wall-clock limit in seconds of each realization's fit
+    span_timer: SpanTimer shared by all realizations, whose spans are summed
+
+    returns a list of the mcal flags & flat result row of each realization
+    '''
+
+    res = []
+    for k in range(nrealizations):
+        # NOTE: reseeds the priors & guessers too, as they share rng
+        rng.seed(utils.get_obj_seed(seed, i, k))
+        res.append(mp_run_fit(i, obj, obslist, prior, logprint, rng,
+                              psf_model=psf_model, gal_model=gal_model,
+                              mcal_pars=mcal_pars, timeout=timeout,
+                              span_timer=span_timer))
+
+    return res
+
+def mp_fit_obj(BITfitter, i, fit_args):
+    '''
+    Read the cutouts of MEDS index i & fit all of its realizations
+
+    fit_args: the (args, kwargs) passed on to mp_run_fits()
+
+    returns the MEDS index, the mp_run_fits() results, the time it took &
+    a row of timing spans (see SpanTimer.to_row())
+    '''
+
+    start = time.time()
+
+    # the MEDS reader adds its cutout reads to the same spans
+    span_timer = SpanTimer()
+    BITfitter.medsObj.span_timer = span_timer
+
+    try:
+        with span_timer.span('obslist'):
+            obslist = BITfitter._get_source_observations(i)
+    finally:
+        BITfitter.medsObj.span_timer = None
+
+    res = mp_run_fits(i,
+                      setup_obj(i, BITfitter.medsObj[i]),
+                      obslist,
+                      *fit_args[0], span_timer=span_timer, **fit_args[1])
+
+    dt = time.time() - start
+
+    return i, res, dt, span_timer.to_row(i, total=dt)
+
+# Per-process fitter & fit args used for worker-side MEDS reading; set in
+# each pool worker by _init_worker()
+_worker_state = {}
+
+def _init_worker(config, fit_args):
+    '''
+    Pool initializer. Each worker opens its own MEDS file once so that only
+    MEDS indices (and not cutouts) need to be sent to it
+    '''
+
+    _worker_state['fitter'] = SuperBITNgmixFitter(config)
+    _worker_state['args'] = fit_args
+
+    return
+
+def mp_run_chunk(indices):
+    '''
+    Fit a chunk of MEDS indices, reading cutouts from the worker's own
+    MEDS handle
+
+    indices: iterable of MEDS indices
+    '''
+
+    BITfitter = _worker_state['fitter']
+    fit_args = _worker_state['args']
+
+    return mp_fit_chunk(BITfitter, indices, fit_args)
+
+def mp_fit_chunk(BITfitter, indices, fit_args):
+    '''
+    Bulk read the cutouts of a chunk of MEDS indices (see
+    BatchedNGMixMEDS.prefetch()) & fit them one by one
+
+    returns a list of the mp_fit_obj() output for each index, w/ the
+    prefetch time spread over the indices as the prefetch span
+    '''
+
+    start = time.time()
+    BITfitter.medsObj.prefetch(indices)
+    prefetch_time = time.time() - start
+
+    try:
+        mcal_res = [mp_fit_obj(BITfitter, i, fit_args) for i in indices]
+    finally:
+        BITfitter.medsObj.clear_prefetch()
+
+    return spread_block_span(mcal_res, 'prefetch', prefetch_time)
 
 def main():
 
@@ -430,14 +621,36 @@ def main():
     index_end = args.end
     make_plots = args.plot
     nproc = args.n
+    chunksize = args.chunksize
+    timeout = args.timeout
+    nrealizations = args.nrealizations
+    combine = args.combine
     seed = args.seed
     psf_model = args.psf_model
     gal_model = args.gal_model
     overwrite = args.overwrite
     use_coadd = args.use_coadd
     use_coadd_only = args.use_coadd_only
-    rng  = np.random.RandomState(seed)
-    mcal_pars= {'psf': 'dilate', 'mcal_shear': 0.01}
+    checkpoint_dir = args.checkpoint_dir
+    checkpoint_every = args.checkpoint_every
+    keep_checkpoint = args.keep_checkpoint
+    mpi = args.mpi
+    warm_start = args.warm_start
+    timing = args.timing
+    stage_dir = args.stage_dir
+
+    if mpi is True:
+        M = MPIHelper()
+    else:
+        M = None
+
+    if (seed is None) and (checkpoint_dir is not None):
+        # a restarted run must reuse the seed of the original one
+        checkpoint_info = McalCheckpoint.read_info(checkpoint_dir)
+        if checkpoint_info is not None:
+            seed = checkpoint_info['seed']
+
+    mcal_pars= {'psf': 'dilate', 'mcal_shear': 0.01, 'warm_start': warm_start}
 
     if outdir is None:
         outdir = os.getcwd()
@@ -463,8 +676,15 @@ def main():
     else:
         set_seed(config)
 
+    if M is not None:
+        # all ranks must agree on the master seed
+        config['seed'] = M.bcast(config['seed'])
+
     logdir = outdir
-    logfile = 'mcal_fitting.log'
+    if (M is not None) and (M.mpi_size > 1):
+        logfile = f'mcal_fitting_rank{M.mpi_rank}.log'
+    else:
+        logfile = 'mcal_fitting.log'
     log = utils.setup_logger(logfile, logdir=logdir)
     logprint = utils.LogPrint(log, vb)
 
@@ -478,10 +698,38 @@ def main():
     logprint(f'Use coadd: {use_coadd}')
     logprint(f'vb: {vb}')
     logprint(f'seed: {config["seed"]}')
+    logprint(f'nrealizations: {nrealizations}')
+    logprint(f'warm_start: {warm_start}')
+
+    if stage_dir is not None:
+        # same lookup as SuperBITNgmixFitter
+        meds_path = os.path.join(outdir, medsfile)
+        if not os.path.exists(meds_path):
+            meds_path = medsfile
+        stager = MedsStager(meds_path, stage_dir=stage_dir, logprint=logprint)
+
+        # workers open the staged copy through the config
+        config['medsfile'] = stager.acquire()
+    else:
+        stager = None
 
     BITfitter = SuperBITNgmixFitter(config)
 
-    priors = BITfitter._get_priors()
+    # the priors & guessers share one RNG, which is reseeded from
+    # (seed, MEDS index, realization) before every fit
+    rng = np.random.RandomState(config['seed'])
+    prior = BITfitter._get_priors(rng=rng)
+
+    # NOTE: prior & rng must be pickled together for workers to keep
+    # sharing the same RNG
+    fit_args = (
+        [prior, logprint, rng, config['seed']],
+        {'nrealizations': nrealizations,
+         'psf_model': psf_model,
+         'gal_model': gal_model,
+         'mcal_pars': mcal_pars,
+         'timeout': timeout}
+        )
 
     Ncat = len(BITfitter.catalog)
     if index_start == None:
@@ -498,37 +746,126 @@ def main():
 
     start = time.time()
 
+    # with MPI, each rank fits (& reads the cutouts of) its own slice
+    if M is not None:
+        lstart, lend = M.mpi_local_range(index_end - index_start)
+        local_start, local_end = index_start + lstart, index_start + lend
+        logprint(f'MPI rank {M.mpi_rank}: fitting MEDS indices ' +\
+                 f'[{local_start}, {local_end})')
+    else:
+        local_start, local_end = index_start, index_end
+
+    # one preallocated row per MEDS index & realization; filled in place
+    mcal_res = McalResultBuffer(
+        local_start, local_end, nrealizations=nrealizations
+        )
+
+    if checkpoint_dir is not None:
+        checkpoint = McalCheckpoint(
+            checkpoint_dir, flush_size=checkpoint_every, logprint=logprint
+            )
+        checkpoint_info = {
+            'medsfile': os.path.abspath(medsfile),
+            'seed': config['seed'],
+            'psf_model': psf_model,
+            'gal_model': gal_model,
+            'start': index_start,
+            'end': index_end,
+            'nrealizations': nrealizations,
+            'seeding': 'per_object',
+            }
+
+        # the root rank saves the info of a new checkpoint before the
+        # other ranks compare against it
+        if (M is None) or M.is_mpi_root():
+            checkpoint.check_info(checkpoint_info)
+        if M is not None:
+            M.barrier()
+            if not M.is_mpi_root():
+                checkpoint.check_info(checkpoint_info)
+
+        # rows outside of the local index range are ignored
+        checkpoint.resume(mcal_res)
+    else:
+        checkpoint = None
+
+    # consecutive chunks, so that their cutouts are read in bulk; the
+    # largest go first, so that the slowest fits don't become stragglers
+    # at the end of the run
+    chunks = order_blocks_by_cost(
+        mcal_res.get_unprocessed(), BITfitter.catalog['box_size'], chunksize
+        )
+
+    timer = FitTimer(ncores=nproc)
+    timing_rows = []
+
     # for no multiprocessing:
     if nproc == 1:
-        mcal_res = []
-        for i in range(index_start, index_end):
-            mcal_res.append(mp_run_fit(
-                            i,
-                            setup_obj(i, BITfitter.medsObj[i]),
-                            BITfitter._get_source_observations(i),
-                            priors,
-                            logprint, rng, psf_model, gal_model, mcal_pars)
-                            )
-
-        mcal_res = vstack(mcal_res)
-
-    # for multiprocessing:
+        for chunk in chunks:
+            for i, res, dt, spans in mp_fit_chunk(BITfitter, chunk, fit_args):
+                timer.add(dt)
+                timing_rows.append(spans)
+                for k, (flags, row) in enumerate(res):
+                    mcal_res.fill(i, flags, row, realization=k)
+            if checkpoint is not None:
+                checkpoint.add(mcal_res, list(chunk))
+
+    # for multiprocessing; workers read their own cutouts, so only
+    # small chunks of MEDS indices are sent from here as workers free up
     else:
-        with Pool(nproc) as pool:
-            mcal_res = vstack(pool.starmap(mp_run_fit,
-                                        [(i,
-                                          setup_obj(i, BITfitter.medsObj[i]),
-                                          BITfitter._get_source_observations(i),
-                                          priors,
-                                          logprint, rng, psf_model, gal_model, mcal_pars) for i in range(index_start, index_end)
-                                          ]
-                                        )
-                            )
+        init_args = (config, fit_args)
+
+        with Pool(nproc, initializer=_init_worker,
+                  initargs=init_args) as pool:
+            for res in pool.imap_unordered(mp_run_chunk, chunks):
+                for i, obj_res, dt, spans in res:
+                    timer.add(dt)
+                    timing_rows.append(spans)
+                    for k, (flags, row) in enumerate(obj_res):
+                        mcal_res.fill(i, flags, row, realization=k)
+                if checkpoint is not None:
+                    checkpoint.add(mcal_res, [r[0] for r in res])
+
+    timer.stop()
+
+    if checkpoint is not None:
+        checkpoint.flush(mcal_res)
 
     end = time.time()
 
+    # the results are in memory, so the staged MEDS file can go
+    if stager is not None:
+        BITfitter.medsObj = None
+        stager.release()
+
+    timer.report(logprint)
+
+    timing_table = build_timing_table(timing_rows)
+
+    Ntimeout = np.sum((mcal_res.flags & MCAL_FLAGS['timeout']) != 0)
+    if Ntimeout > 0:
+        logprint(f'{Ntimeout} fits exceeded the {timeout} s time limit')
+
+    report_fit_iterations(
+        mcal_res.data, MCAL_SHEAR_TYPES, logprint, flags=mcal_res.flags
+        )
+
+    if M is not None:
+        # only the compact result rows are sent to the root rank
+        mcal_res = mcal_results.gather_buffers(
+            mcal_res, M, index_start, index_end
+            )
+        timing_table = gather_timing_tables(timing_table, M)
+        if not M.is_mpi_root():
+            logprint('Done!')
+            return 0
+
+        nproc *= M.mpi_size
+
     T = end - start
     logprint(f'Total fitting and stacking time: {T} seconds')
+    logprint(f'{mcal_res.Nfailed} objects failed metacalibration fitting ' +\
+             'and are excluded from output catalog')
 
     N = index_end - index_start
     logprint(f'{T/N} seconds per object (wall time)')
@@ -541,7 +878,16 @@ def main():
     out = os.path.join(outdir, outfilename)
     logprint(f'Writing results to {out}')
 
-    write_output_table(out, mcal_res, overwrite=overwrite)
+    write_output_table(out, mcal_res, overwrite=overwrite, combine=combine)
+
+    if timing is True:
+        timing_file = timing_filename(out)
+        logprint(f'Writing timing spans to {timing_file}')
+        timing_table.write(timing_file, overwrite=overwrite)
+
+    if (checkpoint is not None) and (keep_checkpoint is False):
+        logprint(f'Removing checkpoint shards in {checkpoint_dir}')
+        checkpoint.clean()
 
     logprint('Done!')
 
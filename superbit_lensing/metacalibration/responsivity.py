@@ -0,0 +1,209 @@
+'''
+Catalog-wide metacalibration responsivity & shear calibration. Everything
+here works on whole columns (e.g. of an mcal catalog) at once, using the
+closed-form inverse of the 2x2 response matrices rather than a per-object
+np.linalg.inv()
+'''
+
+import numpy as np
+
+# Response matrices w/ a smaller |det| than this are treated as singular
+DEFAULT_MIN_DET = 1.0e-8
+
+def get_responsivities(cat, mcal_shear):
+    '''
+    Compute the per-object shear responsivities R_ij = dg_i/dgamma_j from
+    the metacal sheared fits
+
+    cat: astropy.Table, np.ndarray
+        An mcal catalog with g_1p, g_1m, g_2p & g_2m columns of shape (N, 2)
+    mcal_shear: float
+        The applied shear in the finite difference calculation
+
+    returns: r11, r12, r21, r22 (np.ndarrays of shape (N,))
+    '''
+
+    g_1p = np.asarray(cat['g_1p'])
+    g_1m = np.asarray(cat['g_1m'])
+    g_2p = np.asarray(cat['g_2p'])
+    g_2m = np.asarray(cat['g_2m'])
+
+    r11 = (g_1p[:, 0] - g_1m[:, 0]) / (2.*mcal_shear)
+    r12 = (g_2p[:, 0] - g_2m[:, 0]) / (2.*mcal_shear)
+    r21 = (g_1p[:, 1] - g_1m[:, 1]) / (2.*mcal_shear)
+    r22 = (g_2p[:, 1] - g_2m[:, 1]) / (2.*mcal_shear)
+
+    return r11, r12, r21, r22
+
+def get_mean_responsivity(cat, mcal_shear):
+    '''
+    The mean shear response matrix <R_gamma> of a selected catalog
+
+    cat: astropy.Table, np.ndarray
+        An mcal catalog with g_1p, g_1m, g_2p & g_2m columns
+    mcal_shear: float
+        The applied shear in the finite difference calculation
+
+    returns: np.ndarray of shape (2, 2)
+    '''
+
+    r11, r12, r21, r22 = get_responsivities(cat, mcal_shear)
+
+    return np.array([
+        [np.mean(r11), np.mean(r12)],
+        [np.mean(r21), np.mean(r22)]
+        ])
+
+def get_selection_responsivity(g_1p, g_1m, g_2p, g_2m, mcal_shear):
+    '''
+    The selection response matrix R_S, given the noshear ellipticities of
+    the objects that pass the selection made on each sheared catalog
+
+    g_1p, g_1m, g_2p, g_2m: np.ndarrays of shape (N_sel, 2)
+        The g_noshear column of the 1p, 1m, 2p & 2m selections
+    mcal_shear: float
+        The applied shear in the finite difference calculation
+
+    returns: np.ndarray of shape (2, 2)
+    '''
+
+    g_1p = np.asarray(g_1p)
+    g_1m = np.asarray(g_1m)
+    g_2p = np.asarray(g_2p)
+    g_2m = np.asarray(g_2m)
+
+    r11 = (np.mean(g_1p[:, 0]) - np.mean(g_1m[:, 0])) / (2.*mcal_shear)
+    r12 = (np.mean(g_2p[:, 0]) - np.mean(g_2m[:, 0])) / (2.*mcal_shear)
+    r21 = (np.mean(g_1p[:, 1]) - np.mean(g_1m[:, 1])) / (2.*mcal_shear)
+    r22 = (np.mean(g_2p[:, 1]) - np.mean(g_2m[:, 1])) / (2.*mcal_shear)
+
+    return np.array([[r11, r12], [r21, r22]])
+
+def invert_responsivities(r11, r12, r21, r22, min_det=DEFAULT_MIN_DET):
+    '''
+    Closed-form inverse of (a batch of) 2x2 response matrices. Singular
+    matrices (|det| < min_det) and non-finite inputs give NaN entries
+    instead of raising a LinAlgError
+
+    r11, r12, r21, r22: floats or np.ndarrays
+        The response matrix entries
+    min_det: float
+        The minimum allowed |det(R)|
+
+    returns: rinv11, rinv12, rinv21, rinv22, singular
+        The inverse matrix entries & a bool (array) that is True where R
+        was singular
+    '''
+
+    r11 = np.asarray(r11, dtype=float)
+    r12 = np.asarray(r12, dtype=float)
+    r21 = np.asarray(r21, dtype=float)
+    r22 = np.asarray(r22, dtype=float)
+
+    det = r11*r22 - r12*r21
+    singular = ~np.isfinite(det) | (np.abs(det) < min_det)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_det = np.where(singular, np.nan, 1. / det)
+
+    return r22*inv_det, -r12*inv_det, -r21*inv_det, r11*inv_det, singular
+
+def invert_response_matrix(R, min_det=DEFAULT_MIN_DET):
+    '''
+    Same as invert_responsivities(), but for a single 2x2 matrix. Raises
+    a ValueError if R is singular
+
+    R: np.ndarray of shape (2, 2)
+        The response matrix
+
+    returns: np.ndarray of shape (2, 2)
+    '''
+
+    R = np.asarray(R)
+    i11, i12, i21, i22, singular = invert_responsivities(
+        R[0, 0], R[0, 1], R[1, 0], R[1, 1], min_det=min_det
+        )
+
+    if singular:
+        raise ValueError(f'Response matrix is singular:\n{R}')
+
+    return np.array([[i11, i12], [i21, i22]])
+
+def apply_responsivities(g, r11, r12, r21, r22, min_det=DEFAULT_MIN_DET):
+    '''
+    Calibrate the ellipticities of each object by its own inverse response
+    matrix, g_MC = R^-1 g
+
+    g: np.ndarray of shape (N, 2)
+        The (noshear) ellipticities
+    r11, r12, r21, r22: np.ndarrays of shape (N,)
+        The per-object responsivities
+    min_det: float
+        The minimum allowed |det(R)|. Objects w/ a singular R get NaNs
+
+    returns: g1_MC, g2_MC, singular (np.ndarrays of shape (N,))
+    '''
+
+    g = np.asarray(g)
+
+    i11, i12, i21, i22, singular = invert_responsivities(
+        r11, r12, r21, r22, min_det=min_det
+        )
+
+    g1_MC = i11*g[:, 0] + i12*g[:, 1]
+    g2_MC = i21*g[:, 0] + i22*g[:, 1]
+
+    return g1_MC, g2_MC, singular
+
+def get_mcal_responsivities(cat, mcal_shear, min_det=DEFAULT_MIN_DET):
+    '''
+    Compute the selection-independent per-object responsivities and
+    calibrated shears for a full mcal catalog. Objects with a singular
+    response matrix (or failed fits) get NaN g1_MC/g2_MC
+
+    cat: astropy.Table, np.ndarray
+        An mcal catalog with g_noshear, g_1p, g_1m, g_2p & g_2m columns
+    mcal_shear: float
+        The applied shear in the finite difference calculation
+    min_det: float
+        The minimum allowed |det(R)|
+
+    returns: dict
+        The r11, r12, r21, r22, g1_MC & g2_MC columns
+    '''
+
+    r11, r12, r21, r22 = get_responsivities(cat, mcal_shear)
+    g1_MC, g2_MC, singular = apply_responsivities(
+        cat['g_noshear'], r11, r12, r21, r22, min_det=min_det
+        )
+
+    return {
+        'r11': r11, 'r12': r12,
+        'r21': r21, 'r22': r22,
+        'g1_MC': g1_MC, 'g2_MC': g2_MC
+        }
+
+def get_weights(g_cov, shape_noise, R_inv=None):
+    '''
+    Inverse-variance shape weights, w = 1 / (shape_noise + C_11 + C_22)
+
+    g_cov: np.ndarray of shape (N, 2, 2)
+        The per-object ellipticity covariance
+    shape_noise: float
+        The shape noise term added to the measurement variance
+    R_inv: np.ndarray of shape (2, 2)
+        If passed, the covariance is first transformed to that of the
+        calibrated shear, R^-1 C R^-T
+
+    returns: weight, cov
+        The weights & the (possibly transformed) covariance
+    '''
+
+    cov = np.asarray(g_cov)
+
+    if R_inv is not None:
+        cov = np.einsum('ij,njk,lk->nil', R_inv, cov, R_inv)
+
+    weight = 1. / (shape_noise + cov[:, 0, 0] + cov[:, 1, 1])
+
+    return weight, cov
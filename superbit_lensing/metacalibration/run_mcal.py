@@ -14,6 +14,9 @@ BASE = os.path.dirname(
     )
 sys.path.insert(0, BASE)
 from mcal_runner import MetacalRunner, build_fitter
+from superbit_lensing.metacalibration.mcal_checkpoint import McalCheckpoint
+from superbit_lensing.metacalibration.mcal_timing import timing_filename
+from superbit_lensing.galsim.mpi_helper import MPIHelper
 import superbit_lensing.utils as utils
 
 import ipdb
@@ -39,6 +42,47 @@ def parse_args():
                         help='Number of tries before accepting a fit failure')
     parser.add_argument('-ncores', type=int, default=1,
                         help='Number of cores to use')
+    parser.add_argument('-chunksize', type=int, default=16,
+                        help='Number of consecutive MEDS indices handed to a worker ' +\
+                        'at a time when ncores > 1')
+    parser.add_argument('-timeout', type=float, default=None,
+                        help='Wall-clock limit in seconds for the fit of a single ' +\
+                        'object; slower fits are flagged instead of stalling the run')
+    parser.add_argument('-nrealizations', type=int, default=1,
+                        help='Number of metacal noise realizations to fit ' +\
+                        'per object in a single pass over the MEDS file')
+    parser.add_argument('-combine', type=str, default='median',
+                        choices=['median', 'none'],
+                        help='For nrealizations > 1, write the median over ' +\
+                        'realizations (median) or one catalog per ' +\
+                        'realization (none)')
+    parser.add_argument('-checkpoint_dir', type=str, default=None,
+                        help='Directory for checkpoint shards. If set, ' +\
+                        'finished objects are saved periodically and a ' +\
+                        'restarted run only fits the missing objects')
+    parser.add_argument('-checkpoint_every', type=int, default=500,
+                        help='Number of finished objects per checkpoint shard')
+    parser.add_argument('--keep_checkpoint', action='store_true', default=False,
+                        help='Keep the checkpoint shards after the final ' +\
+                        'mcal catalog is written')
+    parser.add_argument('--warm_start', action='store_true', default=False,
+                        help='Start the sheared metacal fits from the ' +\
+                        'noshear solution')
+    parser.add_argument('--prescreen', action='store_true', default=False,
+                        help='Skip obvious stars, very low-S/N & unresolved ' +\
+                        'objects w/ a cheap moments pre-screen before the ' +\
+                        'metacal fit')
+    parser.add_argument('--mpi', action='store_true', default=False,
+                        help='Split the MEDS indices over MPI ranks (e.g. ' +\
+                        'w/ mpirun -n 4); ncores is then per rank')
+    parser.add_argument('--timing', action='store_true', default=False,
+                        help='Write per-object timing spans to a ' +\
+                        '{outfile}_timing sidecar; summarize it w/ ' +\
+                        'python mcal_timing.py {sidecar}')
+    parser.add_argument('-stage_dir', type=str, default=None,
+                        help='Stage the MEDS file into this node-local dir ' +\
+                        '(e.g. /dev/shm/superbit_meds) once per node & read ' +\
+                        'it from there')
     parser.add_argument('--overwrite', action='store_true', default=False,
                         help='Overwrite output mcal file')
     parser.add_argument('--vb', action='store_true', default=False,
@@ -69,10 +113,27 @@ def main(args):
     shear = args.shear
     ntry = args.ntry
     ncores = args.ncores
+    chunksize = args.chunksize
+    timeout = args.timeout
+    nrealizations = args.nrealizations
+    combine = args.combine
+    checkpoint_dir = args.checkpoint_dir
+    checkpoint_every = args.checkpoint_every
+    keep_checkpoint = args.keep_checkpoint
     make_plots = args.plot
     overwrite = args.overwrite
+    mpi = args.mpi
+    prescreen = args.prescreen
+    warm_start = args.warm_start
+    timing = args.timing
+    stage_dir = args.stage_dir
     vb = args.vb
 
+    if mpi is True:
+        M = MPIHelper()
+    else:
+        M = None
+
     #-----------------------------------------------------------------
     # Initial setup
 
@@ -83,14 +144,19 @@ def main(args):
         os.mkdir(outdir)
 
     logdir = outdir
-    logfile = 'mcal_fitting.log'
+    if (M is not None) and (M.mpi_size > 1):
+        logfile = f'mcal_fitting_rank{M.mpi_rank}.log'
+    else:
+        logfile = 'mcal_fitting.log'
     log = utils.setup_logger(logfile, logdir=logdir)
     logprint = utils.LogPrint(log, vb)
 
     #-----------------------------------------------------------------
     # Create & setup metacal runner
 
-    mcal_runner = MetacalRunner(medsfile, logprint=logprint)
+    mcal_runner = MetacalRunner(
+        medsfile, logprint=logprint, stage_dir=stage_dir
+        )
 
     Ncat = mcal_runner.Nobjs
 
@@ -113,8 +179,22 @@ def main(args):
                  f'catalog size of {Ncat}; running over full catalog')
         index_end = Ncat
 
+    if checkpoint_dir is not None:
+        checkpoint = McalCheckpoint(
+            checkpoint_dir, flush_size=checkpoint_every, logprint=logprint
+            )
+        checkpoint_info = checkpoint.read_info(checkpoint_dir)
+        if (seed is None) and (checkpoint_info is not None):
+            # a restarted run must reuse the seed of the original one
+            seed = checkpoint_info['seed']
+    else:
+        checkpoint = None
+
     if seed is None:
         seed = np.random.randint(0, 2**32-1)
+    if M is not None:
+        # all ranks must agree on the master seed
+        seed = M.bcast(seed)
     logprint(f'Using metacal seed {seed}')
     mcal_runner.set_seed(seed)
 
@@ -149,9 +229,13 @@ def main(args):
     mcal_runner.setup_bootstrapper(
         gal_fitter, psf_fitter, shear,
         gal_kwargs=gal_kwargs, psf_kwargs=psf_kwargs,
-        ntry=ntry
+        ntry=ntry, warm_start=warm_start
         )
 
+    if prescreen is True:
+        logprint('Using the metacal pre-screen')
+        mcal_runner.setup_prescreen()
+
     #-----------------------------------------------------------------
     # Run metacal
 
@@ -160,10 +244,25 @@ def main(args):
 
     start = time.time()
 
-    mcal_runner.go(index_start, index_end, ncores=ncores)
+    mcal_runner.go(
+        index_start, index_end, ncores=ncores, chunksize=chunksize,
+        checkpoint=checkpoint, nrealizations=nrealizations,
+        timeout=timeout, mpi_helper=M
+        )
 
     end = time.time()
 
+    # the results are in memory, so the staged MEDS file can go
+    mcal_runner.close()
+
+    if (M is not None) and (not M.is_mpi_root()):
+        # only the root rank holds the gathered results
+        logprint('Done!')
+        return 0
+
+    if M is not None:
+        ncores *= M.mpi_size
+
     T = end - start
     logprint(f'Total fitting and stacking time: {T} seconds')
 
@@ -175,7 +274,16 @@ def main(args):
 
     outfile = os.path.join(outdir, outfile)
     logprint(f'Writing results to {outfile}')
-    mcal_runner.write_output(outfile, overwrite=overwrite)
+    mcal_runner.write_output(outfile, overwrite=overwrite, combine=combine)
+
+    if timing is True:
+        timing_file = timing_filename(outfile)
+        logprint(f'Writing timing spans to {timing_file}')
+        mcal_runner.write_timing(timing_file, overwrite=overwrite)
+
+    if (checkpoint is not None) and (keep_checkpoint is False):
+        logprint(f'Removing checkpoint shards in {checkpoint_dir}')
+        checkpoint.clean()
 
     logprint('Done!')
 
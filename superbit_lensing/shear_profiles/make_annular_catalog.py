@@ -10,6 +10,7 @@ from argparse import ArgumentParser
 from annular_jmac import Annular, ShearCalc
 from make_redshift_cat import make_redshift_catalog
 from superbit_lensing import utils
+from superbit_lensing.metacalibration import responsivity
 
 def parse_args():
 
@@ -312,49 +313,31 @@ class AnnularCatalog():
                                  & (mcal['redshift'] > min_redshift)
                                  ]
 
-        selection_1p = mcal[(mcal['T_1p'] > min_Tpsf*mcal['Tpsf_1p'])\
-                            & (mcal['T_1p'] < max_T)\
-                            & (mcal['T_1p'] > min_T)\
-                            & (mcal['s2n_1p'] > min_sn)\
-                            & (mcal['s2n_1p'] < max_sn)\
-                            & (mcal['redshift'] > min_redshift)
-                            ]
-
-        selection_1m = mcal[(mcal['T_1m'] > min_Tpsf*mcal['Tpsf_1m'])\
-                            & (mcal['T_1m'] < max_T)\
-                            & (mcal['T_1m'] > min_T)\
-                            & (mcal['s2n_1m'] > min_sn)\
-                            & (mcal['s2n_1m'] < max_sn)\
-                            & (mcal['redshift'] > min_redshift)
-                            ]
-
-        selection_2p = mcal[(mcal['T_2p'] > min_Tpsf*mcal['Tpsf_2p'])\
-                            & (mcal['T_2p'] < max_T)\
-                            & (mcal['T_2p'] > min_T)\
-                            & (mcal['s2n_2p'] > min_sn)\
-                            & (mcal['s2n_2p'] < max_sn)\
-                            & (mcal['redshift'] > min_redshift)
-                            ]
-
-        selection_2m = mcal[(mcal['T_2m'] > min_Tpsf*mcal['Tpsf_2m'])\
-                            & (mcal['T_2m'] < max_T)\
-                            & (mcal['T_2m'] > min_T)\
-                            & (mcal['s2n_2m'] > min_sn)\
-                            & (mcal['s2n_2m'] < max_sn)\
-                            & (mcal['redshift'] > min_redshift)
-                            ]
+        # the sheared selections are only needed for the mean g_noshear
+        # in R_S, so keep masks rather than copying the full catalog
+        sel_g = {}
+        for shear_type in ['1p', '1m', '2p', '2m']:
+            T = mcal[f'T_{shear_type}']
+            s2n = mcal[f's2n_{shear_type}']
+            sel = (T > min_Tpsf*mcal[f'Tpsf_{shear_type}'])\
+                & (T < max_T)\
+                & (T > min_T)\
+                & (s2n > min_sn)\
+                & (s2n < max_sn)\
+                & (mcal['redshift'] > min_redshift)
+            sel_g[shear_type] = mcal['g_noshear'][sel]
 
         # assuming delta_shear in ngmix_fit is 0.01
-        r11_gamma = (np.mean(noshear_selection['g_1p'][:,0]) -
-                     np.mean(noshear_selection['g_1m'][:,0])) / (2.*mcal_shear)
-        r22_gamma = (np.mean(noshear_selection['g_2p'][:,1]) -
-                     np.mean(noshear_selection['g_2m'][:,1])) / (2.*mcal_shear)
+        R_gamma = responsivity.get_mean_responsivity(
+            noshear_selection, mcal_shear
+            )
+        r11_gamma, r22_gamma = R_gamma[0,0], R_gamma[1,1]
 
         # assuming delta_shear in ngmix_fit is 0.01
-        r11_S = (np.mean(selection_1p['g_noshear'][:,0]) -
-                 np.mean(selection_1m['g_noshear'][:,0])) / (2.*mcal_shear)
-        r22_S = (np.mean(selection_2p['g_noshear'][:,1]) -
-                 np.mean(selection_2m['g_noshear'][:,1])) / (2.*mcal_shear)
+        R_S = responsivity.get_selection_responsivity(
+            sel_g['1p'], sel_g['1m'], sel_g['2p'], sel_g['2m'], mcal_shear
+            )
+        r11_S, r22_S = R_S[0,0], R_S[1,1]
 
         print(f'# mean values <r11_gamma> = {r11_gamma} ' +\
               f'<r22_gamma> = {r22_gamma}')
@@ -374,18 +357,15 @@ class AnnularCatalog():
 
         print(f'shape noise is {shape_noise}')
 
-        tot_covar = shape_noise +\
-                self.selected['g_cov_noshear'][:,0,0] +\
-                self.selected['g_cov_noshear'][:,1,1]
+        weight, _ = responsivity.get_weights(
+            self.selected['g_cov_noshear'], shape_noise
+            )
 
-        weight = 1. / tot_covar
+        r11, r12, r21, r22 = responsivity.get_responsivities(
+            noshear_selection, mcal_shear
+            )
 
         try:
-            r11 = ( noshear_selection['g_1p'][:,0] - noshear_selection['g_1m'][:,0] ) / (2.*mcal_shear)
-            r12 = ( noshear_selection['g_2p'][:,0] - noshear_selection['g_2m'][:,0] ) / (2.*mcal_shear)
-            r21 = ( noshear_selection['g_1p'][:,1] - noshear_selection['g_1m'][:,1] ) / (2.*mcal_shear)
-            r22 = ( noshear_selection['g_2p'][:,1] - noshear_selection['g_2m'][:,1] ) / (2.*mcal_shear)
-
             #---------------------------------
             # Now add value-adds to table
             self.selected.add_columns(
@@ -399,16 +379,15 @@ class AnnularCatalog():
                   'already present in catalog')
 
         try:
-            R = np.array([[r11, r12], [r21, r22]])
-            g1_MC = np.zeros_like(r11)
-            g2_MC = np.zeros_like(r22)
-
-            N = len(g1_MC)
-            for k in range(N):
-                Rinv = np.linalg.inv(R[:,:,k])
-                gMC = np.dot(Rinv, noshear_selection[k]['g_noshear'])
-                g1_MC[k] = gMC[0]
-                g2_MC[k] = gMC[1]
+            # closed-form inverse of every R at once; objects w/ a
+            # singular R get NaNs instead of raising a LinAlgError
+            g1_MC, g2_MC, singular = responsivity.apply_responsivities(
+                noshear_selection['g_noshear'], r11, r12, r21, r22
+                )
+
+            if np.any(singular):
+                print(f'WARNING: {np.sum(singular)} objects have a ' +\
+                      'singular response matrix; setting g{1/2}_MC to NaN')
 
             self.selected.add_columns(
                 [g1_MC, g2_MC],
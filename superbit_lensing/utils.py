@@ -243,6 +243,33 @@ def generate_seeds(Nseeds, master_seed=None, seed_bounds=(0, 2**32-1)):
 
     return seeds
 
+def get_obj_seed(master_seed, index, realization=0):
+    '''
+    Generate a counter-based seed for a single object (and noise
+    realization) from a master seed. As it only depends on the passed
+    values, an object gets the same seed regardless of how a run is
+    split into index ranges, processes or restarts
+
+    master_seed: int
+        The master seed of the run
+    index: int
+        The index of the object, e.g. its MEDS index
+    realization: int
+        The noise realization of the object
+    '''
+
+    if master_seed is None:
+        raise ValueError('master_seed must be set for per-object seeds!')
+
+    for val in [master_seed, index, realization]:
+        if int(val) < 0:
+            raise ValueError('master_seed, index & realization must be ' +\
+                             'non-negative ints!')
+
+    ss = SeedSequence([int(master_seed), int(index), int(realization)])
+
+    return int(ss.generate_state(1, dtype=np.uint32)[0])
+
 def check_req_params(config, params, defaults):
     '''
     Ensure that certain required parameters have their values set to
@@ -389,6 +416,18 @@ def ngmix_dict2table(d):
 
     return Table(data=d)
 
+def get_available_cores():
+    '''
+    The number of cores this process may run on, e.g. its SLURM allocation
+    on a shared node, rather than all of the node's cores. Falls back to
+    os.cpu_count() where the CPU affinity isn't available
+    '''
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
 def setup_batches(nobjs, ncores):
     '''
     Create list of batch indices for each core
@@ -408,6 +447,25 @@ def setup_batches(nobjs, ncores):
 
     return batch_indices
 
+def setup_chunks(start, end, chunksize):
+    '''
+    Split the index range [start, end) into contiguous chunks of at
+    most chunksize indices, e.g. to stream to a multiprocessing pool
+
+    start: int
+        The first index of the range
+    end: int
+        One past the last index of the range
+    chunksize: int
+        The maximum number of indices per chunk
+    '''
+
+    if chunksize < 1:
+        raise ValueError('chunksize must be a positive int!')
+
+    return [range(i, min(i+chunksize, end))
+            for i in range(start, end, chunksize)]
+
 def get_pixel_scale(image_filename):
     '''
     use astropy.wcs to obtain the pixel scale (a/k/a plate scale)
@@ -438,7 +496,8 @@ def make_dir(d):
     Makes dir if it does not already exist
     '''
     if not os.path.exists(d):
-        os.makedirs(d)
+        # exist_ok, as e.g. several MPI ranks may race to create it
+        os.makedirs(d, exist_ok=True)
 
 def get_base_dir():
     '''